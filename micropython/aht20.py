@@ -23,6 +23,7 @@
 
 from time import sleep_ms
 
+import micropython
 from machine import I2C
 from micropython import const
 
@@ -36,6 +37,17 @@ AHTX0_STATUS_BUSY: int = const(0x80)  # Status bit for busy
 AHTX0_STATUS_CALIBRATED: int = const(0x08)  # Status bit for calibrated
 
 
+@micropython.viper
+def _round_shift(n: int, shift: int) -> int:
+    """n / 2^shift rounded half to even, like round() (n >= 0)"""
+    q = n >> shift
+    r = n - (q << shift)
+    half = 1 << (shift - 1)
+    if r > half or (r == half and (q & 1) == 1):
+        q += 1
+    return q
+
+
 class AHT20:
     def __init__(self, i2c: I2C, address: int = AHTX0_I2CADDR_DEFAULT) -> None:
         sleep_ms(20)  # 20ms delay to wake up
@@ -43,15 +55,20 @@ class AHT20:
         self.address: int = address
 
         self._buf: bytearray = bytearray(6)
+        # preallocated views, so that the measurements don't allocate
+        buf = memoryview(self._buf)
+        self._buf1: memoryview = buf[0:1]
+        self._buf3: memoryview = buf[0:3]
 
-        self._temp: float = -1.0
-        self._humidity: float = -1.0
+        # raw readings of the last measurement (20 bits), -1 before the first one
+        self._raw_humidity: int = -1
+        self._raw_temp: int = -1
 
     def reset(self) -> None:
         """Perform a soft-reset of the AHT"""
         buf = memoryview(self._buf)
         buf[0] = AHTX0_CMD_SOFTRESET
-        self.i2c_device.writeto(AHTX0_I2CADDR_DEFAULT, buf[0:1])
+        self.i2c_device.writeto(self.address, buf[0:1])
         sleep_ms(20)  # 20ms delay to wake up
 
     def calibrate(self) -> bool:
@@ -60,7 +77,7 @@ class AHT20:
         buf[0] = AHTX0_CMD_CALIBRATE
         buf[1] = 0x08
         buf[2] = 0x00
-        self.i2c_device.writeto(AHTX0_I2CADDR_DEFAULT, buf[0:3])
+        self.i2c_device.writeto(self.address, buf[0:3])
         while self.status & AHTX0_STATUS_BUSY:
             sleep_ms(10)
         if not self.status & AHTX0_STATUS_CALIBRATED:
@@ -71,36 +88,74 @@ class AHT20:
     @property
     def status(self) -> int:
         """The status byte initially returned from the sensor, see datasheet for details"""
-        buf = memoryview(self._buf)
-        self.i2c_device.readfrom_into(AHTX0_I2CADDR_DEFAULT, buf[0:1])
+        self.i2c_device.readfrom_into(self.address, self._buf1)
         # print("status: "+hex(self._buf[0]))
         return self._buf[0]
 
+    @property
+    def calibrated(self) -> bool:
+        """True if the sensor is still calibrated, e.g. after a reset of the microcontroller only"""
+        return bool(self.status & AHTX0_STATUS_CALIBRATED)
+
     @property
     def relative_humidity(self) -> float:
         """The measured relative humidity in percent."""
-        return self._humidity
+        if self._raw_humidity < 0:
+            return -1.0
+        return (self._raw_humidity * 100) / 0x100000
 
     @property
     def temperature(self) -> float:
         """The measured temperature in degrees Celsius."""
-        return self._temp
+        if self._raw_temp < 0:
+            return -1.0
+        return ((self._raw_temp * 200.0) / 0x100000) - 50
+
+    def relative_humidity_scaled(self, decimals: int = 1) -> int:
+        """
+        The measured relative humidity in percent * 10^decimals (at most 2), rounded like round().
+        Integer only: the same as round(relative_humidity * 10 ** decimals), without creating floats.
+        """
+        # 100 * 10^d / 2^20 = 25 * 5^d / 2^(18 - d), so that the product fits a small int
+        return _round_shift(self._raw_humidity * 25 * 5 ** decimals, 18 - decimals)
+
+    def temperature_scaled(self, decimals: int = 1) -> int:
+        """
+        The measured temperature in degrees Celsius * 10^decimals (at most 2), rounded like round().
+        Integer only: the same as round(temperature * 10 ** decimals), without creating floats.
+        """
+        # 200 * 10^d / 2^20 = 25 * 5^d / 2^(17 - d)
+        return _round_shift(self._raw_temp * 25 * 5 ** decimals, 17 - decimals) - 50 * 10 ** decimals
 
     def read(self) -> None:
         """Internal function for triggering the AHT to read temp/humidity"""
-        buf = memoryview(self._buf)
+        buf = self._buf
         buf[0] = AHTX0_CMD_TRIGGER
         buf[1] = 0x33
         buf[2] = 0x00
-        self.i2c_device.writeto(AHTX0_I2CADDR_DEFAULT, buf[0:3])
+        self.i2c_device.writeto(self.address, self._buf3)
         while self.status & AHTX0_STATUS_BUSY:
             sleep_ms(10)
-        self.i2c_device.readfrom_into(AHTX0_I2CADDR_DEFAULT, buf[0:6])
-
-        self._humidity = (
-                (buf[1] << 12) | (buf[2] << 4) | (buf[3] >> 4)
-        )
-        self._humidity = (self._humidity * 100) / 0x100000
-        self._temp = ((buf[3] & 0xF) << 16) | (buf[4] << 8) | buf[5]
-        self._temp = ((self._temp * 200.0) / 0x100000) - 50
-
+        self.i2c_device.readfrom_into(self.address, buf)
+        self._decode()
+
+    def convert(self, step: int) -> int:
+        """Run a step of a non-blocking measurement (see I2CBus.run). Returns the ms to wait or -1 when done"""
+        buf = self._buf
+        if step == 0:
+            buf[0] = AHTX0_CMD_TRIGGER
+            buf[1] = 0x33
+            buf[2] = 0x00
+            self.i2c_device.writeto(self.address, self._buf3)
+            return 80  # measurement time from the datasheet
+
+        self.i2c_device.readfrom_into(self.address, buf)
+        if buf[0] & AHTX0_STATUS_BUSY:
+            return 10
+        self._decode()
+        return -1
+
+    def _decode(self) -> None:
+        buf = self._buf
+        self._raw_humidity = (buf[1] << 12) | (buf[2] << 4) | (buf[3] >> 4)
+        self._raw_temp = ((buf[3] & 0xF) << 16) | (buf[4] << 8) | buf[5]
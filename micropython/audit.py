@@ -0,0 +1,148 @@
+import gc
+
+from micropython import const
+from utime import ticks_us, ticks_diff
+
+__all__ = ["Audit"]
+
+_MAX_DEPTH = const(4)  # maximum nesting of audited sites
+
+# Indexes of the per-site counters
+SITE_CALLS = const(0)
+SITE_BYTES = const(1)
+SITE_GCS = const(2)
+SITE_MAX = const(3)
+SITE_MS = const(4)
+
+
+class Audit:
+    """
+    Heap allocation audit for the main loop.
+
+    Every block wrapped in ``with audit.site("name"):`` records the bytes allocated,
+    the garbage collections that ran and the time spent while it was executing. The
+    counters are kept per call site and per cycle, so the cycle can be checked against
+    a budget. The timings printed by report() are the input of ``scripts/energy_model.py``.
+
+    The heap is collected at the start of the cycle and the automatic collection is
+    disabled inside the sites, so the difference of gc.mem_alloc() is what a site
+    allocated. If a collection runs anyway (the heap is full) the sample is not valid:
+    it's counted as a GC, not as bytes, and the cycle fails the budget, since it allocated
+    at least the free heap.
+
+    When the audit is disabled every method is a no-op and nothing is allocated.
+
+    :param int budget: maximum number of bytes a cycle may allocate (0 = unlimited)
+    :param bool enabled: if False, the audit does nothing
+    """
+
+    def __init__(self, budget: int = 0, enabled: bool = True):
+        self.enabled: bool = enabled
+        self.budget: int = budget
+
+        # site name -> [calls, bytes, gcs, max bytes per call, time ms]; bytes of the calls without a GC
+        self.sites: dict[str, list[int]] = {}
+
+        self.cycle_bytes: int = 0  # -1 if a collection ran during the cycle
+        self.cycle_gcs: int = 0
+        self._cycle_start: int = 0
+        self._gc_enabled: bool = True  # state of the automatic collection outside the sites
+
+        # preallocated stack for nested sites
+        self._depth: int = 0
+        self._names: list = [None] * _MAX_DEPTH
+        self._starts: list[int] = [0] * _MAX_DEPTH
+        self._ticks: list[int] = [0] * _MAX_DEPTH
+
+    def site(self, name: str) -> "Audit":
+        """Select the call site recorded by the next ``with`` block"""
+        if self.enabled and self._depth < _MAX_DEPTH:
+            self._names[self._depth] = name
+        return self
+
+    def __enter__(self) -> "Audit":
+        if self.enabled and self._depth < _MAX_DEPTH:
+            if self._depth == 0:
+                self._gc_enabled = gc.isenabled()
+                gc.disable()
+            self._starts[self._depth] = gc.mem_alloc()
+            self._ticks[self._depth] = ticks_us()
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self._depth -= 1
+        if not self.enabled or self._depth >= _MAX_DEPTH:
+            return False
+
+        elapsed = ticks_diff(ticks_us(), self._ticks[self._depth])
+        after = gc.mem_alloc()
+        before = self._starts[self._depth]
+        name = self._names[self._depth]
+        if self._depth == 0 and self._gc_enabled:
+            gc.enable()
+
+        if after < before:
+            # the heap shrank: a collection ran inside the block (the heap was full),
+            # what the block allocated is unknown
+            allocated = 0
+            collected = 1
+        else:
+            allocated = after - before
+            collected = 0
+
+        counters = self.sites.get(name)
+        if counters is None:
+            counters = [0, 0, 0, 0, 0]
+            self.sites[name] = counters
+        counters[SITE_CALLS] += 1
+        counters[SITE_BYTES] += allocated
+        counters[SITE_GCS] += collected
+        self.cycle_gcs += collected
+        if allocated > counters[SITE_MAX]:
+            counters[SITE_MAX] = allocated
+        counters[SITE_MS] += elapsed // 1000
+
+        return False
+
+    def begin_cycle(self) -> None:
+        """Start counting the allocations of a new cycle"""
+        if not self.enabled:
+            return
+        gc.collect()
+        self.cycle_bytes = 0
+        self.cycle_gcs = 0
+        self._cycle_start = gc.mem_alloc()
+
+    def end_cycle(self) -> bool:
+        """
+        Stop counting the allocations of the cycle. Returns True if it's within the budget:
+        not if a collection ran, the cycle allocated more than the free heap
+        """
+        if not self.enabled:
+            return True
+
+        after = gc.mem_alloc()
+        if after < self._cycle_start:
+            self.cycle_gcs += 1
+        self.cycle_bytes = -1 if self.cycle_gcs else after - self._cycle_start
+
+        return not self.budget or (not self.cycle_gcs and self.cycle_bytes <= self.budget)
+
+    def report(self) -> None:
+        """Print the counters of every call site"""
+        if not self.enabled:
+            return
+
+        print("Cycle: %d bytes, %d GC (budget %d)" % (self.cycle_bytes, self.cycle_gcs, self.budget))
+        for name, counters in self.sites.items():
+            print("  %s: %d calls, %d bytes, %d GC, max %d, %d ms" % (
+                name, counters[SITE_CALLS], counters[SITE_BYTES], counters[SITE_GCS], counters[SITE_MAX],
+                counters[SITE_MS]
+            ))
+
+    def reset(self) -> None:
+        """Clear the counters of every call site"""
+        self.sites = {}
+        self.cycle_bytes = 0
+        self.cycle_gcs = 0
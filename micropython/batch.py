@@ -0,0 +1,115 @@
+import ustruct as struct
+from micropython import const
+
+__all__ = ["Batch", "BLOCK_MAGIC", "BLOCK_VERSION"]
+
+BLOCK_MAGIC = b"SB"
+BLOCK_VERSION = const(2)  # bumped when the fields change
+
+# magic, version, columns, points, sequence number, device time of the upload
+_HEADER = "<2sBBHHI"
+_HEADER_SIZE = const(12)
+_VARINT_MAX = const(5)  # bytes of the longest varint written in a column
+
+
+class Batch:
+    """
+    Readings kept in RAM as a compressed column block while the radio is off.
+
+    A block is made of a header followed by one column per field, every column
+    prefixed by its length (u16). All numbers are varints:
+
+    - column 0: the timestamp of the first point, then the delta-of-delta of the others (zigzag)
+    - column 1: the bitmask of the valid fields of every point
+    - column 2+: for every valid value, its delta from the previous valid value of the field (zigzag)
+
+    Readings are stored as integers (already scaled) so that deltas are exact.
+    The decoder is in ``scripts/decode_block.py``.
+
+    :param int fields: number of fields of every point
+    :param int capacity: maximum points in a block
+    """
+
+    def __init__(self, fields: int, capacity: int):
+        self.fields: int = fields
+        self.capacity: int = capacity
+        self.columns: int = fields + 2
+        self.count: int = 0  # points in the block
+        self.seq: int = 0  # sequence number of the block
+
+        # every column has its own region of the data buffer
+        self._region: int = capacity * _VARINT_MAX
+        self._data: bytearray = bytearray(self.columns * self._region)
+        self._pos: list[int] = [0] * self.columns
+        self._block: bytearray = bytearray(_HEADER_SIZE + self.columns * (2 + self._region))
+
+        self._last: list[int] = [0] * fields
+        self._last_ts: int = 0
+        self._last_delta: int = 0
+
+    @staticmethod
+    def _zigzag(n: int) -> int:
+        return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+    def _put(self, column: int, value: int) -> None:
+        """Append an unsigned varint to a column"""
+        data = self._data
+        start = column * self._region
+        pos = start + self._pos[column]
+        while value > 0x7F:
+            data[pos] = (value & 0x7F) | 0x80
+            value >>= 7
+            pos += 1
+        data[pos] = value
+        self._pos[column] = pos + 1 - start
+
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def append(self, ts: int, values: list[int], valid: int) -> None:
+        """Add a point. Only the values whose bit is set in valid are stored"""
+        if self.count == 0:
+            self._put(0, ts)
+            self._last_delta = 0
+        else:
+            delta = ts - self._last_ts
+            self._put(0, self._zigzag(delta - self._last_delta))
+            self._last_delta = delta
+        self._last_ts = ts
+
+        self._put(1, valid)
+
+        last = self._last
+        for i in range(self.fields):
+            if valid & (1 << i):
+                value = values[i]
+                self._put(i + 2, self._zigzag(value - last[i]))
+                last[i] = value
+
+        self.count += 1
+
+    def block(self, now: int) -> memoryview:
+        """Build the block to upload. now is the device time, used to map the timestamps to the wall clock"""
+        block = self._block
+        struct.pack_into(_HEADER, block, 0, BLOCK_MAGIC, BLOCK_VERSION, self.columns, self.count, self.seq, now)
+
+        data = memoryview(self._data)
+        pos = _HEADER_SIZE
+        for column in range(self.columns):
+            size = self._pos[column]
+            start = column * self._region
+            struct.pack_into("<H", block, pos, size)
+            pos += 2
+            block[pos:pos + size] = data[start:start + size]
+            pos += size
+
+        return memoryview(block)[:pos]
+
+    def clear(self) -> None:
+        """Empty the block after it has been uploaded"""
+        for column in range(self.columns):
+            self._pos[column] = 0
+        for i in range(self.fields):
+            self._last[i] = 0
+        self.count = 0
+        self.seq = (self.seq + 1) & 0xFFFF
@@ -71,6 +71,16 @@ class BMP180:
         # settings to be adjusted by user
         self.oversample_setting = 3
 
+        # preallocated buffers for the measurements
+        self._cmd = bytearray(1)
+        self._raw = bytearray(3)
+        self._raw2 = memoryview(self._raw)[0:2]
+
+        # results of the last convert() measurement
+        self._UT: int = 0
+        self.last_temperature_x10: int = 0  # 0.1 degree Celsius
+        self.last_pressure: int = 0
+
     def initialize(self) -> None:
         # check chip id
         self.chip_id = self.i2c.readfrom_mem(BMP180_ADDR, 0xD0, 2)
@@ -93,6 +103,30 @@ class BMP180:
         self._MC = unpack('>h', self.i2c.readfrom_mem(BMP180_ADDR, BMP180__MC, 2))[0]
         self._MD = unpack('>h', self.i2c.readfrom_mem(BMP180_ADDR, BMP180__MD, 2))[0]
 
+    @property
+    def calibration(self) -> tuple[int, ...]:
+        """The calibration coefficients (AC1-AC6, B1, B2, MB, MC, MD), to skip initialize() after a reset"""
+        return (
+            self._AC1, self._AC2, self._AC3, self._AC4, self._AC5, self._AC6,
+            self._B1, self._B2, self._MB, self._MC, self._MD
+        )
+
+    @calibration.setter
+    def calibration(self, value: tuple[int, ...]) -> None:
+        (
+            self._AC1, self._AC2, self._AC3, self._AC4, self._AC5, self._AC6,
+            self._B1, self._B2, self._MB, self._MC, self._MD
+        ) = value
+
+    @property
+    def mode(self) -> int:
+        return self._mode
+
+    @mode.setter
+    def mode(self, value: int) -> None:
+        if value in range(4):
+            self._mode = value
+
     @property
     def oversample_sett(self):
         return self.oversample_setting
@@ -105,61 +139,79 @@ class BMP180:
             self.oversample_setting = 3
 
     @micropython.native
-    def _read_raw_temp(self) -> int:
-        """Reads the raw (uncompensated) temperature from the sensor."""
-        self.i2c.writeto_mem(BMP180_ADDR, BMP180_CONTROL, bytearray([BMP180_READTEMPCMD]))
-        sleep_ms(5)
-        UT = unpack('>H', self.i2c.readfrom_mem(BMP180_ADDR, BMP180_TEMPDATA, 2))[0]
+    def _start_temp(self) -> None:
+        self._cmd[0] = BMP180_READTEMPCMD
+        self.i2c.writeto_mem(BMP180_ADDR, BMP180_CONTROL, self._cmd)
 
-        return UT
+    @micropython.native
+    def _collect_temp(self) -> int:
+        raw = self._raw
+        self.i2c.readfrom_mem_into(BMP180_ADDR, BMP180_TEMPDATA, self._raw2)
+        return (raw[0] << 8) | raw[1]
 
     @micropython.native
-    def _read_raw_pressure(self) -> int:
-        """Reads the raw (uncompensated) pressure level from the sensor."""
-        i2c = self.i2c  # cache object to speedup things
+    def _start_pressure(self) -> int:
+        """Start a pressure conversion. Returns the conversion time in ms"""
         mode = self._mode
-        i2c.writeto_mem(BMP180_ADDR, BMP180_CONTROL, bytearray([BMP180_READPRESSURECMD + (mode << 6)]))
+        self._cmd[0] = BMP180_READPRESSURECMD + (mode << 6)
+        self.i2c.writeto_mem(BMP180_ADDR, BMP180_CONTROL, self._cmd)
 
         if mode == BMP180_ULTRALOWPOWER:
-            sleep_ms(5)
+            return 5
         elif mode == BMP180_HIGHRES:
-            sleep_ms(14)
+            return 14
         elif mode == BMP180_ULTRAHIGHRES:
-            sleep_ms(26)
+            return 26
         else:
-            sleep_ms(8)
+            return 8
 
-        MSB = unpack('>B', i2c.readfrom_mem(BMP180_ADDR, BMP180_PRESSUREDATA, 1))[0]
-        LSB = unpack('>B', i2c.readfrom_mem(BMP180_ADDR, BMP180_PRESSUREDATA + 1, 1))[0]
-        XLSB = unpack('>B', i2c.readfrom_mem(BMP180_ADDR, BMP180_PRESSUREDATA + 2, 1))[0]
-        UP = ((MSB << 16) + (LSB << 8) + XLSB) >> (8 - mode)
+    @micropython.native
+    def _collect_pressure(self) -> int:
+        # MSB, LSB and XLSB are read in a single burst
+        raw = self._raw
+        self.i2c.readfrom_mem_into(BMP180_ADDR, BMP180_PRESSUREDATA, raw)
+        return ((raw[0] << 16) + (raw[1] << 8) + raw[2]) >> (8 - self._mode)
 
-        return UP
+    def _read_raw_temp(self) -> int:
+        """Reads the raw (uncompensated) temperature from the sensor."""
+        self._start_temp()
+        sleep_ms(5)
+        return self._collect_temp()
 
-    @property
-    @micropython.viper
-    def temperature(self) -> float:
-        """Temperature in degree Celsius"""
-        UT = self._read_raw_temp()
+    def _read_raw_pressure(self) -> int:
+        """Reads the raw (uncompensated) pressure level from the sensor."""
+        sleep_ms(self._start_pressure())
+        return self._collect_pressure()
 
-        # Calculate temperature
-        X1 = ((UT - self._AC6) * self._AC5) >> 15
-        X2 = (self._MC << 11) // (X1 + self._MD)
-        B5 = X1 + X2
-        temp = ((B5 + 8) >> 4) / 10.0
+    def convert(self, step: int) -> int:
+        """Run a step of a non-blocking measurement (see I2CBus.run). Returns the ms to wait or -1 when done"""
+        if step == 0:
+            self._start_temp()
+            return 5
 
-        return temp
+        if step == 1:
+            self._UT = self._collect_temp()
+            return self._start_pressure()
 
-    @property
-    @micropython.viper
-    def pressure(self) -> float:
-        """Pressure in mbar"""
-        UT = self._read_raw_temp()
-        UP = self._read_raw_pressure()
+        UP = self._collect_pressure()
+        self.last_temperature_x10 = self._calc_temperature_x10(self._UT)
+        self.last_pressure = self._calc_pressure(self._UT, UP)
+        return -1
 
+    @micropython.native
+    def _calc_b5(self, UT) -> int:
         X1 = ((UT - self._AC6) * self._AC5) >> 15
         X2 = (self._MC << 11) // (X1 + self._MD)
-        B5 = X1 + X2
+        return X1 + X2
+
+    @micropython.native
+    def _calc_temperature_x10(self, UT) -> int:
+        B5 = self._calc_b5(UT)
+        return (B5 + 8) >> 4
+
+    @micropython.native
+    def _calc_pressure(self, UT, UP) -> int:
+        B5 = self._calc_b5(UT)
 
         # Pressure Calculations
         B6 = B5 - 4000
@@ -182,3 +234,25 @@ class BMP180:
         p = p + ((X1 + X2 + 3791) >> 4)
 
         return p
+
+    @property
+    def last_temperature(self) -> float:
+        """Temperature of the last convert() measurement in degree Celsius"""
+        return self.last_temperature_x10 / 10.0
+
+    @property
+    def temperature(self) -> float:
+        """Temperature in degree Celsius"""
+        return self.temperature_x10 / 10.0
+
+    @property
+    def temperature_x10(self) -> int:
+        """Temperature in 0.1 degree Celsius, without floats"""
+        return self._calc_temperature_x10(self._read_raw_temp())
+
+    @property
+    def pressure(self) -> int:
+        """Pressure in Pa"""
+        UT = self._read_raw_temp()
+        UP = self._read_raw_pressure()
+        return self._calc_pressure(UT, UP)
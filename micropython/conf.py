@@ -1,4 +1,12 @@
-__all__ = ["WIFI_COUNTRY", "WIFI_SSID", "WIFI_BSID", "WIFI_PASS", "MQTT_NAME", "MQTT_HOST", "MQTT_PORT"]
+__all__ = [
+    "WIFI_COUNTRY", "WIFI_SSID", "WIFI_BSID", "WIFI_PASS", "MQTT_NAME", "MQTT_HOST", "MQTT_PORT",
+    "MQTT_DEADLINE", "MQTT_VERSION", "MQTT_EXPIRY", "MQTT_TLS", "MQTT_CA", "MQTT_CERT", "MQTT_KEY",
+    "SENSORS", "BREAKER_BACKOFF", "WDT_TIMEOUT", "AUDIT_ALLOC", "AUDIT_BUDGET", "DEBUG_REPORT",
+    "PMS_SECOND_CORE", "PMS_IRQ",
+    "BATCH_CYCLES", "BATCH_ALARM_PM25", "BATCH_ALARM_TVOC",
+    "ENERGY_ADAPTIVE", "ENERGY_LEVELS", "ENERGY_PM25_DELTA", "ENERGY_TVOC_DELTA",
+    "TRACE", "TRACE_FILE", "TRACE_LIMIT",
+]
 
 # If you don't want to use the BSSID, just comment set it to None
 
@@ -9,3 +17,49 @@ WIFI_PASS = ""  # Wi-Fi password
 MQTT_NAME = "box01"  # MQTT client name
 MQTT_HOST = ""  # MQTT server address
 MQTT_PORT = 1883  # MQTT server port
+MQTT_DEADLINE = 5_000  # ms the broker has to answer, per stage of the cycle (connect, publish)
+MQTT_VERSION = 4  # protocol: 4 = MQTT 3.1.1, 5 = MQTT 5.0 (more bytes with a connection per cycle, see README)
+MQTT_EXPIRY = 0  # s the broker keeps the readings for an offline subscriber, 0 = forever (MQTT 5.0 only)
+
+# MQTT over TLS (usually on port 8883)
+MQTT_TLS = False  # connect to the broker with TLS
+MQTT_CA = None  # CA certificate of the broker (DER file), None to skip the verification
+MQTT_CERT = None  # client certificate (DER file), if the broker requires it
+MQTT_KEY = None  # key of the client certificate (DER file)
+
+# Sensors of the box, by name in the registry of sensors.py. Absent ones are skipped at boot
+SENSORS = ("aht20", "bmp180", "sgp30", "pms7003")
+BREAKER_BACKOFF = 8  # maximum cycles a failing sensor is skipped before it's tried again
+WDT_TIMEOUT = 8_000  # ms without feeding the watchdog before a reset (at most 8388, 0 = disabled)
+
+# Allocation audit (debug only)
+AUDIT_ALLOC = False  # record the heap allocations of every stage of the cycle
+AUDIT_BUDGET = 0  # maximum bytes allocated per cycle (0 = unlimited)
+DEBUG_REPORT = False  # print the I2C, sensor, MQTT and TLS counters every cycle (formatting them allocates)
+
+# PMS7003
+PMS_SECOND_CORE = False  # run the PMS acquisition on the second core
+PMS_IRQ = True  # receive the frames with the UART interrupt instead of polling
+
+# Radio-off mode
+BATCH_CYCLES = 0  # cycles kept in a compressed block before powering the radio (0 = publish every cycle)
+BATCH_ALARM_PM25 = 50  # upload the block right away if PM2.5 reaches this value (ug/m3)
+BATCH_ALARM_TVOC = 1000  # upload the block right away if TVOC reaches this value (ppb)
+
+# Energy-aware scheduling
+ENERGY_ADAPTIVE = False  # adapt the cycle to the battery voltage (the interval grows up to 6 times)
+# For every level, from the highest voltage:
+# minimum VSYS (mV), interval multiplier, PMS every N cycles, upload every N cycles (radio-off mode only)
+ENERGY_LEVELS = (
+    (3900, 1, 1, 1),
+    (3700, 2, 1, 3),
+    (3500, 3, 2, 6),
+    (0, 6, 4, 12),
+)
+ENERGY_PM25_DELTA = 10  # PM2.5 change (ug/m3) between two cycles that speeds up the sampling
+ENERGY_TVOC_DELTA = 100  # TVOC change (ppb) between two cycles that speeds up the sampling
+
+# Sensor trace (debug only), replayed on the host by scripts/trace_replay.py
+TRACE = False  # record the raw I2C and UART traffic of the sensors
+TRACE_FILE = "trace.bin"  # trace file in flash
+TRACE_LIMIT = 600_000  # maximum size of the trace file (bytes), about 10 days at the default interval
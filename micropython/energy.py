@@ -0,0 +1,125 @@
+from machine import ADC, Pin
+from micropython import const
+from utime import time
+
+__all__ = ["EnergyScheduler", "read_vsys"]
+
+_VSYS_SAMPLES = const(8)
+_CUTOFF_MV = const(3300)  # below this the regulator can't supply the sensors
+
+# Indexes of an energy level
+LEVEL_MV = const(0)
+LEVEL_INTERVAL = const(1)
+LEVEL_PMS_EVERY = const(2)
+LEVEL_UPLOAD_EVERY = const(3)
+
+
+def read_vsys() -> int:
+    """
+    Read VSYS (the battery voltage after the charger) in mV.
+    On the Pico W, GPIO29 is shared with the clock of the radio, so this must not
+    be called while a WiFi transfer is in progress.
+    """
+    wl_cs = Pin(25, Pin.OUT, value=1)  # deselect the radio while GPIO29 is used by the ADC
+    Pin(29, Pin.IN)
+    adc = ADC(29)
+
+    total = 0
+    for _ in range(_VSYS_SAMPLES):
+        total += adc.read_u16()
+
+    # give GPIO29 back to the radio
+    Pin(29, Pin.ALT, pull=Pin.PULL_DOWN, alt=7)
+    wl_cs.value(0)
+
+    # VSYS is divided by 3 before the ADC, whose reference is 3.3 V
+    return total * 3 * 3300 // (_VSYS_SAMPLES * 65535)
+
+
+class EnergyScheduler:
+    """
+    Choose the cycle interval, the PMS duty cycle and the upload batching from the battery voltage.
+
+    Every level is ``(min mV, interval multiplier, PMS every N cycles, upload every N cycles)``,
+    ordered from the highest voltage. When PM2.5 or TVOC change faster than the given
+    deltas, the next cycle runs at half the base interval with the PMS on.
+
+    :param tuple levels: the energy levels
+    :param int pm25_delta: PM2.5 change (ug/m3) that speeds up the sampling
+    :param int tvoc_delta: TVOC change (ppb) that speeds up the sampling
+    """
+
+    def __init__(self, levels: tuple, pm25_delta: int, tvoc_delta: int):
+        self.levels: tuple = levels
+        self.pm25_delta: int = pm25_delta
+        self.tvoc_delta: int = tvoc_delta
+
+        self.vsys: int = 0  # last battery voltage (mV)
+        self.level: int = 0  # index of the current level
+        self.fast: bool = False  # the readings are changing fast
+        self.cycle: int = 0
+
+        self._last_pm25: int = -1
+        self._last_tvoc: int = -1
+
+        # battery trend, used to project the autonomy
+        self._trend_time: int = 0
+        self._trend_mv: int = 0
+        self.slope: int = 0  # mV per day, smoothed
+
+    def sample(self) -> None:
+        """Read the battery and choose the level of the cycle"""
+        self.vsys = read_vsys()
+        self.cycle += 1
+
+        for i in range(len(self.levels)):
+            if self.vsys >= self.levels[i][LEVEL_MV]:
+                self.level = i
+                break
+        else:
+            self.level = len(self.levels) - 1
+
+        now = time()
+        if not self._trend_time:
+            self._trend_time = now
+            self._trend_mv = self.vsys
+        elif now - self._trend_time >= 3600:
+            slope = (self.vsys - self._trend_mv) * 86400 // (now - self._trend_time)
+            self.slope = (3 * self.slope + slope) // 4
+            self._trend_time = now
+            self._trend_mv = self.vsys
+
+    def observe(self, pm25: int, tvoc: int) -> None:
+        """Update the rate of change of the readings, pass -1 for a missing value"""
+        fast = False
+        if pm25 >= 0 and self._last_pm25 >= 0 and abs(pm25 - self._last_pm25) >= self.pm25_delta:
+            fast = True
+        if tvoc >= 0 and self._last_tvoc >= 0 and abs(tvoc - self._last_tvoc) >= self.tvoc_delta:
+            fast = True
+        self.fast = fast
+
+        if pm25 >= 0:
+            self._last_pm25 = pm25
+        if tvoc >= 0:
+            self._last_tvoc = tvoc
+
+    def interval(self, base: int) -> int:
+        """Seconds to sleep before the next cycle"""
+        if self.fast:
+            # half the interval, at least 60 s, but never longer than the normal one
+            return min(base, max(60, base // 2))
+        return base * self.levels[self.level][LEVEL_INTERVAL]
+
+    def pms_due(self) -> bool:
+        """Check if the PMS has to run in this cycle"""
+        return self.fast or self.cycle % self.levels[self.level][LEVEL_PMS_EVERY] == 0
+
+    def upload_every(self) -> int:
+        """Cycles to keep in a block before uploading it"""
+        return 1 if self.fast else self.levels[self.level][LEVEL_UPLOAD_EVERY]
+
+    def autonomy(self) -> int:
+        """Projected hours before the battery reaches the cutoff, -1 if it isn't discharging"""
+        if self.slope >= 0:
+            return -1
+        return max(0, (self.vsys - _CUTOFF_MV) * 24 // -self.slope)
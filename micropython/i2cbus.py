@@ -0,0 +1,200 @@
+from machine import I2C
+from micropython import const
+from utime import sleep_ms, ticks_ms, ticks_us, ticks_add, ticks_diff
+
+__all__ = ["I2CBus"]
+
+_MAX_DEVICES = const(8)  # maximum devices measured by a single run()
+_MAX_STEPS = const(32)  # a device still converting after this many steps is failed
+
+# Indexes of the per-device counters
+DEV_TRANSACTIONS = const(0)
+DEV_ERRORS = const(1)
+DEV_RETRIES = const(2)
+DEV_TIME_US = const(3)
+DEV_MAX_US = const(4)
+
+
+class I2CBus:
+    """
+    Transaction manager for an I2C bus shared by several drivers.
+
+    It exposes the subset of the `I2C` interface used by the drivers, so it can be
+    passed to them in place of the bus. Every transaction that fails with an
+    `OSError` (e.g. a NACK) is retried with an exponential backoff, and counters
+    of transactions, errors and latency are kept for every address.
+
+    run() measures several devices at once: the conversions are started one after
+    the other and every device is read as soon as its conversion is complete.
+
+    :param I2C i2c: the bus
+    :param int retries: how many times a failed transaction is retried
+    :param int backoff: milliseconds to wait before the first retry, doubled every retry
+    """
+
+    def __init__(self, i2c: I2C, retries: int = 2, backoff: int = 2):
+        self.i2c: I2C = i2c
+        self.retries: int = retries
+        self.backoff: int = backoff
+
+        # address -> [transactions, errors, retries, total time us, max time us]
+        self.stats: dict[int, list[int]] = {}
+
+        # preallocated scheduling state of run()
+        self._ready: list[int] = [0] * _MAX_DEVICES
+        self._steps: list[int] = [0] * _MAX_DEVICES
+
+    def _counters(self, addr: int) -> list[int]:
+        counters = self.stats.get(addr)
+        if counters is None:
+            counters = [0, 0, 0, 0, 0]
+            self.stats[addr] = counters
+        return counters
+
+    def _done(self, addr: int, start: int) -> None:
+        elapsed = ticks_diff(ticks_us(), start)
+        counters = self._counters(addr)
+        counters[DEV_TRANSACTIONS] += 1
+        counters[DEV_TIME_US] += elapsed
+        if elapsed > counters[DEV_MAX_US]:
+            counters[DEV_MAX_US] = elapsed
+
+    def _failed(self, addr: int, attempt: int, error: OSError) -> int:
+        """Record a failed transaction. Returns the next attempt, or raises if there are no retries left"""
+        counters = self._counters(addr)
+        counters[DEV_ERRORS] += 1
+        if attempt >= self.retries:
+            raise error
+
+        counters[DEV_RETRIES] += 1
+        sleep_ms(self.backoff << attempt)
+        return attempt + 1
+
+    def scan(self) -> list[int]:
+        return self.i2c.scan()
+
+    def writeto(self, addr: int, buf) -> None:
+        attempt = 0
+        while True:
+            start = ticks_us()
+            try:
+                self.i2c.writeto(addr, buf)
+            except OSError as e:
+                attempt = self._failed(addr, attempt, e)
+                continue
+            self._done(addr, start)
+            return
+
+    def readfrom_into(self, addr: int, buf) -> None:
+        attempt = 0
+        while True:
+            start = ticks_us()
+            try:
+                self.i2c.readfrom_into(addr, buf)
+            except OSError as e:
+                attempt = self._failed(addr, attempt, e)
+                continue
+            self._done(addr, start)
+            return
+
+    def readfrom_mem(self, addr: int, memaddr: int, nbytes: int) -> bytes:
+        attempt = 0
+        while True:
+            start = ticks_us()
+            try:
+                data = self.i2c.readfrom_mem(addr, memaddr, nbytes)
+            except OSError as e:
+                attempt = self._failed(addr, attempt, e)
+                continue
+            self._done(addr, start)
+            return data
+
+    def readfrom_mem_into(self, addr: int, memaddr: int, buf) -> None:
+        attempt = 0
+        while True:
+            start = ticks_us()
+            try:
+                self.i2c.readfrom_mem_into(addr, memaddr, buf)
+            except OSError as e:
+                attempt = self._failed(addr, attempt, e)
+                continue
+            self._done(addr, start)
+            return
+
+    def writeto_mem(self, addr: int, memaddr: int, buf) -> None:
+        attempt = 0
+        while True:
+            start = ticks_us()
+            try:
+                self.i2c.writeto_mem(addr, memaddr, buf)
+            except OSError as e:
+                attempt = self._failed(addr, attempt, e)
+                continue
+            self._done(addr, start)
+            return
+
+    def run(self, devices: tuple, skip: int = 0) -> int:
+        """
+        Measure every device, filling the conversion time of one with the transactions of the others.
+
+        Every device must implement ``convert(step) -> int``: it runs the given step of
+        the measurement and returns the milliseconds to wait before the next step,
+        or -1 when the measurement is complete.
+
+        The devices in the skip bitmask (by index) are not measured.
+        Returns a bitmask of the devices (by index) whose measurement failed.
+        """
+        ready = self._ready
+        steps = self._steps
+        n = len(devices)
+        now = ticks_ms()
+        pending = 0
+        for i in range(n):
+            ready[i] = now
+            if skip & (1 << i):
+                steps[i] = -1
+            else:
+                steps[i] = 0
+                pending += 1
+
+        failed = 0
+        while pending:
+            # pick the device that is ready first
+            best = -1
+            for i in range(n):
+                if steps[i] >= 0 and (best < 0 or ticks_diff(ready[i], ready[best]) < 0):
+                    best = i
+
+            wait = ticks_diff(ready[best], ticks_ms())
+            if wait > 0:
+                sleep_ms(wait)
+
+            try:
+                delay = devices[best].convert(steps[best])
+            except (OSError, RuntimeError) as e:
+                print(str(e))
+                failed |= 1 << best
+                delay = -1
+            else:
+                if delay >= 0 and steps[best] >= _MAX_STEPS:
+                    print("I2C conversion timeout")
+                    failed |= 1 << best
+                    delay = -1
+
+            if delay < 0:
+                steps[best] = -1
+                pending -= 1
+            else:
+                steps[best] += 1
+                ready[best] = ticks_add(ticks_ms(), delay)
+
+        return failed
+
+    def report(self) -> None:
+        """Print the counters of every device"""
+        for addr, counters in self.stats.items():
+            transactions = counters[DEV_TRANSACTIONS]
+            print("  I2C 0x%02x: %d transactions, %d errors, %d retries, avg %d us, max %d us" % (
+                addr, transactions, counters[DEV_ERRORS], counters[DEV_RETRIES],
+                counters[DEV_TIME_US] // transactions if transactions else 0, counters[DEV_MAX_US]
+            ))
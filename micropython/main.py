@@ -1,55 +1,117 @@
 import gc
 
 import machine
-import micropython
 import network
 import rp2
 from machine import Pin, I2C, UART
-from utime import time, sleep_ms, sleep
-
-from aht20 import AHT20
-from bmp180 import BMP180, BMP180_ULTRALOWPOWER
-from caqi import CAQI
-from conf import WIFI_COUNTRY, WIFI_SSID, WIFI_BSID, WIFI_PASS, MQTT_NAME, MQTT_HOST, MQTT_PORT
-from mqtt import MQTTClient
-from pms import PMS
-from sgp30 import SGP30
+from micropython import const
+from utime import time, sleep_ms
+
+from audit import Audit
+from conf import WIFI_COUNTRY, WIFI_SSID, WIFI_BSID, WIFI_PASS, MQTT_NAME, MQTT_HOST, MQTT_PORT, MQTT_DEADLINE
+from conf import MQTT_VERSION, MQTT_EXPIRY, MQTT_TLS, MQTT_CA, MQTT_CERT, MQTT_KEY
+from conf import SENSORS, BREAKER_BACKOFF, WDT_TIMEOUT, AUDIT_ALLOC, AUDIT_BUDGET, DEBUG_REPORT
+from conf import BATCH_CYCLES, BATCH_ALARM_PM25, BATCH_ALARM_TVOC
+from conf import ENERGY_ADAPTIVE, ENERGY_LEVELS, ENERGY_PM25_DELTA, ENERGY_TVOC_DELTA
+from conf import TRACE, TRACE_FILE, TRACE_LIMIT
+from batch import Batch
+from energy import EnergyScheduler
+from i2cbus import I2CBus
+from mqtt import MQTTClient, tls_context
+from sensors import Pipeline, lightsleep, watchdog, feed
+from settings import Settings
+from snapshot import Snapshot
+
+if TRACE:
+    from trace import TraceWriter, TraceI2C, TraceUART
 
 # WiFI settings
 rp2.country(WIFI_COUNTRY)
 
+# Runtime settings, cached in flash and updated from a retained MQTT message
+settings = Settings()
+if settings.load():
+    print("Settings loaded")
+SETTINGS_TOPIC = MQTT_NAME + "/config"
+
+# State saved before a reset and restored on a warm boot, to skip the slow initialisation of the sensors
+RESET_SLEEP_MS = const(60_000)
+snapshot = Snapshot()
+warm_boot: bool = snapshot.load() and machine.reset_cause() != machine.PWRON_RESET
+ready: bool = False  # setup completed, the state is worth a snapshot
+
 # Global variables
-client = MQTTClient(MQTT_NAME, MQTT_HOST, keepalive=60, port=MQTT_PORT)
+client = MQTTClient(
+    MQTT_NAME, MQTT_HOST, keepalive=60, port=MQTT_PORT,
+    ssl_context=tls_context(MQTT_CA, MQTT_CERT, MQTT_KEY) if MQTT_TLS else None,
+    version=MQTT_VERSION, message_expiry=MQTT_EXPIRY
+)
+client.set_callback(settings.on_message)
 wlan: network.WLAN = None
 wlan_pw = machine.Pin(23, Pin.OUT)
-
-# I2C bus
-i2c1 = I2C(1, scl=Pin(15), sda=Pin(14))
-
-# Temperature and humidity sensor
-aht20: AHT20 = AHT20(i2c1)
-
-# Pressure sensor
-bmp180: BMP180 = BMP180(i2c1, mode=BMP180_ULTRALOWPOWER)
-
-# Air quality sensor
-sgp30: SGP30 = SGP30(i2c1)
-baseline_time: int = 0
-
-# Particle sensor
-uart = UART(0)
-pms: PMS = PMS(uart)
-pm25_sum: int = 0
-pm100_sum: int = 0
-pm_values: int = 0
-caqi_time: int = time()
-
-
-# noinspection PyBroadException
-@micropython.native
-def lightsleep(seconds: int):
-    for _ in range(seconds * 1_000):
-        machine.lightsleep(1)
+audit = Audit(AUDIT_BUDGET, enabled=AUDIT_ALLOC)
+
+# Sensor trace: the drivers talk to the bus and the UART through the recorders
+trace: TraceWriter = TraceWriter(TRACE_FILE, limit=TRACE_LIMIT, warm_boot=warm_boot) if TRACE else None
+
+# I2C bus, shared by the sensors
+i2c1 = I2CBus(I2C(1, scl=Pin(15), sda=Pin(14)))
+sensor_i2c = TraceI2C(i2c1, trace) if TRACE else i2c1
+cycle_seq: int = 0
+
+# Readings of a cycle: name and decimals of every field, values are scaled integers.
+# The order is the one of the blocks of the radio-off mode (scripts/decode_block.py).
+FIELDS: tuple = (
+    ("temperature", 1),
+    ("humidity", 1),
+    ("pressure", 0),
+    ("eco2", 0),
+    ("tvoc", 0),
+    ("caqi", 0),
+    ("pm01", 0),
+    ("pm25", 0),
+    ("pm100", 0),
+    ("vsys", 0),
+    ("interval", 0),
+    ("autonomy", 0),
+)
+TOPICS: tuple = tuple(MQTT_NAME + "/" + name for name, _ in FIELDS)
+F_TEMPERATURE = const(0)
+F_HUMIDITY = const(1)
+F_PRESSURE = const(2)
+F_ECO2 = const(3)
+F_TVOC = const(4)
+F_CAQI = const(5)
+F_PM01 = const(6)
+F_PM25 = const(7)
+F_PM100 = const(8)
+F_VSYS = const(9)
+F_INTERVAL = const(10)
+F_AUTONOMY = const(11)
+readings: list[int] = [0] * len(FIELDS)
+
+
+def pms_uart():
+    uart = UART(0)
+    return TraceUART(uart, trace) if TRACE else uart
+
+
+# Sensors of conf.SENSORS that answer: the drivers are imported and built only for them
+pipeline: Pipeline = Pipeline(
+    SENSORS, tuple(name for name, _ in FIELDS), i2c1, sensor_i2c, pms_uart, settings, warm_boot, audit,
+    max_backoff=BREAKER_BACKOFF
+)
+
+# Radio-off mode: readings are kept in a compressed block and uploaded every BATCH_CYCLES cycles
+batch: Batch = Batch(len(FIELDS), BATCH_CYCLES) if BATCH_CYCLES else None
+BLOCK_TOPIC = MQTT_NAME + "/block"
+SEQ_TOPIC = MQTT_NAME + "/seq"  # sequence number of the cycle, to detect lost messages
+
+# Energy-aware scheduling: interval, PMS duty cycle and upload batching follow the battery voltage
+scheduler: EnergyScheduler = EnergyScheduler(
+    ENERGY_LEVELS, ENERGY_PM25_DELTA, ENERGY_TVOC_DELTA
+) if ENERGY_ADAPTIVE else None
+interval: int = settings.interval
 
 
 def wifi_connect() -> bool:
@@ -70,6 +132,7 @@ def wifi_connect() -> bool:
         # timeout for connection
         timeout = time() + 30
         while not wlan.isconnected():
+            feed()
             sleep_ms(50)
             if time() > timeout:
                 print("WiFi timeout connection")
@@ -81,147 +144,219 @@ def wifi_connect() -> bool:
     return True
 
 
-def setup():
-    global baseline_time
+def wifi_off():
+    global wlan
 
-    # Reduce clock
-    machine.freq(64_000_000)
+    if wlan is not None:
+        wlan.disconnect()
+        wlan.active(False)
+        wlan = None
+    wlan_pw.low()
 
-    # Enable garbage collection
-    gc.enable()
 
-    # AHT20
-    aht20.reset()
-    if not aht20.calibrate():
-        print("Could not calibrate AHT20")
-        machine.deepsleep(60_000)
+def mqtt_connect():
+    # the broker gets MQTT_DEADLINE ms to accept the connection and the subscription
+    feed()
+    client.set_deadline(MQTT_DEADLINE)
+    client.connect()
+    # the retained settings are read before disconnecting, no need to wait for them
+    client.subscribe(SETTINGS_TOPIC)
 
-    # BMP180
-    bmp180.initialize()
 
-    # SGP30
-    sgp30.iaq_init()
-    try:
-        f_co2 = open("co2eq_baseline.txt", 'r')
-        f_tvoc = open("tvoc_baseline.txt", 'r')
+def mqtt_disconnect():
+    while client.check_msg() is not None:
+        pass
+    client.disconnect()
 
-        co2_baseline = int(f_co2.read())
-        tvoc_baseline = int(f_tvoc.read())
-    except (ValueError, OSError):
-        print("Impossible to read SGP30 baselines!")
-    else:
-        print("Baselines loaded")
-        sgp30.set_iaq_baseline(co2_baseline, tvoc_baseline)
-        f_co2.close()
-        f_tvoc.close()
-    finally:
-        baseline_time = time()
 
-    # PMS7003
-    pms.pas_mode()
+def setup():
+    # Reduce clock
+    machine.freq(settings.cpu_freq)
+
+    # Enable garbage collection
+    gc.enable()
+
+    # the sensors that fail are left out of the cycle
+    if warm_boot:
+        # the sensors kept running during the reset
+        print("Warm boot")
+    pipeline.setup(warm_boot)
+    if warm_boot:
+        restore_snapshot()
+    print("Sensors:")
+    pipeline.report()
 
     # Setup MQTT
+    client.set_deadline(MQTT_DEADLINE)
     client.connect(clean_session=True)
 
 
-def run():
-    global baseline_time
-    global pm25_sum, pm100_sum, caqi_time, pm_values
+def save_snapshot():
+    pipeline.save(snapshot)
+    snapshot.cycle_seq = cycle_seq
+    snapshot.block_seq = batch.seq if batch is not None else 0
+    snapshot.mqtt_pid = client.pid
+    snapshot.save()
 
-    # measure aht20 (temperature and humidity)
-    aht20.read()
-    temp = aht20.temperature
-    hum = aht20.relative_humidity
-    client.publish("box01/temperature", str(round(temp, 1)))
-    client.publish("box01/humidity", str(round(hum, 0)))
 
-    # measure bmp280 (pressure)
-    pres = bmp180.pressure
-    pres = int(round(pres / 10) * 10)
-    client.publish("box01/pressure", str(pres))
+def restore_snapshot():
+    global cycle_seq
 
-    # measure sgp30 (co2 and tvoc)
-    co2_eq, tvoc = sgp30.iaq_measure()
-    client.publish("box01/eco2", str(co2_eq))
-    client.publish("box01/tvoc", str(tvoc))
+    # the times are shifted by the sleep before the reset
+    pipeline.restore(snapshot, time() - RESET_SLEEP_MS // 1000)
+    cycle_seq = snapshot.cycle_seq
+    if batch is not None:
+        batch.seq = snapshot.block_seq
+    client.pid = snapshot.mqtt_pid
 
-    if time() - baseline_time >= 3600:
+
+def reset():
+    """Save the state and reset the device after an error"""
+    if ready:
         try:
-            f_co2 = open("co2eq_baseline.txt", 'w')
-            f_tvoc = open("tvoc_baseline.txt", 'w')
-
-            bl_co2, bl_tvoc = sgp30.get_iaq_baseline()
-            f_co2.write(str(bl_co2))
-            f_tvoc.write(str(bl_tvoc))
-
-            sgp30.set_iaq_rel_humidity(temp=temp, rh=hum)
-
-            f_co2.close()
-            f_tvoc.close()
-        except OSError:
-            print("Impossible to save SGP30 baselines!")
-        finally:
-            print("Baselines saved")
-            baseline_time = time()
-
-    # measure pms7003 (pm10, pm25, pm100)
-    pms.wake_up()
-    lightsleep(30)
-    pms.prepare_read()
-    pms_data = pms.read()
-    pms.sleep()
-
-    pm10 = pms_data[4]
-    pm25 = pms_data[5]
-    pm100 = pms_data[6]
-    pm25_sum += pm25
-    pm100_sum += pm100
-    pm_values += 1
-
-    if time() - caqi_time >= 3600:
-        pm100_avg = pm100_sum // pm_values
-        pm25_avg = pm25_sum // pm_values
-        caqi = CAQI.caqi(pm25_avg, pm100_avg)
-        client.publish("box01/caqi", str(caqi))
-        pm25_sum = 0
-        pm100_sum = 0
-        pm_values = 0
-        caqi_time = time()
-
-    client.publish("box01/pm01", str(pm10))
-    client.publish("box01/pm25", str(pm25))
-    client.publish("box01/pm100", str(pm100))
+            save_snapshot()
+        except Exception as e:
+            print(str(e))
+    sleep_ms(50)
+    machine.deepsleep(RESET_SLEEP_MS)
+
+
+def apply_settings():
+    machine.freq(settings.cpu_freq)
+    pipeline.apply(settings)
+
+
+def publish_readings(valid: int):
+    # the connection waited for the PMS: a new deadline for publishing and disconnecting
+    feed()
+    client.set_deadline(MQTT_DEADLINE)
+    client.publish_num(SEQ_TOPIC, cycle_seq)
+    for i in range(len(FIELDS)):
+        if valid & (1 << i):
+            client.publish_num(TOPICS[i], readings[i], FIELDS[i][1])
+
+
+def alarm(valid: int) -> bool:
+    """Check if the readings are worth uploading the block before it's full"""
+    if valid & (1 << F_PM25) and readings[F_PM25] >= BATCH_ALARM_PM25:
+        return True
+    if valid & (1 << F_TVOC) and readings[F_TVOC] >= BATCH_ALARM_TVOC:
+        return True
+    return False
+
+
+def schedule(valid: int) -> int:
+    """Choose the interval before the next cycle and add the scheduler telemetry to the readings"""
+    global interval
+
+    if scheduler is None:
+        interval = settings.interval
+        return valid
 
+    scheduler.observe(
+        readings[F_PM25] if valid & (1 << F_PM25) else -1,
+        readings[F_TVOC] if valid & (1 << F_TVOC) else -1,
+    )
+    interval = scheduler.interval(settings.interval)
+
+    readings[F_VSYS] = scheduler.vsys
+    readings[F_INTERVAL] = interval
+    readings[F_AUTONOMY] = scheduler.autonomy()
+    return valid | (1 << F_VSYS) | (1 << F_INTERVAL) | (1 << F_AUTONOMY)
+
+
+def upload_due(valid: int) -> bool:
+    if batch.full() or alarm(valid):
+        return True
+    return scheduler is not None and batch.count >= scheduler.upload_every()
+
+
+def upload_block():
+    print("Uploading block")
+    wifi_connect()
+    mqtt_connect()
+    client.publish(BLOCK_TOPIC, batch.block(time()), content_type="application/octet-stream")
+    mqtt_disconnect()
+    batch.clear()
+    wifi_off()
+
+
+# from here on, a hang resets the device (the sleeps feed the watchdog)
+if WDT_TIMEOUT:
+    watchdog(WDT_TIMEOUT)
 
 try:
     print("Running setup")
     wifi_connect()
     setup()
+    if batch is not None:
+        wifi_off()  # the radio is powered only to upload a block
+    ready = True
     print("Setup complete")
 except Exception as e:
     print(str(e))
     sleep_ms(50)
-    machine.deepsleep(60_000)
+    machine.deepsleep(RESET_SLEEP_MS)
 else:
-    lightsleep(30)  # wait for sensors to settle
+    if not warm_boot:
+        lightsleep(pipeline.settle_ms())  # wait for sensors to settle
 
 while True:
     try:
         print("Waking up")
-        wifi_connect()
-        client.connect()
+        feed()
+        cycle_seq += 1
+        if trace is not None:
+            trace.cycle(cycle_seq)
+        if settings.apply_pending():
+            apply_settings()
+        audit.begin_cycle()
+        pms_due = True
+        if scheduler is not None:
+            scheduler.sample()
+            pms_due = scheduler.pms_due()
+        # the sensors that need it warm up while the rest of the cycle runs
+        pipeline.start(pms_due)
+        if batch is None:
+            with audit.site("wifi"):
+                wifi_connect()
+            with audit.site("mqtt.connect"):
+                mqtt_connect()
 
         print("Running main loop")
-        run()
+        fields = pipeline.measure(readings, pms_due)
+        fields = schedule(fields)
+
+        if batch is None:
+            with audit.site("publish"):
+                publish_readings(fields)
+            mqtt_disconnect()
+        else:
+            batch.append(time(), readings, fields)
+            if upload_due(fields):
+                with audit.site("upload"):
+                    upload_block()
 
         print("Going sleep")
-        client.disconnect()
+        if not audit.end_cycle():
+            print("Allocation budget exceeded")
+        audit.report()
+        if DEBUG_REPORT:
+            # formatting the counters allocates: not in the steady state
+            i2c1.report()
+            pipeline.report_counters()
+            pipeline.report_failures()
+            print("MQTT: %d bytes sent" % client.bytes_sent)
+            if MQTT_TLS:
+                # the ssl module of MicroPython has no sessions: every handshake is full
+                print("TLS: full handshake in %d ms" % client.handshake_ms)
+        client.bytes_sent = 0
+        if trace is not None:
+            trace.flush()
         gc.collect()
     except Exception as e:
         print(str(e))
-        sleep_ms(50)
-        machine.deepsleep(60_000)
+        reset()
     else:
         sleep_ms(50)
-        lightsleep(300)  # sleep for 5 minute
-
+        lightsleep(interval * 1_000)  # sleep until the next cycle (5 minutes by default)
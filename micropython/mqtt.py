@@ -20,12 +20,66 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import errno
 import micropython
+import select
+import ssl
 
 import usocket as socket
 import ustruct as struct
+from micropython import const
+from utime import ticks_ms, ticks_add, ticks_diff
 
-__all__ = ["MQTTClient"]
+__all__ = ["MQTTClient", "tls_context"]
+
+_RX_SIZE = const(64)  # receive buffer
+_ALIAS_MAX = const(16)  # topic aliases kept per connection (MQTT 5.0)
+
+# MQTT 5.0 properties
+_PROP_MESSAGE_EXPIRY = const(0x02)
+_PROP_CONTENT_TYPE = const(0x03)
+_PROP_TOPIC_ALIAS_MAXIMUM = const(0x22)
+_PROP_TOPIC_ALIAS = const(0x23)
+# size of the value of the fixed size properties (the others are strings, binary data or varints)
+_PROP_SIZE = {
+    0x01: 1, 0x17: 1, 0x19: 1, 0x24: 1, 0x25: 1, 0x28: 1, 0x29: 1, 0x2A: 1,
+    0x13: 2, 0x21: 2, 0x22: 2, 0x23: 2,
+    0x02: 4, 0x11: 4, 0x18: 4, 0x27: 4,
+}
+_PROP_VARINT = const(0x0B)
+_PROP_STRING_PAIR = const(0x26)
+
+
+@micropython.native
+def _varint_size(n: int) -> int:
+    size = 1
+    while n > 0x7F:
+        n >>= 7
+        size += 1
+    return size
+
+
+def tls_context(cafile: str = None, certfile: str = None, keyfile: str = None) -> ssl.SSLContext:
+    """
+    Build the TLS context of the client. It's meant to be created once and reused by every connection,
+    so that the certificates are parsed only at boot.
+
+    :param str cafile: CA certificate (DER) of the broker. If None, the broker is not verified
+    :param str certfile: client certificate (DER), for brokers that authenticate the clients
+    :param str keyfile: key of the client certificate (DER)
+    """
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cafile is None:
+        if hasattr(ctx, "check_hostname"):
+            # CPython refuses CERT_NONE while the host name is checked, MicroPython has no such attribute
+            ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+    else:
+        ctx.verify_mode = ssl.CERT_REQUIRED
+        ctx.load_verify_locations(cafile=cafile)
+    if certfile is not None:
+        ctx.load_cert_chain(certfile, keyfile)
+    return ctx
 
 
 class MQTTClient:
@@ -36,7 +90,11 @@ class MQTTClient:
             port: int = 1883,
             user: str = None,
             password: str = None,
-            keepalive: int = 0
+            keepalive: int = 0,
+            timeout: int = 10_000,
+            ssl_context: ssl.SSLContext = None,
+            version: int = 4,
+            message_expiry: int = 0
     ):
         self.client_id = client_id
         self.sock: socket.Socket = None
@@ -45,31 +103,215 @@ class MQTTClient:
         self.user = user
         self.password = password
         self.keepalive = keepalive
+        self.cb = None
+        self.pid = 0
+        self.timeout = timeout  # ms a single wait on the socket may last when no deadline is set
+        self._deadline: int = None
+        self._addr = None  # resolved once: getaddrinfo() can't be bounded by the deadline
+        self._poll = select.poll()
+
+        # TLS, only if a context is given
+        self.ssl_context = ssl_context
+        self._session = None  # TLS session of the last connection, never set on MicroPython (no sessions)
+        self.resumed: bool = False  # the last handshake resumed the previous session, never on MicroPython
+        self.handshake_ms: int = 0  # duration of the last handshake
+
+        # protocol: 4 = MQTT 3.1.1, 5 = MQTT 5.0
+        self.version = version
+        self.message_expiry = message_expiry  # s the broker keeps a message for a subscriber, 0 = forever (5.0)
+        self.bytes_sent: int = 0  # MQTT bytes written, to compare the protocols
+        self._aliases: list = [None] * _ALIAS_MAX  # topic of every alias sent on this connection
+        self._alias_count: int = 0
+        self._alias_max: int = 0  # aliases accepted by the broker (its Topic Alias Maximum)
+
+        # received bytes not consumed yet
+        self._rx = bytearray(_RX_SIZE)
+        self._rx_mv = memoryview(self._rx)
+        self._rx_start = 0
+        self._rx_end = 0
+
+        # preallocated buffers, so that publishing doesn't allocate
+        self._hdr = bytearray(7)  # fixed header + topic length
+        self._props = bytearray(12)  # publish properties (5.0), without the content type string
+        self._props_len: int = 0
+        self._num = bytearray(12)  # formatted numeric payload
+
+    def set_deadline(self, ms: int) -> None:
+        """
+        Bound every following operation to ms milliseconds from now (None to remove the deadline).
+        Past the deadline the operations raise OSError(ETIMEDOUT) instead of waiting for the socket.
+        """
+        self._deadline = None if ms is None else ticks_add(ticks_ms(), ms)
+
+    @micropython.native
+    def _remaining(self) -> int:
+        if self._deadline is None:
+            return self.timeout
+        remaining = ticks_diff(self._deadline, ticks_ms())
+        if remaining <= 0:
+            raise OSError(errno.ETIMEDOUT)
+        return remaining
+
+    @micropython.native
+    def _wait(self, event: int) -> None:
+        """Wait until the socket is ready for event, or raise OSError(ETIMEDOUT)"""
+        self._poll.modify(self.sock, event)
+        # ipoll() reuses its result, unlike poll()
+        for _ in self._poll.ipoll(self._remaining(), 1):
+            return
+        raise OSError(errno.ETIMEDOUT)
+
+    @micropython.native
+    def _write(self, buf, length: int = -1) -> None:
+        if length < 0:
+            length = len(buf)
+        self._remaining()
+
+        written = 0
+        while written < length:
+            if written:
+                # partial write, rare: only then a slice is allocated (topics and payloads may be str,
+                # which CPython can't view)
+                if isinstance(buf, str):
+                    buf = buf.encode()
+                n = self.sock.write(memoryview(buf)[written:length])
+            else:
+                # noinspection PyArgumentList
+                n = self.sock.write(buf, length)
+            if n is None:
+                self._wait(select.POLLOUT)
+            else:
+                written += n
+        self.bytes_sent += length
+
+    @micropython.native
+    def _fill(self) -> None:
+        """Read the available bytes into the empty receive buffer, waiting for them until the deadline"""
+        self._remaining()
+        while True:
+            n = self.sock.readinto(self._rx)
+            if n is None:
+                self._wait(select.POLLIN)
+            elif n == 0:
+                raise OSError(-1)  # connection closed by the server
+            else:
+                self._rx_start = 0
+                self._rx_end = n
+                return
+
+    @micropython.native
+    def _read_byte(self) -> int:
+        if self._rx_start == self._rx_end:
+            self._fill()
+        b = self._rx[self._rx_start]
+        self._rx_start += 1
+        return b
+
+    @micropython.native
+    def _read_u16(self) -> int:
+        return self._read_byte() << 8 | self._read_byte()
+
+    def _read(self, n: int) -> bytes:
+        out = bytearray(n)
+        pos = 0
+        while pos < n:
+            if self._rx_start == self._rx_end:
+                self._fill()
+            k = min(n - pos, self._rx_end - self._rx_start)
+            out[pos:pos + k] = self._rx_mv[self._rx_start:self._rx_start + k]
+            self._rx_start += k
+            pos += k
+        return bytes(out)
+
+    @micropython.native
+    def _skip(self, n: int) -> None:
+        while n > 0:
+            if self._rx_start == self._rx_end:
+                self._fill()
+            k = min(n, self._rx_end - self._rx_start)
+            self._rx_start += k
+            n -= k
 
     def _send_str(self, s: str) -> None:
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+        self._write(struct.pack("!H", len(s)))
+        self._write(s)
 
+    @micropython.native
     def _recv_len(self) -> int:
         n = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
+            b = self._read_byte()
             n |= (b & 0x7F) << sh
             if not b & 0x80:
                 return n
             sh += 7
 
-    @micropython.native
+    def _close(self) -> None:
+        if self.sock is None:
+            return
+        if self.ssl_context is not None:
+            # with TLS 1.3 the session ticket arrives after the handshake: the session is complete only now
+            session = getattr(self.sock, "session", None)
+            if session is not None:
+                self._session = session
+        try:
+            self._poll.unregister(self.sock)
+        except (OSError, KeyError):
+            pass
+        self.sock.close()
+        self.sock = None
+
+    def _handshake(self) -> None:
+        """
+        Wrap the connected socket with TLS; handshake_ms is how long it took.
+
+        Session resumption is not achievable on the MicroPython port: its ssl module doesn't expose the sessions,
+        so on the RP2040 every connection makes a full handshake and resumed stays False. The session is only
+        resumed by a port that exposes ``SSLSocket.session``, like CPython, which runs the host checks.
+        """
+        start = ticks_ms()
+
+        # the handshake runs on a blocking socket, bounded by the deadline
+        self._poll.unregister(self.sock)
+        self.sock.settimeout(self._remaining() / 1000)
+        if self._session is None:
+            sock = self.ssl_context.wrap_socket(self.sock, server_hostname=self.server)
+        else:
+            sock = self.ssl_context.wrap_socket(self.sock, server_hostname=self.server, session=self._session)
+        self.sock = sock
+        sock.setblocking(False)
+        self._poll.register(sock, select.POLLOUT)
+
+        self.resumed = getattr(sock, "session_reused", False)
+        self.handshake_ms = ticks_diff(ticks_ms(), start)
+
     def connect(self, clean_session=True) -> int:
+        if self._addr is None:
+            self._addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+
+        self._close()
         self.sock = socket.socket()
-        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
-        self.sock.connect(addr)
+        self.sock.setblocking(False)
+        self._poll.register(self.sock, select.POLLOUT)
+        self._rx_start = self._rx_end = 0
+        try:
+            self.sock.connect(self._addr)
+        except OSError as e:
+            if e.errno != errno.EINPROGRESS:
+                raise
+        self._wait(select.POLLOUT)
+        if self.ssl_context is not None:
+            self._handshake()
 
         premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+        if self.version == 5:
+            # no CONNECT properties
+            msg = bytearray(b"\x04MQTT\x05\x02\0\0\0")
+        else:
+            msg = bytearray(b"\x04MQTT\x04\x02\0\0")
 
-        sz = 10 + 2 + len(self.client_id)
+        sz = len(msg) + 1 + 2 + len(self.client_id)
         msg[6] = clean_session << 1
 
         if self.user is not None:
@@ -87,46 +329,225 @@ class MQTTClient:
             i += 1
         premsg[i] = sz
 
-        # noinspection PyArgumentList
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
+        self._write(premsg, i + 2)
+        self._write(msg)
 
         self._send_str(self.client_id)
         if self.user is not None:
             self._send_str(self.user)
             self._send_str(self.password)
-        resp = self.sock.read(4)
 
+        self._alias_count = 0
+        self._alias_max = 0
+        if self.version == 5:
+            return self._connack()
+
+        resp = self._read(4)
         return resp[2] & 1
 
+    def _connack(self) -> int:
+        """
+        Read a MQTT 5.0 CONNACK and the Topic Alias Maximum of the broker.
+        Raises OSError with the reason code if the connection is refused.
+        """
+        self._read_byte()
+        self._recv_len()
+        flags = self._read_byte()
+        reason = self._read_byte()
+        if reason:
+            raise OSError(reason)
+
+        sz = self._recv_len()
+        while sz > 0:
+            prop = self._read_byte()
+            sz -= 1
+            size = _PROP_SIZE.get(prop, 0)
+            if prop == _PROP_TOPIC_ALIAS_MAXIMUM:
+                self._alias_max = min(self._read_u16(), _ALIAS_MAX)
+            elif size:
+                self._skip(size)
+            elif prop == _PROP_VARINT:
+                size = _varint_size(self._recv_len())
+            else:
+                # strings and binary data, two strings for a user property
+                for _ in range(2 if prop == _PROP_STRING_PAIR else 1):
+                    n = self._read_u16()
+                    self._skip(n)
+                    size += 2 + n
+            sz -= size
+
+        return flags & 1
+
     def disconnect(self) -> None:
-        self.sock.write(b"\xe0\0")
-        self.sock.close()
+        try:
+            self._write(b"\xe0\0")
+        finally:
+            self._close()
 
     def ping(self) -> bool:
         try:
-            self.sock.write(b"\xc0\0")
+            self._write(b"\xc0\0")
         except OSError:
             return False
 
         return True
 
     @micropython.native
-    def publish(self, topic: str, msg: str) -> None:
-        pkt = bytearray(b"0\0\0\0")
+    def _alias(self, topic: str) -> int:
+        """Alias of the topic: positive if already sent on this connection, negative if new, 0 if none is left"""
+        aliases = self._aliases
+        n = self._alias_count
+        for i in range(n):
+            if aliases[i] == topic:
+                return i + 1
+        if n < self._alias_max:
+            aliases[n] = topic
+            self._alias_count = n + 1
+            return -(n + 1)
+        return 0
+
+    @micropython.native
+    def _write_properties(self, topic: str, content_type: str) -> int:
+        """
+        Write the publish properties into the properties buffer. Returns the length of the topic to send:
+        0 when the broker already knows its alias.
+        """
+        props = self._props
+        topic_len = len(topic)
+        n = 1
+
+        alias = self._alias(topic)
+        if alias:
+            if alias > 0:
+                topic_len = 0
+            else:
+                alias = -alias
+            props[n] = _PROP_TOPIC_ALIAS
+            props[n + 1] = alias >> 8
+            props[n + 2] = alias & 0xFF
+            n += 3
 
-        sz = 2 + len(topic) + len(msg)
+        expiry = self.message_expiry
+        if expiry:
+            props[n] = _PROP_MESSAGE_EXPIRY
+            props[n + 1] = (expiry >> 24) & 0xFF
+            props[n + 2] = (expiry >> 16) & 0xFF
+            props[n + 3] = (expiry >> 8) & 0xFF
+            props[n + 4] = expiry & 0xFF
+            n += 5
+
+        size = n - 1
+        if content_type is not None:
+            # the string follows the buffer
+            ct_len = len(content_type)
+            props[n] = _PROP_CONTENT_TYPE
+            props[n + 1] = ct_len >> 8
+            props[n + 2] = ct_len & 0xFF
+            n += 3
+            size += 3 + ct_len
+
+        props[0] = size  # content types are short: the length fits a single byte varint
+        self._props_len = n
+        return topic_len
+
+    @micropython.native
+    def _write_header(self, topic: str, sz: int, content_type: str = None) -> None:
+        hdr = self._hdr
+        hdr[0] = 0x30
+
+        topic_len = len(topic)
+        if self.version == 5:
+            topic_len = self._write_properties(topic, content_type)
+            sz += 1 + self._props[0]
+
+        sz += 2 + topic_len
         i = 1
         while sz > 0x7F:
-            pkt[i] = (sz & 0x7F) | 0x80
+            hdr[i] = (sz & 0x7F) | 0x80
             sz >>= 7
             i += 1
-        pkt[i] = sz
+        hdr[i] = sz
+
+        hdr[i + 1] = topic_len >> 8
+        hdr[i + 2] = topic_len & 0xFF
+
+        self._write(hdr, i + 3)
+        if topic_len:
+            self._write(topic)
+        if self.version == 5:
+            self._write(self._props, self._props_len)
+            if content_type is not None:
+                self._write(content_type)
+
+    @micropython.native
+    def _format_num(self, value: int, decimals: int) -> int:
+        """Write the value, scaled by 10^decimals, as ASCII into the payload buffer"""
+        buf = self._num
+        sign = 0
+        if value < 0:
+            buf[0] = 0x2D  # '-'
+            value = -value
+            sign = 1
+
+        digits = 1
+        n = value
+        while n >= 10:
+            n //= 10
+            digits += 1
+        if digits <= decimals:
+            digits = decimals + 1  # leading zero, e.g. 0.5
 
-        # noinspection PyArgumentList
-        self.sock.write(pkt, i + 1)
+        length = sign + digits
+        if decimals:
+            length += 1
+
+        pos = length
+        written = 0
+        while pos > sign:
+            pos -= 1
+            if decimals and written == decimals:
+                buf[pos] = 0x2E  # '.'
+                decimals = 0
+                continue
+            buf[pos] = 0x30 + value % 10
+            value //= 10
+            written += 1
+
+        return length
+
+    @micropython.native
+    def publish(self, topic: str, msg: str, content_type: str = None) -> None:
+        """Publish a message. The content type (MQTT 5.0 only, short) describes the payload to the subscribers"""
+        self._write_header(topic, len(msg), content_type)
+        self._write(msg)
+
+    @micropython.native
+    def publish_num(self, topic: str, value: int, decimals: int = 0) -> None:
+        """
+        Publish an integer without allocating a string for it.
+        The value is scaled by 10^decimals, e.g. publish_num(topic, 215, 1) sends "21.5".
+        """
+        n = self._format_num(value, decimals)
+        self._write_header(topic, n)
+        self._write(self._num, n)
+
+    def set_callback(self, f) -> None:
+        """Set the callback called with (topic, msg) for every message received on a subscribed topic"""
+        self.cb = f
+
+    def subscribe(self, topic: str, qos: int = 0) -> None:
+        """
+        Subscribe to a topic. The SUBACK is not waited for: it is consumed,
+        together with the messages of the topic, by check_msg() and wait_msg().
+        """
+        assert self.cb is not None, "Subscribe callback is not set"
+        pkt = bytearray(b"\x82\0\0\0\0")  # the last byte is the length of the properties (5.0)
+        props = 1 if self.version == 5 else 0
+        self.pid = (self.pid % 0xFFFF) + 1
+        struct.pack_into("!BH", pkt, 1, 2 + props + 2 + len(topic) + 1, self.pid)
+        self._write(pkt, 4 + props)
         self._send_str(topic)
-        self.sock.write(msg)
+        self._write(bytes((qos,)))
 
     @micropython.native
     def wait_msg(self) -> int:
@@ -135,31 +556,51 @@ class MQTTClient:
         Subscribed messages are delivered to a callback previously
         set by .set_callback() method. Other (internal) MQTT
         messages processed internally.
+        Returns the packet type. Raises OSError(ETIMEDOUT) if nothing arrives before the deadline.
         """
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return 0
-        if res == b"":
-            return 0
-        if res == b"\xd0":  # PINGRESP
-            return 0
-        op = res[0]
+        op = self._read_byte()
+        sz = self._recv_len()
         if op & 0xF0 != 0x30:
+            # PINGRESP, SUBACK, ...: skip the variable header
+            self._skip(sz)
             return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
+
+        topic_len = self._read_u16()
+        topic = self._read(topic_len)
 
         sz -= topic_len + 2
 
-        if op & 6 == 2:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
+        pid = 0
+        if op & 6:
+            pid = self._read_u16()
             sz -= 2
 
+        if self.version == 5:
+            # the properties of the messages received are not used
+            props = self._recv_len()
+            self._skip(props)
+            sz -= _varint_size(props) + props
+
+        msg = self._read(sz) if sz else b""
+        if self.cb is not None:
+            self.cb(topic, msg)
+
+        if op & 6 == 2:
             pkt = bytearray(b"\x40\x02\0\0")
             struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
+            self._write(pkt)
 
         return op
+
+    def check_msg(self) -> int:
+        """
+        Check if the server has any pending messages, and process one if so.
+        Returns None if there is nothing to read.
+        """
+        if self._rx_start == self._rx_end:
+            self._poll.modify(self.sock, select.POLLIN)
+            for _ in self._poll.ipoll(0, 1):
+                break
+            else:
+                return None
+        return self.wait_msg()
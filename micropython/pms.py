@@ -20,14 +20,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from struct import unpack
+from struct import unpack, unpack_from
 
+import _thread
 import micropython
-from time import time, sleep_ms
+from time import time, sleep, sleep_ms, ticks_ms, ticks_diff
 from machine import UART
 from micropython import const
 
-__all__ = ["PMS"]
+__all__ = ["PMS", "PMSWorker"]
 
 # Commands
 ACTIVE_MODE = bytearray((0x42, 0x4D, 0xE1, 0x00, 0x01, 0x01, 0x71))
@@ -39,6 +40,19 @@ REQUEST_READ = bytearray((0x42, 0x4D, 0xE2, 0x00, 0x00, 0x01, 0x71))
 # Message constant
 START_BYTE_1 = const(0x42)
 START_BYTE_2 = const(0x4d)
+FRAME_SIZE = const(32)
+
+# UART RX buffer, over the 256 bytes of the rp2 port: 16 frames, about 0.5 s at 9600 baud (960 bytes/s),
+# so that the frames survive a soft IRQ delayed by a GC, a flash write or a blocking TLS handshake
+RX_BUFFER = const(512)
+
+# IRQ reception
+RING_SIZE = const(256)  # must be a power of two
+RING_MASK = const(RING_SIZE - 1)
+CHUNK_SIZE = const(32)  # RX FIFO size of the RP2040
+
+# Time the worker may take after the warm-up: commands and a read timeout of 5 s
+READ_MARGIN = const(10)
 
 # Indexes
 # noinspection DuplicatedCode
@@ -61,9 +75,131 @@ PMS_CHECKSUM = const(15)
 
 
 class PMS:
-    def __init__(self, uart: UART):
+    def __init__(self, uart: UART, rxbuf: int = RX_BUFFER):
         self.uart: UART = uart
-        self.uart.init(9600, timeout=250, timeout_char=100)
+        self.uart.init(9600, timeout=250, timeout_char=100, rxbuf=rxbuf)
+
+        # IRQ reception: bytes are staged in a ring buffer by the RX handler,
+        # then frames are decoded by a scheduled callback
+        self._irq: bool = False
+        self._ring: bytearray = bytearray(RING_SIZE)
+        self._head: int = 0  # written by the RX handler
+        self._tail: int = 0  # written by the decoder
+        self._chunk: bytearray = bytearray(CHUNK_SIZE)
+        self._frame_buf: bytearray = bytearray(FRAME_SIZE)
+        self._scheduled: bool = False
+        self._decode_cb = self._decode  # preallocated, micropython.schedule must not allocate
+
+        self._frame: tuple = None  # last decoded frame
+        self._frame_seq: int = 0  # incremented for every decoded frame
+        self._read_seq: int = 0  # sequence of the last frame returned by read()
+
+        # counters
+        self.frames_ok: int = 0  # frames decoded
+        self.frames_bad: int = 0  # frames discarded for a wrong length or checksum
+        self.frames_lost: int = 0  # ring buffer overflows, each one loses at least a frame
+        self._overflow: bool = False  # the ring buffer is full, bytes are being dropped
+        self.bytes_dropped: int = 0  # bytes discarded because the ring buffer was full
+        self.schedule_missed: int = 0  # decoder not scheduled because the queue was full
+
+    def enable_irq(self) -> bool:
+        """Receive the frames with the UART RX interrupt. Returns False if the port doesn't support it"""
+        uart = self.uart
+        if not hasattr(uart, "irq") or not hasattr(uart, "IRQ_RXIDLE"):
+            return False
+
+        self._head = self._tail = 0
+        self._overflow = False
+        self._read_seq = self._frame_seq
+        uart.irq(self._on_rx, uart.IRQ_RXIDLE)
+        self._irq = True
+        return True
+
+    def disable_irq(self) -> None:
+        if self._irq:
+            self.uart.irq(None)
+            self._irq = False
+
+    @micropython.native
+    def _on_rx(self, uart: UART) -> None:
+        """RX handler: move the received bytes in the ring buffer and schedule the decoder"""
+        ring = self._ring
+        chunk = self._chunk
+        head = self._head
+        overflow = self._overflow
+
+        n = uart.any()
+        while n > 0:
+            if n > CHUNK_SIZE:
+                n = CHUNK_SIZE
+            n = uart.readinto(chunk, n)
+            if not n:
+                break
+
+            for i in range(n):
+                nxt = (head + 1) & RING_MASK
+                if nxt == self._tail:
+                    self.bytes_dropped += n - i
+                    if not overflow:
+                        # counted once until the decoder makes room again
+                        self.frames_lost += 1
+                        overflow = True
+                    break
+                ring[head] = chunk[i]
+                head = nxt
+                overflow = False
+
+            n = uart.any()
+
+        self._head = head
+        self._overflow = overflow
+
+        if not self._scheduled:
+            try:
+                micropython.schedule(self._decode_cb, 0)
+                self._scheduled = True
+            except RuntimeError:
+                self.schedule_missed += 1
+
+    @micropython.native
+    def _decode(self, _) -> None:
+        """Decode every complete frame in the ring buffer"""
+        self._scheduled = False
+        ring = self._ring
+        buf = self._frame_buf
+
+        while True:
+            tail = self._tail
+            if (self._head - tail) & RING_MASK < FRAME_SIZE:
+                return
+
+            if ring[tail] != START_BYTE_1 or ring[(tail + 1) & RING_MASK] != START_BYTE_2:
+                self._tail = (tail + 1) & RING_MASK  # resync
+                continue
+
+            checksum = 0
+            for i in range(FRAME_SIZE):
+                b = ring[(tail + i) & RING_MASK]
+                buf[i] = b
+                if i < FRAME_SIZE - 2:
+                    checksum += b
+
+            if (buf[2] << 8 | buf[3]) != FRAME_SIZE - 4 or checksum != (buf[30] << 8 | buf[31]):
+                self.frames_bad += 1
+                self._tail = (tail + 1) & RING_MASK
+                continue
+
+            self._frame = unpack_from('>HHHHHHHHHHHHHBBH', buf, 2)
+            self._frame_seq += 1
+            self.frames_ok += 1
+            self._tail = (tail + FRAME_SIZE) & RING_MASK
+
+    def report(self) -> None:
+        """Print the counters of the IRQ reception"""
+        if self._irq:
+            print("  PMS: %d frames, %d bad, %d lost, %d bytes dropped, %d schedules missed" % (
+                self.frames_ok, self.frames_bad, self.frames_lost, self.bytes_dropped, self.schedule_missed
+            ))
 
     def act_mode(self) -> None:
         self.uart.write(ACTIVE_MODE)
@@ -86,12 +222,25 @@ class PMS:
         sleep_ms(50)
 
     def prepare_read(self) -> None:
+        self._read_seq = self._frame_seq
         self.uart.write(REQUEST_READ)
         self.uart.flush()
         sleep_ms(50)
 
+    def _wait_frame(self) -> tuple[int, ...]:
+        start = ticks_ms()
+        while ticks_diff(ticks_ms(), start) < 5_000:
+            if self._frame_seq != self._read_seq:
+                self._read_seq = self._frame_seq
+                return self._frame
+            sleep_ms(20)  # the decoder runs while sleeping
+        print("Timeout while reading data from PMS sensor")
+
     @micropython.native
     def read(self) -> tuple[int, ...]:
+        if self._irq:
+            return self._wait_frame()
+
         uart = self.uart  # cache object to speedup things
         start_time = time()
 
@@ -121,3 +270,80 @@ class PMS:
             return data
         else:
             print("Timeout while reading data from PMS sensor")
+
+
+class PMSWorker:
+    """
+    Run the PMS acquisition (wake up, warm-up, read, sleep) on the second core.
+
+    The main core starts an acquisition with request() and collects the decoded
+    frame with wait(), so it can talk to WiFi, MQTT and the I2C sensors while
+    the fan of the PMS is spinning. The frame is shared through a lock.
+
+    :param PMS pms: the PMS driver, it must not be used by the main core
+    :param int warmup: seconds to wait after waking up the sensor
+    """
+
+    def __init__(self, pms: PMS, warmup: int = 30):
+        self.pms: PMS = pms
+        self.warmup: int = warmup
+
+        self._lock = _thread.allocate_lock()  # protects the fields below
+        self._frame: tuple = None
+        self._seq: int = 0  # incremented every time an acquisition completes
+        self._busy: bool = False
+
+        self._start = _thread.allocate_lock()  # released to start an acquisition
+        self._start.acquire()
+
+        _thread.start_new_thread(self._loop, ())
+
+    def _loop(self) -> None:
+        pms = self.pms
+        while True:
+            self._start.acquire()
+
+            frame = None
+            try:
+                pms.wake_up()
+                sleep(self.warmup)
+                pms.prepare_read()
+                frame = pms.read()
+                pms.sleep()
+            except Exception as e:
+                print(str(e))
+
+            with self._lock:
+                self._frame = frame
+                self._seq += 1
+                self._busy = False
+
+    def request(self) -> int:
+        """Start an acquisition. Returns the sequence number to pass to wait()"""
+        with self._lock:
+            seq = self._seq
+            if self._busy:
+                return seq
+            self._busy = True
+
+        self._start.release()
+        return seq
+
+    def wait(self, seq: int, timeout: int = None, idle=None) -> tuple[int, ...]:
+        """
+        Wait for the acquisition started by request(). Returns None on timeout or read error.
+        The timeout (s) defaults to the warm-up and READ_MARGIN.
+        idle, if given, is called while waiting (e.g. to feed the watchdog).
+        """
+        if timeout is None:
+            timeout = self.warmup + READ_MARGIN
+        start = ticks_ms()
+        while ticks_diff(ticks_ms(), start) < timeout * 1_000:
+            with self._lock:
+                if self._seq != seq:
+                    return self._frame
+            if idle is not None:
+                idle()
+            sleep_ms(100)
+
+        print("Timeout while waiting for the PMS worker")
@@ -0,0 +1,648 @@
+import errno
+
+import machine
+import micropython
+from micropython import const
+from utime import time, ticks_ms, ticks_diff
+
+__all__ = ["Sensor", "Breaker", "Pipeline", "REGISTRY", "BUS_I2C", "BUS_UART", "lightsleep", "watchdog", "feed"]
+
+BUS_I2C = const(0)
+BUS_UART = const(1)
+
+_wdt = None  # hardware watchdog, fed by feed() and lightsleep()
+
+
+def watchdog(timeout: int):
+    """Start the hardware watchdog: the device resets if it isn't fed for timeout ms (8388 at most on the RP2040)"""
+    global _wdt
+    _wdt = machine.WDT(timeout=timeout)
+    return _wdt
+
+
+def feed() -> None:
+    if _wdt is not None:
+        _wdt.feed()
+
+
+@micropython.native
+def lightsleep(ms: int):
+    for i in range(ms):
+        if i & 1023 == 0:
+            feed()  # about every second
+        machine.lightsleep(1)
+
+
+class Breaker:
+    """
+    Circuit breaker of a sensor.
+
+    After a failure the sensor is retried in the next cycle; every further consecutive
+    failure doubles the cycles it's skipped (1, 3, 7, ...) up to max_backoff, so that a
+    broken sensor costs neither its retries nor its warm-up while the others are measured.
+
+    :param int max_backoff: maximum cycles skipped after a failure
+    """
+
+    def __init__(self, max_backoff: int = 8):
+        self.max_backoff: int = max_backoff
+        self.failures: int = 0  # consecutive failures
+        self.backoff: int = 0  # cycles left to skip
+
+        # counters
+        self.errors: int = 0  # failed measurements
+        self.skipped: int = 0  # cycles skipped while open
+        self.trips: int = 0  # times the breaker opened
+
+    def allow(self) -> bool:
+        """Called once per cycle: True if the sensor can be measured"""
+        if self.backoff:
+            self.backoff -= 1
+            self.skipped += 1
+            return False
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+
+    def failure(self) -> None:
+        self.errors += 1
+        self.failures += 1
+        if self.failures == 2:
+            self.trips += 1
+        backoff = (1 << (self.failures - 1)) - 1 if self.failures < 16 else self.max_backoff
+        self.backoff = backoff if backoff < self.max_backoff else self.max_backoff
+
+
+class Sensor:
+    """
+    Entry of the sensor registry: what a driver needs and produces, and how it's run in the cycle.
+
+    The metadata are class attributes, so they can be read without importing the driver:
+    the module is imported by create(), only for the sensors that are present.
+
+    - NAME: name used in ``conf.SENSORS``
+    - DRIVER: (module, class) of the driver, built by create() on the bus
+    - BUS: BUS_I2C or BUS_UART
+    - ADDRESS: I2C address probed at boot, None if the sensor can't be probed
+    - INIT_MS: time the sensor needs after the cold initialisation before its readings are valid
+    - WARMUP_MS: time the sensor must be powered before every measurement (0 = none)
+    - CONVERSION_MS: duration of a measurement
+    - POWER_MA: current drawn while measuring
+    - FIELDS: names of the readings, in the table of main.py
+    - DUTY: the energy scheduler may skip the sensor in a cycle
+    - SITE: audit site of the measurement (the I2C sensors are measured together in "i2c")
+
+    :param Pipeline pipeline: the pipeline that runs the sensor
+    """
+
+    NAME = ""
+    DRIVER = ("", "")
+    BUS = BUS_I2C
+    ADDRESS = None
+    INIT_MS = 0
+    WARMUP_MS = 0
+    CONVERSION_MS = 0
+    POWER_MA = 0.0
+    FIELDS = ()
+    DUTY = False
+    SITE = "i2c"
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.driver = None
+        self.slots: tuple = ()  # index of every field in the readings
+        self.valid: bool = False  # the last measurement succeeded
+        self.ready: bool = True  # the setup succeeded
+        self.active: bool = False  # measured in this cycle
+        self.breaker: Breaker = None
+
+    def create(self, bus, settings, warm_boot: bool) -> None:
+        """Import the driver and build it on the bus. Overridden by the drivers that take settings"""
+        module, name = self.DRIVER
+        self.driver = getattr(__import__(module), name)(bus)
+
+    def setup(self, warm_boot: bool) -> None:
+        """Initialise the sensor. Raises OSError or RuntimeError if it doesn't answer"""
+
+    def apply(self, settings) -> None:
+        """Apply new runtime settings"""
+
+    def warmup_ms(self) -> int:
+        return self.WARMUP_MS
+
+    def start(self) -> None:
+        """Power the sensor at the start of the cycle, if it has to warm up"""
+
+    def read(self, readings: list) -> int:
+        """Store the readings of the last measurement. Returns the bitmask of the valid fields"""
+        return 0
+
+    def save(self, snapshot) -> None:
+        """Store the state in the snapshot taken before a reset"""
+
+    def restore(self, snapshot, now: int) -> None:
+        """Restore the state from the snapshot. Times are relative to now"""
+
+    def report(self) -> None:
+        """Print the counters of the driver"""
+
+    def mask(self) -> int:
+        """Bitmask of all the fields"""
+        mask = 0
+        for slot in self.slots:
+            mask |= 1 << slot
+        return mask
+
+
+class AHT20Sensor(Sensor):
+    NAME = "aht20"
+    DRIVER = ("aht20", "AHT20")
+    ADDRESS = 0x38
+    INIT_MS = 40  # after the power on, before the calibration
+    CONVERSION_MS = 80
+    POWER_MA = 0.98
+    FIELDS = ("temperature", "humidity")
+
+    def setup(self, warm_boot: bool) -> None:
+        aht20 = self.driver
+        if warm_boot and aht20.calibrated:
+            return
+        if not warm_boot:
+            aht20.reset()
+        if not aht20.calibrate():
+            raise RuntimeError("Could not calibrate AHT20")
+
+    def read(self, readings: list) -> int:
+        # as scaled integers: no float is created
+        aht20 = self.driver
+        readings[self.slots[0]] = aht20.temperature_scaled(1)
+        readings[self.slots[1]] = aht20.relative_humidity_scaled(0) * 10
+        return self.mask()
+
+
+class BMP180Sensor(Sensor):
+    NAME = "bmp180"
+    DRIVER = ("bmp180", "BMP180")
+    ADDRESS = 0x77
+    INIT_MS = 10
+    CONVERSION_MS = 31  # temperature and pressure, ultra high resolution
+    POWER_MA = 0.65
+    FIELDS = ("pressure",)
+
+    def create(self, bus, settings, warm_boot: bool) -> None:
+        from bmp180 import BMP180
+        self.driver = BMP180(bus, mode=settings.bmp_mode)
+
+    def setup(self, warm_boot: bool) -> None:
+        # on a warm boot the calibration comes from the snapshot
+        if not warm_boot:
+            self.driver.initialize()
+
+    def apply(self, settings) -> None:
+        self.driver.mode = settings.bmp_mode
+
+    def read(self, readings: list) -> int:
+        pres = self.driver.last_pressure
+        # round to the nearest 10 Pa, ties to even
+        q = pres // 10
+        r = pres - q * 10
+        if r > 5 or (r == 5 and q & 1):
+            q += 1
+        readings[self.slots[0]] = q * 10
+        return self.mask()
+
+    def save(self, snapshot) -> None:
+        snapshot.bmp180 = self.driver.calibration
+
+    def restore(self, snapshot, now: int) -> None:
+        if any(snapshot.bmp180):
+            self.driver.calibration = snapshot.bmp180
+        else:
+            # the sensor was absent when the snapshot was taken
+            self.driver.initialize()
+
+
+class SGP30Sensor(Sensor):
+    NAME = "sgp30"
+    DRIVER = ("sgp30", "SGP30")
+    ADDRESS = 0x58
+    INIT_MS = 15_000  # the IAQ algorithm returns fixed values for the first 15 s
+    CONVERSION_MS = 12
+    POWER_MA = 48.2
+    FIELDS = ("eco2", "tvoc")
+
+    def __init__(self, pipeline):
+        super().__init__(pipeline)
+        self.start_time: int = time()
+        self.baseline: list[int] = [0, 0]  # last co2eq and tvoc baselines
+        self.baseline_time: int = 0
+
+    def create(self, bus, settings, warm_boot: bool) -> None:
+        from sgp30 import SGP30
+        self.driver = SGP30(bus, init=not warm_boot)
+
+    def setup(self, warm_boot: bool) -> None:
+        if warm_boot:
+            # the sensor kept running during the reset, the state comes from the snapshot
+            return
+
+        sgp30 = self.driver
+        sgp30.iaq_init()
+        self.start_time = time()
+        try:
+            f_co2 = open("co2eq_baseline.txt", 'r')
+            f_tvoc = open("tvoc_baseline.txt", 'r')
+
+            co2_baseline = int(f_co2.read())
+            tvoc_baseline = int(f_tvoc.read())
+        except (ValueError, OSError):
+            print("Impossible to read SGP30 baselines!")
+        else:
+            print("Baselines loaded")
+            sgp30.set_iaq_baseline(co2_baseline, tvoc_baseline)
+            self.baseline[0] = co2_baseline
+            self.baseline[1] = tvoc_baseline
+            f_co2.close()
+            f_tvoc.close()
+        finally:
+            self.baseline_time = time()
+
+    def read(self, readings: list) -> int:
+        sgp30 = self.driver
+        readings[self.slots[0]] = sgp30.last_co2eq
+        readings[self.slots[1]] = sgp30.last_tvoc
+
+        if time() - self.baseline_time >= 3600:
+            self.save_baseline()
+        return self.mask()
+
+    def save_baseline(self) -> None:
+        sgp30 = self.driver
+        try:
+            f_co2 = open("co2eq_baseline.txt", 'w')
+            f_tvoc = open("tvoc_baseline.txt", 'w')
+
+            bl_co2, bl_tvoc = sgp30.get_iaq_baseline()
+            self.baseline[0] = bl_co2
+            self.baseline[1] = bl_tvoc
+            f_co2.write(str(bl_co2))
+            f_tvoc.write(str(bl_tvoc))
+
+            # humidity compensation, from the AHT20 measured in the same cycle
+            aht20 = self.pipeline.find("aht20")
+            if aht20 is not None and aht20.valid:
+                sgp30.set_iaq_rel_humidity_fixed(
+                    aht20.driver.relative_humidity_scaled(1), aht20.driver.temperature_scaled(1)
+                )
+
+            f_co2.close()
+            f_tvoc.close()
+        except OSError:
+            print("Impossible to save SGP30 baselines!")
+        finally:
+            print("Baselines saved")
+            self.baseline_time = time()
+
+    def save(self, snapshot) -> None:
+        now = time()
+        snapshot.co2eq_baseline = self.baseline[0]
+        snapshot.tvoc_baseline = self.baseline[1]
+        snapshot.sgp30_uptime = now - self.start_time
+        snapshot.baseline_elapsed = now - self.baseline_time
+
+    def restore(self, snapshot, now: int) -> None:
+        self.baseline[0] = snapshot.co2eq_baseline
+        self.baseline[1] = snapshot.tvoc_baseline
+        self.start_time = now - snapshot.sgp30_uptime
+        self.baseline_time = now - snapshot.baseline_elapsed
+
+
+class PMS7003Sensor(Sensor):
+    NAME = "pms7003"
+    DRIVER = ("pms", "PMS")
+    BUS = BUS_UART
+    INIT_MS = 30_000  # the fan needs 30 s to give stable readings after the power on
+    WARMUP_MS = 30_000  # default of settings.pms_warmup
+    CONVERSION_MS = 1_000  # a frame every second in passive mode (2.3 s in active mode)
+    POWER_MA = 100.0  # at 5 V
+    FIELDS = ("pm01", "pm25", "pm100", "caqi")
+    DUTY = True
+    SITE = "pms"
+
+    def __init__(self, pipeline):
+        super().__init__(pipeline)
+        self.settings = None
+        self.worker = None
+        self._seq: int = 0  # acquisition of the worker
+        self._woken: int = 0  # ticks_ms() of the wake-up
+        self._started: bool = False
+
+        # CAQI accumulators
+        self.pm25_sum: int = 0
+        self.pm100_sum: int = 0
+        self.values: int = 0
+        self.caqi_time: int = time()
+
+    def create(self, bus, settings, warm_boot: bool) -> None:
+        from pms import PMS
+        self.driver = PMS(bus)
+        self.settings = settings
+
+    def setup(self, warm_boot: bool) -> None:
+        from conf import PMS_IRQ, PMS_SECOND_CORE
+
+        pms = self.driver
+        pms.pas_mode()
+        if PMS_IRQ and not pms.enable_irq():
+            print("UART IRQ not supported, polling PMS")
+        if PMS_SECOND_CORE:
+            from pms import PMSWorker
+            self.worker = PMSWorker(pms, warmup=self.settings.pms_warmup)
+
+    def apply(self, settings) -> None:
+        if self.worker is not None:
+            self.worker.warmup = settings.pms_warmup
+
+    def warmup_ms(self) -> int:
+        return self.settings.pms_warmup * 1_000
+
+    def start(self) -> None:
+        # the fan warms up while the rest of the cycle runs, on the second core if there is the worker
+        if self.worker is not None:
+            self._seq = self.worker.request()
+        else:
+            self.driver.wake_up()
+            self._woken = ticks_ms()
+        self._started = True
+
+    def read(self, readings: list) -> int:
+        if not self._started:
+            self.start()
+        self._started = False
+
+        if self.worker is not None:
+            pms_data = self.worker.wait(self._seq, idle=feed)
+        else:
+            pms = self.driver
+            lightsleep(self.warmup_ms() - ticks_diff(ticks_ms(), self._woken))
+            pms.prepare_read()
+            pms_data = pms.read()
+            pms.sleep()
+        if pms_data is None:
+            raise OSError(errno.ETIMEDOUT)
+
+        slots = self.slots
+        pm10 = pms_data[4]
+        pm25 = pms_data[5]
+        pm100 = pms_data[6]
+        self.pm25_sum += pm25
+        self.pm100_sum += pm100
+        self.values += 1
+
+        readings[slots[0]] = pm10
+        readings[slots[1]] = pm25
+        readings[slots[2]] = pm100
+        valid = (1 << slots[0]) | (1 << slots[1]) | (1 << slots[2])
+
+        if time() - self.caqi_time >= self.settings.caqi_window:
+            from caqi import CAQI
+            readings[slots[3]] = CAQI.caqi(self.pm25_sum // self.values, self.pm100_sum // self.values)
+            valid |= 1 << slots[3]
+            self.pm25_sum = 0
+            self.pm100_sum = 0
+            self.values = 0
+            self.caqi_time = time()
+
+        return valid
+
+    def save(self, snapshot) -> None:
+        snapshot.pm25_sum = self.pm25_sum
+        snapshot.pm100_sum = self.pm100_sum
+        snapshot.pm_values = self.values
+        snapshot.caqi_elapsed = time() - self.caqi_time
+
+    def restore(self, snapshot, now: int) -> None:
+        self.pm25_sum = snapshot.pm25_sum
+        self.pm100_sum = snapshot.pm100_sum
+        self.values = snapshot.pm_values
+        self.caqi_time = now - snapshot.caqi_elapsed
+
+    def report(self) -> None:
+        self.driver.report()
+
+
+# name -> entry, the order of conf.SENSORS doesn't matter
+REGISTRY: dict = {
+    AHT20Sensor.NAME: AHT20Sensor,
+    BMP180Sensor.NAME: BMP180Sensor,
+    SGP30Sensor.NAME: SGP30Sensor,
+    PMS7003Sensor.NAME: PMS7003Sensor,
+}
+
+
+class Pipeline:
+    """
+    Measurement cycle built from the sensors listed in ``conf.SENSORS``.
+
+    At boot the I2C bus is scanned once and the sensors that don't answer are skipped.
+    Every sensor has a `Breaker`: a failed setup or measurement invalidates only the
+    fields of that sensor, and the setup is retried when the breaker lets it. The cycle is
+    ordered with the metadata of the registry to keep the device awake as little as possible:
+
+    1. start(): the sensors that must warm up are powered first, the longest first,
+       so that their warm-up overlaps WiFi, MQTT and the I2C conversions;
+    2. measure(): the I2C sensors are measured together by `I2CBus.run`, the longest
+       conversion first, then the warmed up sensors are read.
+
+    :param tuple names: names of the sensors in the registry
+    :param tuple fields: names of the readings, in the order of the readings list
+    :param I2CBus i2c: the bus, scanned to find the sensors
+    :param sensor_i2c: the bus passed to the drivers (the bus itself or a recorder)
+    :param uart: the UART of the serial sensor, or a callable that builds it
+    :param Settings settings: the runtime settings
+    :param bool warm_boot: the sensors kept their state during the reset
+    :param Audit audit: allocation audit of the cycle
+    :param int max_backoff: maximum cycles a failing sensor is skipped
+    """
+
+    def __init__(self, names: tuple, fields: tuple, i2c, sensor_i2c, uart, settings, warm_boot: bool, audit,
+                 max_backoff: int = 8):
+        self.i2c = i2c
+        self.audit = audit
+        self.sensors: list = []
+
+        try:
+            found = i2c.scan()
+        except OSError:
+            found = []
+
+        for name in names:
+            entry = REGISTRY.get(name)
+            if entry is None:
+                print("Unknown sensor %s" % name)
+                continue
+            if entry.BUS == BUS_I2C and entry.ADDRESS is not None and entry.ADDRESS not in found:
+                print("%s not found" % name)
+                continue
+
+            sensor = entry(self)
+            sensor.breaker = Breaker(max_backoff)
+            sensor.slots = tuple(fields.index(field) for field in entry.FIELDS)
+            try:
+                if entry.BUS == BUS_I2C:
+                    sensor.create(sensor_i2c, settings, warm_boot)
+                else:
+                    sensor.create(uart() if callable(uart) else uart, settings, warm_boot)
+            except (OSError, RuntimeError) as e:
+                print("%s: %s" % (name, str(e)))
+                continue
+            self.sensors.append(sensor)
+
+        self._order()
+
+    def _order(self) -> None:
+        # measured together on the bus, the longest conversion is started first
+        i2c = [s for s in self.sensors if s.BUS == BUS_I2C]
+        i2c.sort(key=lambda s: -s.CONVERSION_MS)
+        self._i2c: tuple = tuple(i2c)
+        self._drivers: tuple = tuple(s.driver for s in i2c)
+
+        # powered at the start of the cycle, the longest warm-up first
+        warm = [s for s in self.sensors if s.BUS != BUS_I2C or s.WARMUP_MS]
+        warm.sort(key=lambda s: -s.warmup_ms())
+        self._warm: tuple = tuple(warm)
+
+    def find(self, name: str):
+        for sensor in self.sensors:
+            if sensor.NAME == name:
+                return sensor
+        return None
+
+    def setup(self, warm_boot: bool) -> None:
+        """Initialise every sensor, the ones that fail are set up again in a later cycle"""
+        for sensor in self.sensors:
+            self._setup(sensor, warm_boot)
+
+    @staticmethod
+    def _setup(sensor: Sensor, warm_boot: bool = False) -> bool:
+        try:
+            sensor.setup(warm_boot)
+        except (OSError, RuntimeError) as e:
+            print("%s setup: %s" % (sensor.NAME, str(e)))
+            sensor.ready = False
+            sensor.breaker.failure()
+            return False
+        sensor.ready = True
+        return True
+
+    @staticmethod
+    def _read(sensor: Sensor, readings: list) -> int:
+        try:
+            valid = sensor.read(readings)
+        except (OSError, RuntimeError) as e:
+            print("%s: %s" % (sensor.NAME, str(e)))
+            sensor.valid = False
+            sensor.breaker.failure()
+            return 0
+        sensor.valid = True
+        sensor.breaker.success()
+        return valid
+
+    def settle_ms(self) -> int:
+        """Time the sensors need after a cold initialisation"""
+        ms = 0
+        for sensor in self.sensors:
+            if sensor.INIT_MS > ms:
+                ms = sensor.INIT_MS
+        return ms
+
+    def apply(self, settings) -> None:
+        for sensor in self.sensors:
+            sensor.apply(settings)
+
+    def start(self, due: bool) -> None:
+        """
+        Choose the sensors of the cycle and power the ones that must warm up.
+        Duty cycled sensors only if due, failing ones only if their breaker lets them.
+        """
+        for sensor in self.sensors:
+            sensor.active = (due or not sensor.DUTY) and sensor.breaker.allow()
+            if sensor.active and not sensor.ready:
+                # a cold setup: the state of the sensor is unknown
+                sensor.active = self._setup(sensor)
+
+        for sensor in self._warm:
+            if sensor.active:
+                try:
+                    sensor.start()
+                except (OSError, RuntimeError) as e:
+                    print("%s: %s" % (sensor.NAME, str(e)))
+                    sensor.active = False
+                    sensor.breaker.failure()
+
+    def measure(self, readings: list, due: bool) -> int:
+        """Measure every sensor and store the readings. Returns the bitmask of the valid fields"""
+        valid = 0
+
+        sensors = self._i2c
+        skip = 0
+        for i in range(len(sensors)):
+            if not sensors[i].active:
+                skip |= 1 << i
+        if skip != (1 << len(sensors)) - 1:
+            with self.audit.site("i2c"):
+                failed = self.i2c.run(self._drivers, skip)
+            for i in range(len(sensors)):
+                sensor = sensors[i]
+                sensor.valid = sensor.active and not failed & (1 << i)
+                if sensor.active and not sensor.valid:
+                    sensor.breaker.failure()
+            # after every valid flag is set: a sensor may use the readings of another one
+            for sensor in sensors:
+                if sensor.valid:
+                    valid |= self._read(sensor, readings)
+        else:
+            for sensor in sensors:
+                sensor.valid = False
+
+        for sensor in self._warm:
+            if sensor.BUS == BUS_I2C:
+                continue
+            if not sensor.active:
+                sensor.valid = False
+                continue
+            with self.audit.site(sensor.SITE):
+                valid |= self._read(sensor, readings)
+
+        return valid
+
+    def save(self, snapshot) -> None:
+        for sensor in self.sensors:
+            sensor.save(snapshot)
+
+    def restore(self, snapshot, now: int) -> None:
+        for sensor in self.sensors:
+            sensor.restore(snapshot, now)
+
+    def report_failures(self) -> None:
+        """Print the failure counters of the sensors that failed at least once"""
+        for sensor in self.sensors:
+            breaker = sensor.breaker
+            if breaker.errors:
+                print("  %s: %d errors, %d trips, %d cycles skipped%s" % (
+                    sensor.NAME, breaker.errors, breaker.trips, breaker.skipped,
+                    ", open for %d cycles" % breaker.backoff if breaker.backoff else ""
+                ))
+
+    def report_counters(self) -> None:
+        """Print the counters of the drivers"""
+        for sensor in self.sensors:
+            sensor.report()
+
+    def report(self) -> None:
+        """Print the sensors of the cycle and their metadata"""
+        for sensor in self._warm + self._i2c:
+            print("  %s: warm-up %d ms, conversion %d ms, %.2f mA" % (
+                sensor.NAME, sensor.warmup_ms(), sensor.CONVERSION_MS, sensor.POWER_MA
+            ))
@@ -0,0 +1,94 @@
+import ustruct as struct
+from micropython import const
+
+__all__ = ["Settings", "SETTINGS_VERSION"]
+
+SETTINGS_VERSION = const(1)  # version of the message and record format
+
+# version, revision, interval, pms warm-up, bmp180 mode, cpu freq, caqi window
+_RECORD = "<BHHBBIH"
+_FILE = "settings.bin"
+_U16_MAX = const(65_535)  # interval and caqi window are cached as u16: larger values would be truncated
+
+
+class Settings:
+    """
+    Runtime settings, updated from a retained MQTT message and cached in flash.
+
+    The message is a semicolon separated list of integers:
+    ``version;revision;interval;pms_warmup;bmp_mode;cpu_freq;caqi_window``, e.g.
+    ``1;3;300;30;0;64000000;3600``. A message is applied only if its revision is
+    different from the current one, at the start of the next cycle.
+    """
+
+    def __init__(self):
+        self.revision: int = 0
+        self.interval: int = 300  # seconds between two cycles
+        self.pms_warmup: int = 30  # seconds the PMS fan runs before reading
+        self.bmp_mode: int = 0  # BMP180_ULTRALOWPOWER
+        self.cpu_freq: int = 64_000_000  # Hz
+        self.caqi_window: int = 3600  # seconds averaged by the CAQI
+
+        self._pending: tuple = None
+
+    def load(self) -> bool:
+        """Load the settings cached in flash. Returns False if there are none"""
+        try:
+            with open(_FILE, "rb") as f:
+                values = struct.unpack(_RECORD, f.read())
+        except (OSError, ValueError):
+            return False
+
+        if values[0] != SETTINGS_VERSION:
+            return False
+
+        self._set(values)
+        return True
+
+    def save(self) -> None:
+        """Cache the settings in flash"""
+        try:
+            with open(_FILE, "wb") as f:
+                f.write(struct.pack(
+                    _RECORD, SETTINGS_VERSION, self.revision, self.interval, self.pms_warmup,
+                    self.bmp_mode, self.cpu_freq, self.caqi_window
+                ))
+        except OSError:
+            print("Impossible to save settings!")
+
+    def on_message(self, topic: bytes, msg: bytes) -> None:
+        """MQTT callback: parse the message and keep it for the next cycle if it has a new revision"""
+        try:
+            values = tuple(int(v) for v in msg.split(b";"))
+        except ValueError:
+            print("Invalid settings message")
+            return
+
+        if len(values) != 7 or values[0] != SETTINGS_VERSION:
+            print("Unsupported settings version")
+            return
+
+        if values[1] == self.revision:
+            return
+
+        _, _, interval, warmup, mode, freq, window = values
+        if interval < 10 or not 0 <= warmup <= 120 or not 0 <= mode <= 3 \
+                or not 48_000_000 <= freq <= 133_000_000 or not interval <= window <= _U16_MAX:
+            print("Settings out of range")
+            return
+
+        self._pending = values
+
+    def apply_pending(self) -> bool:
+        """Apply the settings received since the last call. Returns True if they changed"""
+        if self._pending is None:
+            return False
+
+        self._set(self._pending)
+        self._pending = None
+        self.save()
+        print("Settings updated to revision %d" % self.revision)
+        return True
+
+    def _set(self, values: tuple) -> None:
+        _, self.revision, self.interval, self.pms_warmup, self.bmp_mode, self.cpu_freq, self.caqi_window = values
@@ -21,6 +21,7 @@
 # THE SOFTWARE.
 
 import math
+from binascii import unhexlify
 from time import sleep_ms
 
 import micropython
@@ -37,6 +38,107 @@ _SGP30_CRC8_POLYNOMIAL: int = const(0x31)
 _SGP30_CRC8_INIT: int = const(0xFF)
 _SGP30_WORD_LEN: int = const(2)
 
+# Absolute humidity per 0.1 % RH (g/m3 * 256 / 1000 * 2^27) from -40 to 50 degrees Celsius, every 0.1 degree: one
+# 32-bit big-endian entry per temperature, one line per degree. Computed with the formula of "Generic SGP Driver
+# Integration for Software I2C" (see set_iaq_rel_humidity) in doubles; where the double result of the formula falls on
+# the other side of an integer, the entry is moved by one unit, so that set_iaq_rel_humidity_fixed() sends the same
+# value as set_iaq_rel_humidity() for every input in 0.1 steps (the host check "sgp30-humidity" verifies it).
+_AH_TABLE: bytes = unhexlify(
+    "005cb08e005d9dd0005e8d32005f7eba0060726b0061684b0062605d00635aa70064572c006555f0"  # -40
+    "006656f900675a4b00685feb006967dd006a7225006b7ec9006c8dcd006d9f36006eb309006fc94a"  # -39
+    "0070e1fe0071fd2a00731ad300743afe00755db0007682ed0077aabc0078d520007a021f007b31be"  # -38
+    "007c6402007d98f1007ed08f00800ae2008147ef008287bb0083ca4d00850fa8008657d30087a2d2"  # -37
+    "0088f0ac008a4167008b9506008ceb91008e450d008fa17f009100ed0092635d0093c8d50095315a"  # -36
+    "00969cf200980ba300997d74009af26a009c6a8a009de5dc009f646500a0e62b00a26b3400a3f388"  # -35
+    "00a57f2a00a70e2300a8a07900aa363100abcf5200ad6be300af0be900b0af6c00b2567200b40102"  # -34
+    "00b5af2200b760d900b9162d00bacf2600bc8bca00be4c2000c0102f00c1d7fd00c3a39200c572f5"  # -33
+    "00c7462d00c91d4000caf83600ccd71700ceb9e900d0a0b300d28b7e00d47a4f00d66d2f00d86426"  # -32
+    "00da5f3900dc5e7200de61d800e0697200e2754700e4856100e699c500e8b27d00eacf9000ecf106"  # -31
+    "00ef16e700f1413a00f3700900f5a35a00f7db3700fa17a700fc58b200fe9e610100e8bc010337cc"  # -30
+    "01058b990107e42b010a418b010ca3c1010f0ad6011176d40113e7c101165da80118d892011b5886"  # -29
+    "011ddd8e012067b30122f6fd01258b7701282529012ac41c012d685a013011ec0132c0da01357530"  # -28
+    "01382ef5013aee35013db2f701407d4601434d2b014622b10148fde1014bdec4014ec5650151b1ce"  # -27
+    "0154a40801579c1f015a9a1b015d9e070160a7ed0163b7d80166cdd20169e9e5016d0c1c01703481"  # -26
+    "0173631f017698010179d331017d14ba01805ca70183ab030186ffd8018a5b33018dbd1d019125a1"  # -25
+    "019494cc01980aa9019b8742019f0aa301a294d701a625eb01a9bde901ad5cdd01b102d301b4afd7"  # -24
+    "01b863f401bc1f3601bfe1aa01c3ab5b01c77c5601cb54a601cf345801d31b7701d70a1201db0033"  # -23
+    "01defde701e3033b01e7103b01eb24f501ef417401f365c701f791f801fbc6160200022e0204464c"  # -22
+    "0208927e020ce6d1021143530215a810021a1516021e8a730223083402278e67022c1d1a0230b45a"  # -21
+    "023554360239fcbb023eadf7024367f802482acd024cf6840251cb2b0256a8d0025b8f8202607f50"  # -20
+    "02657848026a7a79026f85f202749ac00279b8f5027ee09d028411ca02894c88028e90e90293defb"  # -19
+    "029936cd029e986f02a403f102a9796202aef8d202b4825102ba15ee02bfb3ba02c55bc402cb0e1d"  # -18
+    "02d0cad502d691fc02dc63a302e23fd902e826b002ee183802f4148202fa1b9e03002d9e03064a92"  # -17
+    "030c728c0312a59b0318e3d3031f2d44032581ff032be21503324d990338c49c033f47300345d566"  # -16
+    "034c6f51035315020359c68c0360840003674d71036e22f103750493037bf2690382ec860389f2fd"  # -15
+    "039105df03982541039f513503a689cf03adcf2003b5213e03bc803a03c3ec2903cb651e03d2eb2c"  # -14
+    "03da7e6803e21ee503e9ccb703f187f303f950ab040126f504090ae50410fc8f0418fc0704210963"  # -13
+    "042924b704314e17043985990441cb52044a1f57045281bc045af298046371ff046c000704749cc6"  # -12
+    "047d4852048602c0048ecc260497a49a04a08c3204a9830504b2892804bb9eb304c4c3bb04cdf858"  # -11
+    "04d73ca004e090aa04e9f48c04f3685f04fcec39050680310510245f0519d8da05239dba052d7316"  # -10
+    "0537590705414fa5054b570605556f44055f98770569d2b705741e1c057e7abf0588e8ba05936824"  # -9
+    "059df91605a89bab05b34ffa05be161d05c8ee2d05d3d84505ded47c05e9e2ef05f503b5060036e9"  # -8
+    "060b7ca60616d50406224020062dbe1206394ef60644f2e70650a9fe065c74580668520e0674433c"  # -7
+    "068047fe068c606f06988caa06a4cccb06b120ed06bd892d06ca05a606d6967606e33bb706eff586"  # -6
+    "06fcc4000709a74107169f670723ac8d0730ced1073e0651074b53290758b57607662d570773bae8"  # -5
+    "07815e48078f1794079ce6eb07aacc6b07b8c83107c6da5d07d5030d07e3425f07f1987208000566"  # -4
+    "080e8959081d246a082bd6ba083aa0660849819008587a5608678ad90876b3380885f39408954c0c"  # -3
+    "08a4bcc308b445d608c3e76908d3a19b08e3748d08f3606109036537091383320923ba7209340b1a"  # -2
+    "0944754a0954f926096596ce09764e660987201009980bee09a9122309ba32d109cb6e1c09dcc427"  # -1
+    "09ee351509ffc1090a1168270a232a920a35086f0a4701e10a59170d0a6b48160a7d95210a8ffe53"  # 0
+    "0aa283d00ab525be0ac7e4410adabf7e0aedb79b0b00ccbd0b13ff0a0b274ea80b3abbbc0b4e466c"  # 1
+    "0b61eedf0b75b53c0b8999a80b9d9c4b0bb1bd4a0bc5fcce0bda5afe0beed8000c0373fc0c182f1b"  # 2
+    "0c2d09820c42035c0c571ccf0c6c56040c81af230c9728550cacc1c30cc27b960cd855f60cee510e"  # 3
+    "0d046d050d1aaa070d31083c0d4787ce0d5e28e80d74ebb40d8bd05c0da2d70a0db9ffea0dd14b27"  # 4
+    "0de8b8ea0e0049600e17fcb40e2fd3120e47cca40e5fe9980e782a190e908e530ea916730ec1c2a6"  # 5
+    "0eda93170ef387f50f0ca16b0f25dfa80f3f42d90f58cb2b0f7278cd0f8c4beb0fa644b50fc06358"  # 6
+    "0fdaa8040ff512e6100fa42e102a5c0a10453aaa1060403e107b6cf41096c0fc10b23c8710cddfc5"  # 7
+    "10e9aae511059e181121b98f113dfd7b115a6a0d1176ff751193bde611b0a59011cdb6a611eaf159"  # 8
+    "120855dc1225e46112439d1a1261803b127f8df5129dc67c12bc2a0312dab8be12f972e01318589d"  # 9
+    "13376a291356a7b81376117e1395a7b113b56a8513d55a2f13f576e31415c0d8143638431456dd59"  # 10
+    "1477b0511498b16114b9e0be14db3ea014fccb3e151e86cc1540718515628b9e1584d54f15a74ed0"  # 11
+    "15c9f85815ecd221160fdc61163317511656832b167a2027169dee7f16c1ee6b16e62025170a83e7"  # 12
+    "172f19ea1753e26a1778dda0179e0bc617c36d1817e901d1180eca2b1834c663185af6b318815b57"  # 13
+    "18a7f48c18cec28e18f5c599191cfde919446bbc196c0f4f1993e8df19bbf8a919e43eeb1a0cbbe3"  # 14
+    "1a356fd01a5e5aef1a877d7f1ab0d7bf1ada69ed1b04344a1b2e37141b58728c1b82e6f01bad9482"  # 15
+    "1bd87b811c039c2d1c2ef6c91c5a8b941c865ad01cb264be1cdea9a01d0b29b81d37e5481d64dc92"  # 16
+    "1d920fd81dbf7f5e1ded2b661e1b14341e493a0b1e779d2e1ea63de21ed51c6b1f04390c1f33940c"  # 17
+    "1f632dae1f9306371fc31ded1ff3751520240bf52054e2d22085f9f420b751a120e8ea1e211ac3b4"  # 18
+    "214cdea9217f3b4421b1d9ce21e4ba8d2217ddca224b43ce227eece122b2d94b22e70956231b7d4b"  # 19
+    "235035732385321923ba738623effa042425c5de245bd75f24922ed124c8cc7f24ffb0b62536dbc1"  # 20
+    "256e4dec25a6078225de08d126165225264ee3ca2687be0f26c0e14026fa4dab2734039f276e0368"  # 21
+    "27a84d5627e2e1b8281dc0db2858eb10289460a528d021eb290c2f30294888c729852efe29c22226"  # 22
+    "29ff62912a3cf0902a7acc742ab8f68e2af76f312b3636af2b754d5a2bb4b3862bf469842c346fa9"  # 23
+    "2c74c6472cb56db32cf666412d37b0442d794c122dbb3a002dfd7a612e400d8c2e82f3d72ec62d96"  # 24
+    "2f09bb212f4d9ccd2f91d2f22fd65de6301b3e003060739830a5ff0630ebe0a1313218c23178a7c2"  # 25
+    "31bf8df93206cbc0324e617132964f6532de95f63327357f33702e5933b980e034032d6f344d3460"  # 26
+    "3497960f34e252d9352d6b183578df2a35c4af6c3610dc39365d65f036aa4cee36f7919037453435"  # 27
+    "3793353b37e19500383053e4387f724538cef083391ecefe396f0e1639bfae2b3a10af9d3a6212ce"  # 28
+    "3ab3d81f3b05fff03b588aa53bab789e3bfeca3e3c527fe83ca699ff3cfb18e53d4ffcff3da546af"  # 29
+    "3dfaf65a3e510c653ea789343efe6d2b3f55b8b03fad6c29400587fc405e0c8d40b6fa4441105188"  # 30
+    "416a12bf41c43e51421ed4a54279d62342d5433343311c3e438d61ad43ea13e84447335844a4c069"  # 31
+    "4502bb824561251045bffd7b461f4530467efc9946df2421473fbc3547a0c54148023fb148642bf1"  # 32
+    "48c68a6f49295b98498c9fd949f057a04a54835d4ab9237c4b1e386d4b83c2a04be9c2834c503886"  # 33
+    "4cb7251a4d1e88af4d8663b54deeb69d4e5781da4ec0c5dc4f2a83154f94b9f84fff6af7506a9685"  # 34
+    "50d63d1551425f1c51aefd0c521c175a5289ae7a52f7c2e25366550653d5655b5444f45854b50272"  # 35
+    "5525902055969dd956082c14567a3b4756eccbec575fde7957d3736758478b2f58bc264959314530"  # 36
+    "59a6e85c5a1d10475a93bd6d5b0af0475b82a9505bfae9045c73afdf5cecfe5b5d66d4f65de1342c"  # 37
+    "5e5c1c7a5ed78e5e5f538a545fd010db604d227060cabf946148e8c361c79e7f6246e14662c6b198"  # 38
+    "63470ff563c7fcde644978d564cb845a654e1fee65d14c146655094f66d95820675e390a67e3ac92"  # 39
+    "6869b33a68f04d8669777bfc69ff3f1f6a8797746b1085826b9a09cd6c2424dc6caed7346d3a215d"  # 40
+    "6dc603df6e527f3f6edf94066f6d42bd6ffb8bea708a70197119efd171aa0b9b723ac40372cc1992"  # 41
+    "735e0cd273f09e4f7483ce9375179e2b75ac0da376411d8676d6ce61776d20c278041535789bac49"  # 42
+    "7933e68b79ccc48b7a6646d67b006dfc7b9b3a8c7c36ad177cd2c62c7d6f865d7e0cee397eaafe53"  # 43
+    "7f49b73c7fe91986808925c38129dc8681cb3e63826d4bed831005b783b36c558457805e84fc4264"  # 44
+    "85a1b2fe8647d2c186eea2438796221b883e52df88e735278990c98a8a3b109f8ae60aff8b91b943"  # 45
+    "8c3e1c048ceb33db8d9901618e4785318ef6bfe48fa6b21790575c649108bf6791badbbb926db1fd"  # 46
+    "932142ca93d58ebe948a967795405a9495f6dbb196ae1a6e97661769981ed34298d84e9999928a0e"  # 47
+    "9a4d86409b0943d19bc5c3639c8305959d410b0c9dffd4689ebf624e9f7fb55fa040ce3fa102ad92"  # 48
+    "a1c553fda288c223a34cf8aba411f839a4d7c174a59e5500a665b386a72dddaca7f6d419a8c09775"  # 49
+    "a98b2868"  # 50
+)
+_AH_T0: int = const(-400)  # temperature of the first entry (0.1 degree)
+_AH_SHIFT: int = const(27)  # fractional bits of the entries
+
 
 class SGP30:
     """
@@ -44,20 +146,33 @@ class SGP30:
 
     :param i2c: The `I2C` object to use. This is the only required parameter.
     :param int address: (optional) The I2C address of the device.
+    :param bool init: (optional) Initialize the IAQ algorithm, set it to False if the sensor is already running.
     """
 
-    def __init__(self, i2c: I2C, address: int = _SGP30_DEFAULT_I2C_ADDR):
+    def __init__(self, i2c: I2C, address: int = _SGP30_DEFAULT_I2C_ADDR, init: bool = True):
         """Initialize the sensor, get the serial # and verify that we found a proper SGP30"""
         self._i2c = i2c
         self._addr: int = address
 
+        # preallocated reply buffers and result lists, indexed by reply size
+        self._replies: tuple = tuple(bytearray(n * (_SGP30_WORD_LEN + 1)) for n in range(4))
+        self._words: tuple = tuple([0] * n for n in range(4))
+
+        # results of the last convert() measurement
+        self.last_co2eq: int = 0
+        self.last_tvoc: int = 0
+
+        # preallocated humidity command: command, value, CRC
+        self._humidity_cmd: bytearray = bytearray(b"\x20\x61\0\0\0")
+
         # get unique serial, its 48 bits, so we store in an array
-        self.serial = self._i2c_read_words_from_cmd([0x36, 0x82], 10, 3)
+        self.serial = list(self._i2c_read_words_from_cmd(b"\x36\x82", 10, 3))
         # get featureset
-        featureset = self._i2c_read_words_from_cmd([0x20, 0x2f], 10, 1)
+        featureset = self._i2c_read_words_from_cmd(b"\x20\x2f", 10, 1)
         if featureset[0] not in [_SGP30_FEATURESET_0, _SGP30_FEATURESET_1]:
             raise RuntimeError('SGP30 Not detected')
-        self.iaq_init()
+        if init:
+            self.iaq_init()
 
     @property
     def tvoc(self) -> int:
@@ -81,16 +196,27 @@ class SGP30:
 
     def iaq_init(self) -> None:
         """Initialize the IAQ algorithm"""
-        self._i2c_read_words_from_cmd([0x20, 0x03], 10, 0)
+        self._i2c_read_words_from_cmd(b"\x20\x03", 10, 0)
 
     def iaq_measure(self) -> list[int]:
         """Measure the CO2eq and TVOC"""
         # name, command, signals, delay
-        return self._i2c_read_words_from_cmd([0x20, 0x08], 50, 2)
+        return self._i2c_read_words_from_cmd(b"\x20\x08", 50, 2)
+
+    def convert(self, step: int) -> int:
+        """Run a step of a non-blocking measurement (see I2CBus.run). Returns the ms to wait or -1 when done"""
+        if step == 0:
+            self._i2c.writeto(self._addr, b"\x20\x08")
+            return 12  # maximum measurement duration from the datasheet
+
+        result = self._i2c_read_words(2)
+        self.last_co2eq = result[0]
+        self.last_tvoc = result[1]
+        return -1
 
     def get_iaq_baseline(self) -> list[int]:
         """Retrieve the IAQ algorithm baseline for CO2eq and TVOC"""
-        return self._i2c_read_words_from_cmd([0x20, 0x15], 10, 2)
+        return self._i2c_read_words_from_cmd(b"\x20\x15", 10, 2)
 
     def set_iaq_baseline(self, co2eq: int, tvoc: int) -> None:
         """Set the previously recorded IAQ algorithm baseline for CO2eq and TVOC"""
@@ -103,7 +229,7 @@ class SGP30:
             arr.append(self._generate_crc(arr))
             buffer += arr
 
-        self._i2c_read_words_from_cmd([0x20, 0x1e] + buffer, 10, 0)
+        self._i2c_read_words_from_cmd(bytes([0x20, 0x1e] + buffer), 10, 0)
 
     @micropython.native
     def set_iaq_rel_humidity(self, rh: float, temp: float) -> None:
@@ -114,46 +240,80 @@ class SGP30:
 
         self.set_iaq_humidity(grams_pm3)
 
+    @micropython.native
+    def set_iaq_rel_humidity_fixed(self, rh: int, temp: int) -> None:
+        """
+        Set the relative humidity for eCO2 and TVOC compensation algorithm, without floats.
+        rh is in 0.1 % (clamped between 0 and 100 %), temp in 0.1 degree Celsius (clamped between -40 and 50 degrees).
+        The value sent is the one of set_iaq_rel_humidity(rh / 10, temp / 10) with doubles.
+        """
+        if temp < -400:
+            temp = -400
+        elif temp > 500:
+            temp = 500
+        if rh < 0:
+            rh = 0
+        elif rh > 1000:
+            rh = 1000
+
+        table = _AH_TABLE
+        i = (temp - _AH_T0) * 4
+        # rh * entry >> 27 in two halves of 16 bits, so that the products stay small ints
+        high = table[i] << 8 | table[i + 1]
+        low = table[i + 2] << 8 | table[i + 3]
+        self._set_humidity((rh * high + ((rh * low) >> 16)) >> (_AH_SHIFT - 16))
+
     def set_iaq_humidity(self, grams_pm3: float) -> None:
         """Set the humidity in g/m3 for eCO2 and TVOC compensation algorithm"""
-        tmp = int(grams_pm3 * 256)
-        buffer = []
-        for value in [tmp]:
-            # noinspection PyListCreation
-            arr = [value >> 8, value & 0xFF]
-            arr.append(self._generate_crc(arr))
-            buffer += arr
+        self._set_humidity(int(grams_pm3 * 256))
 
-        self._i2c_read_words_from_cmd([0x20, 0x61] + buffer, 10, 0)
+    @micropython.native
+    def _set_humidity(self, value: int) -> None:
+        """Send the absolute humidity as a 8.8 fixed point number (g/m3 * 256)"""
+        if value > 0xFFFF:
+            value = 0xFFFF
+        cmd = self._humidity_cmd
+        cmd[2] = value >> 8
+        cmd[3] = value & 0xFF
+        cmd[4] = self._generate_crc(cmd, 2, 2)
+        self._i2c_read_words_from_cmd(cmd, 10, 0)
 
     @micropython.native
-    def _i2c_read_words_from_cmd(self, command: list[int], delay: int, reply_size: int) -> list[int]:
-        """Run an SGP command query, get a reply and CRC results if necessary"""
-        self._i2c.writeto(self._addr, bytes(command))
+    def _i2c_read_words_from_cmd(self, command: bytes, delay: int, reply_size: int) -> list[int]:
+        """
+        Run an SGP command query, get a reply and CRC results if necessary.
+        The returned list is reused by the next command with the same reply size.
+        """
+        self._i2c.writeto(self._addr, command)
         sleep_ms(delay)
+        return self._i2c_read_words(reply_size)
+
+    @micropython.native
+    def _i2c_read_words(self, reply_size: int) -> list[int]:
+        """Read the reply of a command and check its CRC"""
+        result = self._words[reply_size]
         if not reply_size:
-            return []
-        crc_result = bytearray(reply_size * (_SGP30_WORD_LEN + 1))
+            return result
+        crc_result = self._replies[reply_size]
         self._i2c.readfrom_into(self._addr, crc_result)
         # print("\tRaw Read: ", crc_result)
-        result = []
         for i in range(reply_size):
-            word = [crc_result[3 * i], crc_result[3 * i + 1]]
-            crc = crc_result[3 * i + 2]
-            if self._generate_crc(word) != crc:
+            if self._generate_crc(crc_result, 3 * i, _SGP30_WORD_LEN) != crc_result[3 * i + 2]:
                 raise RuntimeError("CRC Error")
-            result.append(word[0] << 8 | word[1])
+            result[i] = crc_result[3 * i] << 8 | crc_result[3 * i + 1]
         # print("\tOK Data: ", [hex(i) for i in result])
         return result
 
     @staticmethod
     @micropython.native
-    def _generate_crc(data) -> int:
+    def _generate_crc(data, start: int = 0, length: int = -1) -> int:
         """8-bit CRC algorithm for checking data"""
+        if length < 0:
+            length = len(data)
         crc = _SGP30_CRC8_INIT
         # calculates 8-Bit checksum with given polynomial
-        for byte in data:
-            crc ^= byte
+        for i in range(start, start + length):
+            crc ^= data[i]
             for _ in range(8):
                 if crc & 0x80:
                     crc = (crc << 1) ^ _SGP30_CRC8_POLYNOMIAL
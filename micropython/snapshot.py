@@ -0,0 +1,83 @@
+import os
+
+import ustruct as struct
+from binascii import crc32
+from micropython import const
+
+__all__ = ["Snapshot", "SNAPSHOT_VERSION"]
+
+SNAPSHOT_VERSION = const(1)
+
+# version,
+# bmp180 calibration (AC1-AC6, B1, B2, MB, MC, MD),
+# sgp30 baselines (co2eq, tvoc) and uptime,
+# seconds since the last sgp30 baseline save,
+# caqi accumulators (pm2.5 sum, pm10 sum, values, seconds since the window started),
+# cycle sequence, block sequence, mqtt packet id
+_RECORD = "<BhhhHHHhhhhhHHIIIIHIIHH"
+_RECORD_SIZE = const(57)
+_FILE = "snapshot.bin"
+
+
+class Snapshot:
+    """
+    State of the drivers saved in a single CRC protected flash record before a reset,
+    so that the next boot can skip the slow initialisation of the sensors.
+
+    Times are stored as elapsed seconds, since the clock doesn't survive the reset.
+    A snapshot is used only once: load() removes the record.
+    """
+
+    def __init__(self):
+        self.bmp180: tuple = (0,) * 11  # all zero if there is no BMP180
+        self.co2eq_baseline: int = 0
+        self.tvoc_baseline: int = 0
+        self.sgp30_uptime: int = 0
+        self.baseline_elapsed: int = 0
+        self.pm25_sum: int = 0
+        self.pm100_sum: int = 0
+        self.pm_values: int = 0
+        self.caqi_elapsed: int = 0
+        self.cycle_seq: int = 0
+        self.block_seq: int = 0
+        self.mqtt_pid: int = 0
+
+    def save(self) -> None:
+        record = bytearray(_RECORD_SIZE + 4)
+        struct.pack_into(
+            _RECORD, record, 0, SNAPSHOT_VERSION, *self.bmp180,
+            self.co2eq_baseline, self.tvoc_baseline, self.sgp30_uptime, self.baseline_elapsed,
+            self.pm25_sum, self.pm100_sum, self.pm_values, self.caqi_elapsed,
+            self.cycle_seq, self.block_seq, self.mqtt_pid
+        )
+        struct.pack_into("<I", record, _RECORD_SIZE, crc32(memoryview(record)[:_RECORD_SIZE]))
+
+        with open(_FILE, "wb") as f:
+            f.write(record)
+
+    def load(self) -> bool:
+        """Load and remove the snapshot. Returns False if there is none or it's corrupted"""
+        try:
+            with open(_FILE, "rb") as f:
+                record = f.read()
+            os.remove(_FILE)
+        except OSError:
+            return False
+
+        if len(record) != _RECORD_SIZE + 4:
+            return False
+        if struct.unpack_from("<I", record, _RECORD_SIZE)[0] != crc32(memoryview(record)[:_RECORD_SIZE]):
+            print("Snapshot CRC error")
+            return False
+
+        values = struct.unpack_from(_RECORD, record)
+        if values[0] != SNAPSHOT_VERSION:
+            return False
+
+        self.bmp180 = values[1:12]
+        (
+            self.co2eq_baseline, self.tvoc_baseline, self.sgp30_uptime, self.baseline_elapsed,
+            self.pm25_sum, self.pm100_sum, self.pm_values, self.caqi_elapsed,
+            self.cycle_seq, self.block_seq, self.mqtt_pid
+        ) = values[12:]
+        return True
@@ -0,0 +1,237 @@
+import _thread
+import os
+
+import micropython
+import ustruct as struct
+from micropython import const
+from utime import time, ticks_ms, ticks_diff
+
+__all__ = [
+    "TraceWriter", "TraceI2C", "TraceUART", "TRACE_MAGIC", "TRACE_VERSION",
+    "REC_I2C_WRITE", "REC_I2C_READ", "REC_I2C_MEM_WRITE", "REC_I2C_MEM_READ", "REC_I2C_ERROR",
+    "REC_UART_RX", "REC_UART_TX", "REC_BOOT", "REC_CYCLE",
+]
+
+TRACE_MAGIC = b"ST"
+TRACE_VERSION = const(1)
+
+# file header: magic, version, reserved
+_HEADER = "<2sBB"
+_HEADER_SIZE = const(4)
+
+# record: kind, I2C address or UART id, register (or errno), data length, ms since the boot
+_RECORD = "<BBBHI"
+_RECORD_SIZE = const(9)
+
+# Kinds of record
+REC_I2C_WRITE = const(1)  # writeto(): the bytes written
+REC_I2C_READ = const(2)  # readfrom_into(): the bytes read
+REC_I2C_MEM_WRITE = const(3)  # writeto_mem(): the bytes written to the register
+REC_I2C_MEM_READ = const(4)  # readfrom_mem(), readfrom_mem_into(): the bytes read from the register
+REC_I2C_ERROR = const(5)  # a transaction failed: errno in the register field, the kind of transaction as data
+REC_UART_RX = const(6)  # bytes received
+REC_UART_TX = const(7)  # bytes sent
+REC_BOOT = const(8)  # start of a boot: time() (u32) and warm boot flag (u8)
+REC_CYCLE = const(9)  # start of a cycle: sequence number (u32)
+
+
+class TraceWriter:
+    """
+    Recorder of the raw sensor traffic, replayed on the host by ``scripts/trace_replay.py``.
+
+    Records are staged in a RAM buffer and appended to the trace file by flush(), once
+    per cycle, so that recording doesn't touch the flash while the sensors are measured.
+    The buffer is protected by a lock taken without waiting: a record that arrives while
+    another one is being written (UART handler, second core) is dropped and counted.
+
+    :param str path: trace file, created with its header if it doesn't exist
+    :param int size: bytes of the RAM buffer, records that don't fit are dropped
+    :param int limit: maximum size of the trace file, recording stops when it's reached
+    :param bool warm_boot: the sensors kept their state from the previous boot
+    """
+
+    def __init__(self, path: str = "trace.bin", size: int = 4096, limit: int = 1_000_000, warm_boot: bool = False):
+        self.path: str = path
+        self.limit: int = limit
+        self.dropped: int = 0  # records lost
+
+        self._buf: bytearray = bytearray(size)
+        self._pos: int = 0
+        self._lock = _thread.allocate_lock()
+
+        # 32-bit ms clock, advanced at every record so that ticks_ms() never wraps between two of them
+        self._elapsed: int = 0
+        self._last: int = ticks_ms()
+
+        try:
+            self.written: int = os.stat(path)[6]
+        except OSError:
+            header = bytearray(_HEADER_SIZE)
+            struct.pack_into(_HEADER, header, 0, TRACE_MAGIC, TRACE_VERSION, 0)
+            with open(path, "wb") as f:
+                f.write(header)
+            self.written = _HEADER_SIZE
+
+        self._word = bytearray(5)
+        struct.pack_into("<IB", self._word, 0, time(), 1 if warm_boot else 0)
+        self.record(REC_BOOT, 0, 0, self._word)
+
+    @micropython.native
+    def record(self, kind: int, addr: int, reg: int, data, length: int = -1) -> None:
+        if length < 0:
+            length = len(data)
+        if not self._lock.acquire(0):
+            self.dropped += 1
+            return
+
+        buf = self._buf
+        pos = self._pos
+        if pos + _RECORD_SIZE + length > len(buf) or self.written + pos > self.limit:
+            self.dropped += 1
+        else:
+            now = ticks_ms()
+            self._elapsed = (self._elapsed + ticks_diff(now, self._last)) & 0xFFFFFFFF
+            self._last = now
+            struct.pack_into(_RECORD, buf, pos, kind, addr, reg, length, self._elapsed)
+            pos += _RECORD_SIZE
+            # byte by byte: a slice would allocate
+            for i in range(length):
+                buf[pos + i] = data[i]
+            self._pos = pos + length
+
+        self._lock.release()
+
+    def cycle(self, seq: int) -> None:
+        """Mark the start of a cycle"""
+        struct.pack_into("<I", self._word, 0, seq)
+        self.record(REC_CYCLE, 0, 0, self._word, 4)
+
+    def flush(self) -> None:
+        """Append the buffered records to the trace file"""
+        self._lock.acquire()
+        try:
+            if self._pos:
+                with open(self.path, "ab") as f:
+                    f.write(memoryview(self._buf)[:self._pos])
+                self.written += self._pos
+                self._pos = 0
+        finally:
+            self._lock.release()
+
+
+class TraceI2C:
+    """
+    I2C bus (or `I2CBus`) wrapper that records every transaction of the drivers.
+
+    Failures are recorded after the retries of the wrapped bus, as the drivers see them.
+
+    :param i2c: the bus
+    :param TraceWriter trace: the recorder
+    """
+
+    def __init__(self, i2c, trace: TraceWriter):
+        self.i2c = i2c
+        self.trace: TraceWriter = trace
+        self._kind = bytearray(1)
+
+    def _error(self, addr: int, kind: int, e: OSError) -> None:
+        self._kind[0] = kind
+        self.trace.record(REC_I2C_ERROR, addr, e.errno & 0xFF if isinstance(e.errno, int) else 0, self._kind)
+
+    def writeto(self, addr: int, buf) -> None:
+        try:
+            self.i2c.writeto(addr, buf)
+        except OSError as e:
+            self._error(addr, REC_I2C_WRITE, e)
+            raise
+        self.trace.record(REC_I2C_WRITE, addr, 0, buf)
+
+    def readfrom_into(self, addr: int, buf) -> None:
+        try:
+            self.i2c.readfrom_into(addr, buf)
+        except OSError as e:
+            self._error(addr, REC_I2C_READ, e)
+            raise
+        self.trace.record(REC_I2C_READ, addr, 0, buf)
+
+    def readfrom_mem(self, addr: int, memaddr: int, nbytes: int) -> bytes:
+        try:
+            data = self.i2c.readfrom_mem(addr, memaddr, nbytes)
+        except OSError as e:
+            self._error(addr, REC_I2C_MEM_READ, e)
+            raise
+        self.trace.record(REC_I2C_MEM_READ, addr, memaddr, data)
+        return data
+
+    def readfrom_mem_into(self, addr: int, memaddr: int, buf) -> None:
+        try:
+            self.i2c.readfrom_mem_into(addr, memaddr, buf)
+        except OSError as e:
+            self._error(addr, REC_I2C_MEM_READ, e)
+            raise
+        self.trace.record(REC_I2C_MEM_READ, addr, memaddr, buf)
+
+    def writeto_mem(self, addr: int, memaddr: int, buf) -> None:
+        try:
+            self.i2c.writeto_mem(addr, memaddr, buf)
+        except OSError as e:
+            self._error(addr, REC_I2C_MEM_WRITE, e)
+            raise
+        self.trace.record(REC_I2C_MEM_WRITE, addr, memaddr, buf)
+
+
+class TraceUART:
+    """
+    UART wrapper that records the byte stream received and sent by a driver.
+
+    The RX interrupt is forwarded with the wrapper as argument, so the reads of the handler are recorded too.
+
+    :param uart: the UART
+    :param TraceWriter trace: the recorder
+    :param int uart_id: id of the UART in the records
+    """
+
+    def __init__(self, uart, trace: TraceWriter, uart_id: int = 0):
+        self.uart = uart
+        self.trace: TraceWriter = trace
+        self.uart_id: int = uart_id
+        self._handler = None
+        self._on_irq = self._irq  # preallocated bound method for the interrupt
+        if hasattr(uart, "IRQ_RXIDLE"):
+            self.IRQ_RXIDLE = uart.IRQ_RXIDLE
+
+    def init(self, *args, **kwargs) -> None:
+        self.uart.init(*args, **kwargs)
+
+    def any(self) -> int:
+        return self.uart.any()
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.uart.read() if n < 0 else self.uart.read(n)
+        if data:
+            self.trace.record(REC_UART_RX, self.uart_id, 0, data)
+        return data
+
+    def readinto(self, buf, n: int = -1) -> int:
+        n = self.uart.readinto(buf) if n < 0 else self.uart.readinto(buf, n)
+        if n:
+            self.trace.record(REC_UART_RX, self.uart_id, 0, buf, n)
+        return n
+
+    def write(self, buf) -> int:
+        n = self.uart.write(buf)
+        self.trace.record(REC_UART_TX, self.uart_id, 0, buf)
+        return n
+
+    def flush(self) -> None:
+        self.uart.flush()
+
+    def _irq(self, _uart) -> None:
+        self._handler(self)
+
+    def irq(self, handler=None, trigger: int = 0) -> None:
+        self._handler = handler
+        if handler is None:
+            self.uart.irq(None)
+        else:
+            self.uart.irq(self._on_irq, trigger)
@@ -0,0 +1,385 @@
+import argparse
+import csv
+import os
+import sys
+import time
+import warnings
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+import numpy as np
+
+from tsstore import Store
+
+
+# Valid range of every field, in the units published by the firmware
+RANGES = {
+    "temperature": (-40.0, 85.0),  # °C, AHT20
+    "humidity": (0.0, 100.0),  # %
+    "pressure": (30_000.0, 110_000.0),  # Pa, BMP180
+    "eco2": (400.0, 60_000.0),  # ppm, SGP30
+    "tvoc": (0.0, 60_000.0),  # ppb, SGP30
+    "caqi": (0.0, 500.0),
+    "pm01": (0.0, 1_000.0),  # ug/m3, PMS7003
+    "pm25": (0.0, 1_000.0),
+    "pm100": (0.0, 1_000.0),
+    "vsys": (2_500.0, 5_500.0),  # mV
+}
+
+# Minimum duration (s) of a run of identical values reported as stuck. Quantised fields of a quiet room
+# can legitimately stay the same for a while, the PMS reads 0 for hours only if the fan stopped.
+STUCK_SECONDS = {
+    "temperature": 6 * 3600,
+    "humidity": 6 * 3600,
+    "pressure": 3 * 3600,
+    "eco2": 6 * 3600,
+    "tvoc": 6 * 3600,
+    "pm01": 12 * 3600,
+    "pm25": 12 * 3600,
+    "pm100": 12 * 3600,
+}
+
+# Change between the means of two consecutive windows reported as a step
+STEPS = {
+    "temperature": 3.0,
+    "humidity": 15.0,
+    "pressure": 500.0,
+    "eco2": 800.0,
+    "tvoc": 500.0,
+    "pm25": 50.0,
+    "pm100": 80.0,
+}
+STEP_WINDOW = 6  # points of every window (30 min at the default interval)
+
+# Cross-box divergence, on the hourly rollups: robust z-score against the fleet median
+# (detector, z-score, hours): at least 3/4 of the hours of a window must be over the z-score.
+# A drift, like the SGP30 baseline, is a smaller offset that lasts days.
+DIVERGENCE = (
+    ("divergence", 4.0, 24),
+    ("drift", 2.0, 7 * 24),
+)
+DIVERGENCE_CHUNK = 31 * 24  # hours of every fleet median
+DIVERGENCE_FIELDS = ("temperature", "humidity", "pressure", "eco2", "tvoc", "pm25")
+
+CHUNK = 1 << 20  # points read at once from a series
+
+
+@dataclass
+class Event:
+    box: str
+    field: str
+    detector: str
+    start: int  # UNIX time
+    end: int
+    value: float  # what was detected: the stuck value, the worst value, the largest step or z-score
+
+
+def runs(mask: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Start and end (excluded) of the runs of True of a boolean array"""
+    edges = np.diff(mask.astype(np.int8), prepend=0, append=0)
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+class Stuck:
+    """Runs of identical values lasting at least the given seconds. The last run is carried to the next chunk"""
+
+    name = "stuck"
+
+    def __init__(self, seconds: int):
+        self.seconds = seconds
+        self.value: Optional[float] = None  # run in progress
+        self.start = 0
+        self.end = 0
+
+    def feed(self, times: np.ndarray, values: np.ndarray) -> Iterator[tuple[int, int, float]]:
+        # start of every run of the chunk
+        starts = np.flatnonzero(np.diff(values, prepend=np.nan) != 0)
+        ends = np.r_[starts[1:], len(values)]
+
+        first = 0
+        if self.value is not None and values[0] == self.value:
+            # the carried run continues
+            self.end = times[ends[0] - 1]
+            first = 1
+            if len(starts) > 1:
+                yield from self._close()
+        elif self.value is not None:
+            yield from self._close()
+
+        if len(starts) > first:
+            middle = slice(first, len(starts) - 1)
+            durations = times[ends[middle] - 1] - times[starts[middle]]
+            for i in np.flatnonzero(durations >= self.seconds) + first:
+                yield int(times[starts[i]]), int(times[ends[i] - 1]), float(values[starts[i]])
+            self.value = values[starts[-1]]
+            self.start = times[starts[-1]]
+            self.end = times[-1]
+
+    def _close(self) -> Iterator[tuple[int, int, float]]:
+        if self.value is not None and self.end - self.start >= self.seconds and not np.isnan(self.value):
+            yield int(self.start), int(self.end), float(self.value)
+        self.value = None
+
+    def finish(self) -> Iterator[tuple[int, int, float]]:
+        yield from self._close()
+
+
+class Runs:
+    """
+    Base of the detectors that flag runs of points of a chunk. A run reaching the end of a chunk
+    stays open and is joined with a run starting the next one.
+    """
+
+    name = ""
+
+    def __init__(self):
+        self.open: Optional[list] = None  # start, end, value of the run in progress
+
+    @staticmethod
+    def merge(a: float, b: float) -> float:
+        return a if abs(a) >= abs(b) else b
+
+    def events(self, times: np.ndarray, starts: np.ndarray, ends: np.ndarray, worst, n: int
+               ) -> Iterator[tuple[int, int, float]]:
+        """Events of the runs [start, end) of a chunk of n points. worst(start, end) is the value of a run"""
+        if self.open is not None and (not len(starts) or starts[0] != 0):
+            yield tuple(self.open)
+            self.open = None
+        for start, end in zip(starts, ends):
+            event = [int(times[start]), int(times[end - 1]), worst(start, end)]
+            if self.open is not None:
+                # the run continues from the previous chunk
+                event[0] = self.open[0]
+                event[2] = self.merge(self.open[2], event[2])
+                self.open = None
+            if end == n:
+                self.open = event
+            else:
+                yield tuple(event)
+
+    def finish(self) -> Iterator[tuple[int, int, float]]:
+        if self.open is not None:
+            yield tuple(self.open)
+            self.open = None
+
+
+class OutOfRange(Runs):
+    """Runs of values outside the valid range of the field, or NaN"""
+
+    name = "range"
+
+    def __init__(self, lo: float, hi: float):
+        super().__init__()
+        self.lo = lo
+        self.hi = hi
+
+    def feed(self, times: np.ndarray, values: np.ndarray) -> Iterator[tuple[int, int, float]]:
+        with np.errstate(invalid="ignore"):
+            bad = ~((values >= self.lo) & (values <= self.hi))
+        starts, ends = runs(bad)
+
+        def worst(start: int, end: int) -> float:
+            run = values[start:end]
+            if np.isnan(run).all():
+                return float("nan")
+            high = np.nanmax(run)
+            return float(high if high > self.hi else np.nanmin(run))
+
+        yield from self.events(times, starts, ends, worst, len(values))
+
+    @staticmethod
+    def merge(a: float, b: float) -> float:
+        return b if np.isnan(a) else a if np.isnan(b) else Runs.merge(a, b)
+
+
+class Step(Runs):
+    """
+    Changes between the means of two consecutive windows larger than the threshold.
+
+    The means come from a cumulative sum: every point is read once. The last 2 * window - 1
+    points are carried, so the steps across two chunks are found too.
+    """
+
+    name = "step"
+
+    def __init__(self, window: int, threshold: float):
+        super().__init__()
+        self.window = window
+        self.threshold = threshold
+        self.tail_times = np.empty(0, dtype=np.int64)
+        self.tail_values = np.empty(0, dtype=np.float64)
+
+    def feed(self, times: np.ndarray, values: np.ndarray) -> Iterator[tuple[int, int, float]]:
+        w = self.window
+        times = np.concatenate((self.tail_times, times))
+        values = np.concatenate((self.tail_values, values))
+        self.tail_times = times[-(2 * w - 1):]
+        self.tail_values = values[-(2 * w - 1):]
+        if len(values) < 2 * w:
+            return
+
+        # step at i: mean of [i, i + w) - mean of [i - w, i), for i in [w, len - w]
+        n = len(values)
+        previous, current, following = slice(0, n - 2 * w + 1), slice(w, n - w + 1), slice(2 * w, n + 1)
+        valid = ~np.isnan(values)
+        if valid.all():
+            sums = np.concatenate(([0.0], np.cumsum(values)))
+            step = (sums[following] - 2 * sums[current] + sums[previous]) / w
+        else:
+            # sums and counts of the valid points, a NaN would spread to the whole cumulative sum
+            sums = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+            counts = np.concatenate(([0], np.cumsum(valid)))
+            with np.errstate(invalid="ignore", divide="ignore"):
+                after = (sums[following] - sums[current]) / (counts[following] - counts[current])
+                before = (sums[current] - sums[previous]) / (counts[current] - counts[previous])
+                step = after - before
+        with np.errstate(invalid="ignore"):
+            big = np.abs(step) > self.threshold
+        starts, ends = runs(big)
+
+        def worst(start: int, end: int) -> float:
+            return float(step[start + int(np.abs(step[start:end]).argmax())])
+
+        yield from self.events(times[w:], starts, ends, worst, len(big))
+
+
+def chunks(store: Store, box: str, field: str, size: int, start: Optional[int], stop: Optional[int]):
+    """Zero-copy chunks of a series"""
+    for times, values in store.partitions(box, field, start, stop):
+        for lo in range(0, len(times), size):
+            yield times[lo:lo + size], values[lo:lo + size]
+
+
+def detect_series(store: Store, box: str, field: str, size: int,
+                  start: Optional[int] = None, stop: Optional[int] = None) -> tuple[list[Event], int]:
+    """Run the detectors of a single series in one pass. Returns the events and the points read"""
+    detectors = []
+    if field in STUCK_SECONDS:
+        detectors.append(Stuck(STUCK_SECONDS[field]))
+    if field in RANGES:
+        detectors.append(OutOfRange(*RANGES[field]))
+    if field in STEPS:
+        detectors.append(Step(STEP_WINDOW, STEPS[field]))
+
+    events = []
+    points = 0
+    if not detectors:
+        return events, points
+
+    for times, values in chunks(store, box, field, size, start, stop):
+        points += len(times)
+        for detector in detectors:
+            for event in detector.feed(times, values):
+                events.append(Event(box, field, detector.name, *event))
+    for detector in detectors:
+        for event in detector.finish():
+            events.append(Event(box, field, detector.name, *event))
+    return events, points
+
+
+def detect_divergence(store: Store, boxes: list[str], field: str,
+                      start: Optional[int] = None, stop: Optional[int] = None) -> list[Event]:
+    """
+    Boxes that disagree with the fleet: robust z-score of the hourly mean of every box against the
+    median of all the boxes, flagged by every window of DIVERGENCE. The median is computed a month at a time,
+    the scores are kept for the whole range as float32.
+    """
+    if len(boxes) < 3:
+        return []
+
+    rollups = [store.rollup(box, field, "1h", start, stop) for box in boxes]
+    rollups = [(r["time"], r["sum"] / r["count"]) for r in rollups]
+    if not any(len(t) for t, _ in rollups):
+        return []
+    t0 = min(t[0] for t, _ in rollups if len(t))
+    t1 = max(t[-1] for t, _ in rollups if len(t))
+    n = (t1 - t0) // 3600 + 1
+
+    scores = np.full((len(boxes), n), np.nan, dtype=np.float32)
+    for lo in range(0, n, DIVERGENCE_CHUNK):
+        hi = min(lo + DIVERGENCE_CHUNK, n)
+        grid = np.full((len(boxes), hi - lo), np.nan)
+        for row, (times, means) in zip(grid, rollups):
+            a, b = np.searchsorted(times, (t0 + lo * 3600, t0 + hi * 3600))
+            row[(times[a:b] - t0) // 3600 - lo] = means[a:b]
+
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # hours without any box
+            deviation = grid - np.nanmedian(grid, axis=0)
+            mad = np.nanmedian(np.abs(deviation), axis=0)
+            # the fleet is often in agreement: a floor on the spread avoids flagging noise
+            floor = np.nanmedian(mad[mad > 0]) if np.any(mad > 0) else 1.0
+            scores[:, lo:hi] = deviation / (1.4826 * np.maximum(mad, floor))
+
+    events = []
+    for name, z, hours in DIVERGENCE:
+        # hours over z in every window [k, k + hours), with a cumulative sum along time
+        with np.errstate(invalid="ignore"):
+            over = np.abs(scores) > z
+        counts = np.cumsum(np.pad(over, ((0, 0), (1, 0))), axis=1, dtype=np.int32)
+        flagged = counts[:, hours:] - counts[:, :-hours] >= hours * 3 // 4
+
+        for b, box in enumerate(boxes):
+            starts, ends = runs(flagged[b])
+            for s, e in zip(starts, ends):
+                span = scores[b, s:e - 1 + hours]
+                worst = float(span[np.nanargmax(np.abs(span))])
+                events.append(Event(box, field, name, int(t0 + s * 3600), int(t0 + (e + hours - 2) * 3600), worst))
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find stuck, out of range, stepping and diverging sensors")
+    parser.add_argument("--root", default=os.getenv("TSSTORE_PATH", "tsstore"), help="directory of the store")
+    parser.add_argument("--box", action="append", help="only these boxes (default: all)")
+    parser.add_argument("--field", action="append", help="only these fields (default: all)")
+    parser.add_argument("--start", type=int, help="UNIX time")
+    parser.add_argument("--stop", type=int, help="UNIX time")
+    parser.add_argument("--chunk", type=int, default=CHUNK, help="points read at once from a series")
+    parser.add_argument("--csv", help="write the events to this file (- for stdout)")
+    args = parser.parse_args()
+
+    store = Store(args.root)
+    boxes = args.box or store.boxes()
+    events = []
+    points = 0
+
+    start = time.perf_counter()
+    for box in boxes:
+        for field in store.fields(box):
+            if args.field and field not in args.field:
+                continue
+            found, n = detect_series(store, box, field, args.chunk, args.start, args.stop)
+            events += found
+            points += n
+    series_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fields = sorted({f for box in boxes for f in store.fields(box)} & set(DIVERGENCE_FIELDS))
+    for field in fields:
+        if args.field and field not in args.field:
+            continue
+        events += detect_divergence(store, boxes, field, args.start, args.stop)
+    fleet_time = time.perf_counter() - start
+
+    if args.csv:
+        f = sys.stdout if args.csv == "-" else open(args.csv, "w", newline="")
+        writer = csv.writer(f)
+        writer.writerow(("box", "field", "detector", "start", "end", "value"))
+        for e in events:
+            writer.writerow((e.box, e.field, e.detector, e.start, e.end, "%g" % e.value))
+        if f is not sys.stdout:
+            f.close()
+
+    summary: dict[str, int] = {}
+    for e in events:
+        summary[e.detector] = summary.get(e.detector, 0) + 1
+    print("%d events: %s" % (len(events), ", ".join("%s %d" % kv for kv in sorted(summary.items())) or "none"),
+          file=sys.stderr)
+    print("Series: %d points in %.2f s (%.1f M points/s), fleet: %.2f s" % (
+        points, series_time, points / series_time / 1e6 if series_time else 0, fleet_time
+    ), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
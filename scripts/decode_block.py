@@ -0,0 +1,106 @@
+import argparse
+import struct
+import sys
+import time
+from typing import Iterator
+
+
+BLOCK_MAGIC = b"SB"
+BLOCK_VERSION = 2
+HEADER = "<2sBBHHI"  # magic, version, columns, points, sequence number, device time of the upload
+
+# Fields of a block, in the same order as FIELDS in micropython/main.py: name and decimals
+FIELDS = (
+    ("temperature", 1),
+    ("humidity", 1),
+    ("pressure", 0),
+    ("eco2", 0),
+    ("tvoc", 0),
+    ("caqi", 0),
+    ("pm01", 0),
+    ("pm25", 0),
+    ("pm100", 0),
+    ("vsys", 0),
+    ("interval", 0),
+    ("autonomy", 0),
+)
+
+
+def _varints(data: bytes) -> Iterator[int]:
+    value = 0
+    shift = 0
+    for b in data:
+        value |= (b & 0x7F) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            yield value
+            value = 0
+            shift = 0
+
+
+def _unzigzag(n: int) -> int:
+    return (n >> 1) ^ -(n & 1)
+
+
+def decode_block(payload: bytes, received: float, box: str = "box01") -> list[tuple[float, str, float]]:
+    """
+    Expand a block uploaded by the radio-off mode into (timestamp, topic, value) points.
+    The device clock is mapped to the wall clock using the time the block was received.
+    """
+    magic, version, columns, count, _seq, uploaded = struct.unpack_from(HEADER, payload)
+    if magic != BLOCK_MAGIC or version != BLOCK_VERSION:
+        raise ValueError("Unsupported block")
+    if columns != len(FIELDS) + 2:
+        raise ValueError("Unexpected number of columns: %d" % columns)
+
+    pos = struct.calcsize(HEADER)
+    data = []
+    for _ in range(columns):
+        (size,) = struct.unpack_from("<H", payload, pos)
+        pos += 2
+        data.append(_varints(payload[pos:pos + size]))
+        pos += size
+
+    timestamps = data[0]
+    masks = data[1]
+    values = data[2:]
+    last = [0] * len(FIELDS)
+
+    points = []
+    ts = 0
+    delta = 0
+    for i in range(count):
+        if i == 0:
+            ts = next(timestamps)
+        else:
+            delta += _unzigzag(next(timestamps))
+            ts += delta
+        wall = received - (uploaded - ts)
+
+        mask = next(masks)
+        for f, (name, decimals) in enumerate(FIELDS):
+            if mask & (1 << f):
+                last[f] += _unzigzag(next(values[f]))
+                points.append((wall, "%s/%s" % (box, name), last[f] / 10 ** decimals))
+
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode a block uploaded by the radio-off mode")
+    parser.add_argument("file", help="payload of the <box>/block message")
+    parser.add_argument("--received", type=float, default=None, help="UNIX time the block was received")
+    parser.add_argument("--box", default="box01", help="MQTT name of the box")
+    args = parser.parse_args()
+
+    with open(args.file, "rb") as f:
+        payload = f.read()
+
+    received = args.received if args.received is not None else time.time()
+    for ts, topic, value in decode_block(payload, received, args.box):
+        sys.stdout.write("%d,%s,%s\n" % (ts, topic, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import argparse
+import re
+import sys
+from dataclasses import dataclass, field
+
+
+# Currents (mA) of every component. Where the value comes from the datasheets in datasheet/, the file is noted.
+CPU_BASE_MA = 2.5  # RP2040 and the regulator of the Pico W, at 0 MHz (estimate)
+CPU_MA_PER_MHZ = 0.15  # RP2040 running from flash (estimate)
+LIGHTSLEEP_MA = 1.3  # Pico W in lightsleep (estimate)
+RADIO_ASSOC_MA = 60.0  # CYW43 scanning and associating (estimate)
+RADIO_TX_MA = 80.0  # CYW43 transmitting (estimate)
+RADIO_IDLE_MA = 2.5  # CYW43 associated, in power save mode (estimate)
+PMS_ACTIVE_MA = 100.0  # pms7003.pdf, at 5 V
+PMS_STANDBY_MA = 0.2  # pms7003.pdf, at 5 V
+SGP30_MA = 48.2  # sgp30.pdf, measurement mode: after iaq_init the sensor never goes back to sleep
+BMP180_MA = 0.003  # bmp180.pdf, ultra low power mode at 1 sample/s
+AHT20_MA = 0.001  # AHT20, sleep (estimate)
+CHARGER_MA = 0.003  # cn3065.pdf, battery drain without input
+
+PMS_VOLTAGE = 5.0  # the PMS is powered by the step-up converter
+BOOST_EFFICIENCY = 0.85  # step-up converter 3.3 V - 5 V (estimate)
+BATTERY_VOLTAGE = 3.7
+
+# What every stage of micropython/main.py (the Audit sites) keeps on: CPU active, radio state, PMS fan.
+# The fan is started with the cycle (Pipeline.start) and warms up during the stages before the PMS read:
+# "warmup" is on in the cycles in which the PMS is due, True in every call of the stage.
+STAGES = {
+    "wifi": (True, "assoc", "warmup"),
+    "mqtt.connect": (True, "tx", "warmup"),
+    "publish": (True, "tx", False),
+    "upload": (True, "assoc", False),
+    "i2c": (True, None, "warmup"),
+    "pms": (False, None, True),
+}
+
+REPORT_LINE = re.compile(r"^\s+(\S+): (\d+) calls, \d+ bytes, \d+ GC, max \d+, (\d+) ms")
+
+
+@dataclass
+class Profile:
+    """Timings of a cycle: seconds spent in every stage and sleeping"""
+    freq_mhz: float = 64.0
+    interval: float = 300.0
+    radio_always_on: bool = True  # False in radio-off mode
+    pms_share: float = 1.0  # cycles in which the PMS runs
+    stages: dict[str, float] = field(default_factory=lambda: {
+        "mqtt.connect": 0.4,
+        "i2c": 0.1,
+        "pms": 30.5,  # the rest of the 30 s warm-up and the read
+        "publish": 0.2,
+    })
+
+
+def pms_battery_ma(ma: float) -> float:
+    """Current drawn from the battery by the PMS through the step-up converter"""
+    return ma * PMS_VOLTAGE / (BOOST_EFFICIENCY * BATTERY_VOLTAGE)
+
+
+def stage_ma(name: str, profile: Profile) -> float:
+    cpu, radio, fan = STAGES.get(name, (True, None, False))
+
+    ma = CPU_BASE_MA + CPU_MA_PER_MHZ * profile.freq_mhz if cpu else LIGHTSLEEP_MA
+    if radio == "assoc":
+        ma += RADIO_ASSOC_MA
+    elif radio == "tx":
+        ma += RADIO_TX_MA
+    elif profile.radio_always_on:
+        ma += RADIO_IDLE_MA
+    share = profile.pms_share if fan == "warmup" else float(bool(fan))
+    ma += pms_battery_ma(PMS_ACTIVE_MA * share + PMS_STANDBY_MA * (1 - share))
+    return ma
+
+
+def sleep_ma(profile: Profile) -> float:
+    ma = LIGHTSLEEP_MA + pms_battery_ma(PMS_STANDBY_MA)
+    if profile.radio_always_on:
+        ma += RADIO_IDLE_MA
+    return ma
+
+
+def background_ma() -> float:
+    """Components that draw the same current for the whole cycle"""
+    return SGP30_MA + BMP180_MA + AHT20_MA + CHARGER_MA
+
+
+def cycle_charge(profile: Profile) -> list[tuple[str, float, float]]:
+    """Charge used by every stage of a cycle: (stage, seconds, mAh)"""
+    rows = []
+    for name, seconds in profile.stages.items():
+        rows.append((name, seconds, stage_ma(name, profile) * seconds / 3600))
+    rows.append(("sleep", profile.interval, sleep_ma(profile) * profile.interval / 3600))
+
+    duration = sum(seconds for _, seconds, _ in rows)
+    rows.append(("background", duration, background_ma() * duration / 3600))
+    return rows
+
+
+def profile_from_log(path: str, profile: Profile) -> Profile:
+    """Read the stage timings from the Audit report printed by the firmware (the last one is used)"""
+    sites = {}
+    with open(path, "r") as f:
+        for line in f:
+            match = REPORT_LINE.match(line)
+            if match:
+                sites[match.group(1)] = (int(match.group(2)), int(match.group(3)))
+
+    if "i2c" not in sites:
+        raise ValueError("No Audit report found in %s" % path)
+
+    # the I2C sensors are measured once per cycle, the other sites may run less often
+    cycles = sites["i2c"][0]
+    profile.stages = {name: ms / 1000 / cycles for name, (_, ms) in sites.items() if name in STAGES}
+    profile.pms_share = sites["pms"][0] / cycles if "pms" in sites else 0.0
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Charge used by a cycle of the MicroPython firmware")
+    parser.add_argument("--log", help="serial log with the Audit report of the firmware (AUDIT_ALLOC = True)")
+    parser.add_argument("--freq", type=float, default=64.0, help="CPU clock (MHz)")
+    parser.add_argument("--interval", type=float, default=300.0, help="sleep between two cycles (s)")
+    parser.add_argument("--radio-off", action="store_true", help="the radio is off between uploads")
+    parser.add_argument("--battery", type=float, default=2600.0, help="battery capacity (mAh)")
+    parser.add_argument("--solar", type=float, default=0.0, help="average charge from the solar panel (mAh/day)")
+    parser.add_argument("--budget", type=float, default=None, help="fail if a cycle uses more than this (mAh)")
+    args = parser.parse_args()
+
+    profile = Profile(freq_mhz=args.freq, interval=args.interval, radio_always_on=not args.radio_off)
+    if args.log:
+        profile = profile_from_log(args.log, profile)
+
+    rows = cycle_charge(profile)
+    total = sum(mah for _, _, mah in rows)
+    duration = sum(seconds for name, seconds, _ in rows if name != "background")
+    per_day = total * 86400 / duration
+
+    print("%-14s %10s %12s" % ("stage", "s/cycle", "mAh/cycle"))
+    for name, seconds, mah in rows:
+        print("%-14s %10.2f %12.4f" % (name, seconds, mah))
+    print("%-14s %10.2f %12.4f" % ("total", duration, total))
+    print()
+    print("%.1f mAh/day" % per_day)
+
+    net = per_day - args.solar
+    if net <= 0:
+        print("Autonomy: unlimited (solar input %.0f mAh/day)" % args.solar)
+    else:
+        print("Autonomy: %.1f days (battery %.0f mAh, solar input %.0f mAh/day)" % (
+            args.battery / net, args.battery, args.solar
+        ))
+
+    if args.budget is not None and total > args.budget:
+        print("Budget of %.4f mAh/cycle exceeded" % args.budget)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import argparse
+import contextlib
+import errno
+import io
+import os
+import random
+import tempfile
+import time
+from dataclasses import dataclass, field
+
+from trace_replay import FIELDS, Clock, NoAudit, firmware
+
+
+SENSORS = ("aht20", "bmp180", "sgp30", "pms7003")
+ADDRESSES = {"aht20": 0x38, "bmp180": 0x77, "sgp30": 0x58}
+
+CONNECT_MS = 1_500  # WiFi and MQTT, overlapped with the PMS warm-up
+PMS_TIMEOUT_MS = 5_000  # time PMS.read() spends before giving up on a silent sensor
+
+
+class FaultyI2C:
+    """Raw I2C bus where every transaction to a faulty address fails with EIO"""
+
+    def __init__(self, clock: Clock):
+        self.clock = clock
+        self.faulty: set[int] = set()
+
+    def scan(self) -> list[int]:
+        return list(ADDRESSES.values())
+
+    def _transaction(self, addr: int) -> None:
+        self.clock.sleep_ms(1)
+        if addr in self.faulty:
+            raise OSError(errno.EIO)
+
+    def writeto(self, addr: int, buf) -> None:
+        self._transaction(addr)
+
+    def readfrom_into(self, addr: int, buf) -> None:
+        self._transaction(addr)
+
+
+class SimI2CDevice:
+    """I2C sensor with the interface of the drivers used by sensors.py: a write and a read per measurement"""
+
+    def __init__(self, bus, addr: int, conversion_ms: int):
+        self.bus = bus
+        self.addr = addr
+        self.conversion_ms = conversion_ms
+        self._buf = bytearray(6)
+
+        # AHT20
+        self.calibrated = True
+        # BMP180
+        self.last_pressure = 101_325
+        self.calibration = (1,) * 11
+        self.mode = 0
+        # SGP30
+        self.last_co2eq = 400
+        self.last_tvoc = 10
+
+    def _command(self) -> None:
+        self.bus.writeto(self.addr, self._buf)
+
+    def convert(self, step: int) -> int:
+        if step == 0:
+            self._command()
+            return self.conversion_ms
+        self.bus.readfrom_into(self.addr, self._buf)
+        return -1
+
+    def reset(self) -> None:
+        self._command()
+
+    def calibrate(self) -> bool:
+        self._command()
+        return True
+
+    def temperature_scaled(self, decimals: int) -> int:
+        return 215 * 10 ** decimals // 10
+
+    def relative_humidity_scaled(self, decimals: int) -> int:
+        return 45 * 10 ** decimals
+
+    def initialize(self) -> None:
+        self._command()
+
+    def iaq_init(self) -> None:
+        self._command()
+
+    def set_iaq_baseline(self, co2eq: int, tvoc: int) -> None:
+        self._command()
+
+    def get_iaq_baseline(self) -> list[int]:
+        self._command()
+        return [0x8000, 0x8000]
+
+    def set_iaq_rel_humidity_fixed(self, rh: int, temp: int) -> None:
+        self._command()
+
+
+class SimPMS:
+    """PMS7003 that doesn't answer while faulty: read() returns None after the timeout, like the driver"""
+
+    def __init__(self, clock: Clock):
+        self.clock = clock
+        self.faulty = False
+
+    def pas_mode(self) -> None:
+        pass
+
+    def wake_up(self) -> None:
+        pass
+
+    def prepare_read(self) -> None:
+        pass
+
+    def read(self):
+        if self.faulty:
+            self.clock.sleep_ms(PMS_TIMEOUT_MS)
+            return None
+        self.clock.sleep_ms(1_000)
+        return (28, 5, 8, 10, 5, 8, 10, 0, 0, 0, 0, 0, 0, 0x91, 0, 0)
+
+    def sleep(self) -> None:
+        pass
+
+
+@dataclass
+class Outage:
+    sensor: str
+    start: int  # cycle
+    length: int  # cycles
+
+
+@dataclass
+class Stats:
+    policy: str
+    readings: int = 0  # sensor measurements expected
+    lost: int = 0
+    lost_healthy: int = 0  # lost while the sensor was working (skipped by the breaker or by a reset)
+    awake_ms: int = 0
+    recovery: list[int] = field(default_factory=list)  # cycles from the end of an outage to a valid reading
+
+
+def install(clock: Clock, i2c: FaultyI2C, pms: SimPMS):
+    """Import the firmware pipeline on the host, with the simulated devices in place of the drivers"""
+    sensors = firmware(clock)
+
+    conversion = {"aht20": 80, "bmp180": 31, "sgp30": 12}
+    for name in ADDRESSES:
+        def create(self, bus, settings, warm_boot, name=name):
+            self.driver = SimI2CDevice(bus, ADDRESSES[name], conversion[name])
+        sensors.REGISTRY[name].create = create
+
+    def create_pms(self, bus, settings, warm_boot):
+        self.driver = pms
+        self.settings = settings
+    sensors.REGISTRY["pms7003"].create = create_pms
+    return sensors
+
+
+def simulate(policy: str, cycles: int, transient: dict[str, float], outages: list[Outage],
+             backoff: int, seed: int) -> Stats:
+    """
+    Run the cycles through the Pipeline of the firmware.
+
+    Policies:
+    - breaker: the firmware, failing sensors are skipped with an exponential backoff
+    - retry: every sensor is tried in every cycle (max_backoff = 0)
+    - reset: the firmware before the breakers, a PMS failure raised out of the cycle and reset the device,
+      losing the readings of every sensor
+    """
+    clock = Clock()
+    i2c_raw = FaultyI2C(clock)
+    pms = SimPMS(clock)
+    sensors = install(clock, i2c_raw, pms)
+    from i2cbus import I2CBus
+    from settings import Settings
+
+    rng = random.Random(seed)
+    stats = Stats(policy)
+    bus = I2CBus(i2c_raw)
+    settings = Settings()
+    pipeline = sensors.Pipeline(
+        SENSORS, FIELDS, bus, bus, None, settings, False, NoAudit(),
+        max_backoff=0 if policy != "breaker" else backoff
+    )
+    pipeline.setup(False)
+    readings = [0] * len(FIELDS)
+    waiting: dict[str, int] = {}  # sensor -> cycle its outage ended
+
+    for cycle in range(cycles):
+        clock.ms = cycle * settings.interval * 1000
+        faulty = set()
+        for name in SENSORS:
+            if rng.random() < transient.get(name, 0.0):
+                faulty.add(name)
+        for outage in outages:
+            if outage.start <= cycle < outage.start + outage.length:
+                faulty.add(outage.sensor)
+            elif cycle == outage.start + outage.length:
+                waiting[outage.sensor] = cycle
+
+        i2c_raw.faulty = {ADDRESSES[name] for name in faulty if name in ADDRESSES}
+        pms.faulty = "pms7003" in faulty
+
+        start = clock.ms
+        pipeline.start(True)
+        clock.sleep_ms(CONNECT_MS)
+        pipeline.measure(readings, True)
+        stats.awake_ms += clock.ms - start
+
+        reset = policy == "reset" and "pms7003" in faulty
+        for sensor in pipeline.sensors:
+            name = sensor.NAME
+            valid = sensor.valid and not reset
+            stats.readings += 1
+            if not valid:
+                stats.lost += 1
+                if name not in faulty:
+                    stats.lost_healthy += 1
+            elif name in waiting:
+                stats.recovery.append(cycle - waiting.pop(name))
+
+    return stats
+
+
+def parse_outage(value: str) -> Outage:
+    sensor, start, length = value.split(":")
+    if sensor not in SENSORS:
+        raise argparse.ArgumentTypeError("Unknown sensor %s" % sensor)
+    return Outage(sensor, int(start), int(length))
+
+
+def parse_transient(value: str) -> tuple[str, float]:
+    sensor, probability = value.split("=")
+    if sensor not in SENSORS:
+        raise argparse.ArgumentTypeError("Unknown sensor %s" % sensor)
+    return sensor, float(probability)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inject sensor faults in the firmware pipeline running on the host")
+    parser.add_argument("--cycles", type=int, default=10_000)
+    parser.add_argument("--transient", type=parse_transient, action="append", default=[],
+                        help="sensor=probability of failing a cycle, e.g. sgp30=0.01")
+    parser.add_argument("--outage", type=parse_outage, action="append", default=[],
+                        help="sensor:first cycle:cycles, e.g. pms7003:1000:300")
+    parser.add_argument("--backoff", type=int, default=8, help="maximum cycles skipped by the breaker")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    transient = dict(args.transient)
+    outages = args.outage or [Outage("pms7003", 1_000, 300), Outage("sgp30", 5_000, 50)]
+    if not args.transient and not args.outage:
+        transient = {"sgp30": 0.01, "pms7003": 0.02}
+
+    print("%-8s %10s %14s %12s %12s %12s" % (
+        "policy", "lost", "lost healthy", "recovery", "max", "awake s/cycle"
+    ))
+    cwd = os.getcwd()
+    # the SGP30 baselines are saved in the working directory
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            for policy in ("reset", "retry", "breaker"):
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    stats = simulate(policy, args.cycles, transient, outages, args.backoff, args.seed)
+                elapsed = time.perf_counter() - start
+                recovery = stats.recovery or [0]
+                print("%-8s %9.2f%% %13.2f%% %12.1f %12d %12.2f   (%.0f cycles/s)" % (
+                    policy, 100 * stats.lost / stats.readings, 100 * stats.lost_healthy / stats.readings,
+                    sum(recovery) / len(recovery), max(recovery), stats.awake_ms / 1000 / args.cycles,
+                    args.cycles / elapsed
+                ))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1174 @@
+import argparse
+import contextlib
+import errno
+import io
+import math
+import os
+import runpy
+import select
+import socket
+import ssl
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from typing import Optional
+
+from trace_replay import (FIELDS, FIRMWARE_DIR, RESET_SLEEP_S, SENSOR_FIELDS, Clock, NoAudit, ReplayMismatch, Trace,
+                          firmware)
+from trace_replay import host_modules, replay, row
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def check(condition: bool, message: str, *args) -> None:
+    if not condition:
+        raise CheckFailed(message % args)
+
+
+class HostHeap:
+    """
+    gc module of the firmware on the host: a heap with the automatic collection of MicroPython.
+
+    Allocations are garbage unless kept. A collection runs when the allocations since the last one
+    reach the threshold (if enabled) and always when the heap is full, like gc_alloc().
+    """
+
+    def __init__(self, size: int = 160_000, threshold: int = 16_000):
+        self.size = size
+        self.threshold = threshold
+        self.live = 0
+        self.garbage = 0
+        self.since = 0  # bytes allocated since the last collection
+        self.auto = True
+        self.collections = 0
+
+    def mem_alloc(self) -> int:
+        return self.live + self.garbage
+
+    def alloc(self, n: int, keep: bool = False) -> None:
+        if self.auto and self.since + n > self.threshold:
+            self.collect()
+        if self.mem_alloc() + n > self.size:
+            self.collect()
+        if keep:
+            self.live += n
+        else:
+            self.garbage += n
+        self.since += n
+
+    def collect(self) -> None:
+        self.garbage = 0
+        self.since = 0
+        self.collections += 1
+
+    def enable(self) -> None:
+        self.auto = True
+
+    def disable(self) -> None:
+        self.auto = False
+
+    def isenabled(self) -> bool:
+        return self.auto
+
+
+class TracedHeap:
+    """
+    gc module of the firmware on CPython, for code that really runs: mem_alloc() grows by the peak of the memory
+    traced by tracemalloc since the last call.
+
+    CPython frees an object as soon as it's unused, while MicroPython keeps it until a collection: a block that
+    allocates nothing reads 0 on both, one that allocates reads at least its largest object. The interpreter itself
+    allocates a few dozen bytes here and there, so an object smaller than that may go unseen, as the ones CPython
+    takes from its free lists (tuples, lists, floats). CPython ints over 256 are objects too (the small ints of
+    MicroPython go up to 2**30), so the values must stay small.
+    """
+
+    def __init__(self, values: int = 1 << 18):
+        self.allocated = 0
+        self._mark = 0
+        # An object freed after the reset of the peak hides the allocations smaller than it. The results come from
+        # a table of ints built before tracing, so the ones the caller replaces (e.g. the start of a site) are never
+        # freed, and the peak is reset last, when the temporary objects of mem_alloc() are freed.
+        self._ints = list(range(values))
+
+    def start(self) -> None:
+        tracemalloc.start()
+        self.mem_alloc()
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+
+    def mem_alloc(self) -> int:
+        peak = tracemalloc.get_traced_memory()[1]
+        allocated = self.allocated + peak - self._mark
+        self.allocated = self._ints[allocated] if allocated < len(self._ints) else allocated
+        del peak, allocated
+        self._mark = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        return self.allocated
+
+    def collect(self) -> None:
+        pass
+
+    def enable(self) -> None:
+        pass
+
+    def disable(self) -> None:
+        pass
+
+    def isenabled(self) -> bool:
+        return True
+
+
+class SinkSocket:
+    """Connected socket of the firmware that takes every write whole"""
+
+    def write(self, buf, length: int = -1) -> int:
+        return len(buf) if length < 0 else length
+
+
+class ScaledClock:
+    """
+    Real clock of the host running scale times faster than the firmware time, for the code with threads:
+    sleeping really waits, so the threads run concurrently
+    """
+
+    def __init__(self, scale: float = 200):
+        self.scale = scale
+        self.t0 = time.perf_counter()
+
+    def schedule(self, f, arg) -> None:
+        f(arg)
+
+    def ticks_ms(self) -> int:
+        return int((time.perf_counter() - self.t0) * 1_000 * self.scale)
+
+    def ticks_us(self) -> int:
+        return int((time.perf_counter() - self.t0) * 1_000_000 * self.scale)
+
+    def sleep_ms(self, ms: int) -> None:
+        time.sleep(max(0, ms) / 1_000 / self.scale)
+
+    def sleep(self, s: float) -> None:
+        time.sleep(max(0, s) / self.scale)
+
+
+class CountingPMS:
+    """PMS whose n-th frame has every value set to n"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.frames = 0
+
+    def wake_up(self) -> None:
+        self.clock.sleep_ms(50)
+
+    def prepare_read(self) -> None:
+        self.clock.sleep_ms(50)
+
+    def read(self) -> tuple:
+        self.clock.sleep_ms(1_000)
+        self.frames += 1
+        return (self.frames,) * 16
+
+    def sleep(self) -> None:
+        self.clock.sleep_ms(50)
+
+
+class StreamUART:
+    """UART with an RX interrupt: received() makes bytes available and calls the handler once per chunk"""
+
+    IRQ_RXIDLE = 1
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.handler = None
+
+    def init(self, *args, **kwargs) -> None:
+        pass
+
+    def irq(self, handler, trigger=0) -> None:
+        self.handler = handler
+
+    def received(self, data: bytes, chunk: int = 32) -> None:
+        for i in range(0, len(data), chunk):
+            self.buf += data[i:i + chunk]
+            if self.handler is not None:
+                self.handler(self)
+
+    def any(self) -> int:
+        return len(self.buf)
+
+    def readinto(self, buf, n: int) -> int:
+        n = min(n, len(self.buf))
+        buf[:n] = self.buf[:n]
+        del self.buf[:n]
+        return n
+
+    def write(self, buf) -> int:
+        return len(buf)
+
+    def flush(self) -> None:
+        pass
+
+
+class BrokerSocket:
+    """
+    Non-blocking socket to a broker on the virtual clock. The TCP connection completes after accept_ms (None: never),
+    the reply arrives one byte every trickle_ms from the first write, the send buffer takes window bytes in all.
+    """
+
+    def __init__(self, clock: Clock, accept_ms: Optional[int] = 0, reply: bytes = b"\x20\x02\0\0",
+                 trickle_ms: int = 0, window: int = 1 << 16):
+        self.clock = clock
+        self.accept_ms = accept_ms
+        self.reply = reply
+        self.trickle_ms = trickle_ms
+        self.window = window
+        self.connected_at = None
+        self.replied_at = None  # time of the first write
+        self.read = 0
+        self.received = 0
+
+    def setblocking(self, flag: bool) -> None:
+        pass
+
+    def connect(self, addr) -> None:
+        if self.accept_ms is not None:
+            self.connected_at = self.clock.ms + self.accept_ms
+        raise OSError(errno.EINPROGRESS, "connection in progress")
+
+    def ready_at(self, event: int) -> Optional[int]:
+        """Time at which the socket is ready for the event, None if never"""
+        if event == select.POLLOUT:
+            return self.connected_at if self.received < self.window else None
+        if self.replied_at is None or self.read == len(self.reply):
+            return None
+        return self.replied_at + (self.read + 1) * self.trickle_ms
+
+    def write(self, buf, length: int = -1) -> Optional[int]:
+        if length < 0:
+            length = len(buf)
+        ready = self.ready_at(select.POLLOUT)
+        if ready is None or ready > self.clock.ms:
+            return None
+        n = min(length, self.window - self.received)
+        self.received += n
+        if self.replied_at is None:
+            self.replied_at = self.clock.ms
+        return n
+
+    def readinto(self, buf) -> Optional[int]:
+        n = 0
+        while n < len(buf):
+            ready = self.ready_at(select.POLLIN)
+            if ready is None or ready > self.clock.ms:
+                break
+            buf[n] = self.reply[self.read]
+            self.read += 1
+            n += 1
+        return n or None
+
+    def close(self) -> None:
+        pass
+
+
+class VirtualPoll:
+    """select.poll() of the firmware on the virtual clock: ipoll() advances it to the first event or the timeout"""
+
+    def __init__(self, clock: Clock):
+        self.clock = clock
+        self.events = {}
+
+    def register(self, sock, event: int) -> None:
+        self.events[sock] = event
+
+    modify = register
+
+    def unregister(self, sock) -> None:
+        del self.events[sock]
+
+    def ipoll(self, timeout: int, flags: int = 0):
+        end = self.clock.ms + timeout
+        for sock, event in self.events.items():
+            ready = sock.ready_at(event)
+            if ready is not None and ready <= end:
+                self.clock.ms = max(self.clock.ms, ready)
+                return ((sock, event),)
+        self.clock.ms = end
+        return ()
+
+
+class HostPoll:
+    """select.poll() of the firmware on the sockets of the host"""
+
+    def __init__(self):
+        self.poll = select.poll()
+
+    def register(self, sock, event: int) -> None:
+        self.poll.register(sock, event)
+
+    def modify(self, sock, event: int) -> None:
+        self.poll.modify(sock, event)
+
+    def unregister(self, sock) -> None:
+        self.poll.unregister(sock)
+
+    def ipoll(self, timeout: int, flags: int = 0):
+        return self.poll.poll(timeout)
+
+
+class RequestUART(StreamUART):
+    """UART of a PMS in passive mode: every read request is answered with a frame, whose values count the requests"""
+
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+
+    def write(self, buf) -> int:
+        if buf[2] == 0xE2:
+            self.requests += 1
+            self.received(pms_frame(self.requests))
+        return len(buf)
+
+    def read(self, n: int = -1) -> bytes:
+        n = len(self.buf) if n < 0 else min(n, len(self.buf))
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+
+def sgp30_word(value: int) -> bytes:
+    """Word of an SGP30 reply with its CRC"""
+    word = struct.pack(">H", value)
+    crc = 0xFF
+    for b in word:
+        crc ^= b
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x31 if crc & 0x80 else crc << 1) & 0xFF
+    return word + bytes((crc,))
+
+
+# Calibration of the BMP180 in the example of the datasheet: AC1-AC6, B1, B2, MB, MC, MD
+BMP180_CALIBRATION = struct.pack(">hhhHHHhhhhh", 408, -72, -14383, 32741, 32757, 23153, 6190, 4, -32768, -8711, 2868)
+
+
+class SensorBus:
+    """
+    Raw I2C bus with an AHT20, a BMP180 and an SGP30 answering byte by byte, for the drivers of the firmware.
+    The readings change with the cycle, the devices at the failing addresses don't answer.
+    """
+
+    def __init__(self):
+        self.cycle = 0
+        self.failing: set[int] = set()
+        self._command = b""  # last SGP30 command
+        self._control = 0  # BMP180 control register
+
+    def _transaction(self, addr: int) -> None:
+        if addr in self.failing:
+            raise OSError(errno.EIO, "I/O error")  # with the errno set on CPython too
+
+    def scan(self) -> list[int]:
+        return [0x38, 0x58, 0x77]
+
+    def writeto(self, addr: int, buf) -> None:
+        self._transaction(addr)
+        if addr == 0x58:
+            self._command = bytes(buf[:2])
+
+    def readfrom_into(self, addr: int, buf) -> None:
+        self._transaction(addr)
+        cycle = self.cycle
+        if addr == 0x38:
+            # status (calibrated, idle), then 20 bits of humidity and 20 of temperature
+            humidity = 0x70000 + cycle * 997
+            temp = 0x60000 + cycle * 1_511
+            reply = bytes((0x08, humidity >> 12, humidity >> 4 & 0xFF, (humidity & 0xF) << 4 | temp >> 16,
+                           temp >> 8 & 0xFF, temp & 0xFF))
+        else:
+            words = {
+                b"\x36\x82": (0x0000, 0x0123, 0x4567),  # serial
+                b"\x20\x2f": (0x0020,),  # feature set
+                b"\x20\x08": (400 + cycle * 7, cycle * 3),  # CO2eq, TVOC
+                b"\x20\x15": (0x8973, 0x8AAE),  # baselines
+            }.get(self._command, ())
+            reply = b"".join(sgp30_word(w) for w in words)
+        buf[:len(buf)] = reply[:len(buf)]
+
+    def readfrom_mem(self, addr: int, memaddr: int, nbytes: int) -> bytes:
+        self._transaction(addr)
+        if memaddr == 0xD0:
+            return b"\x55\x02"[:nbytes]  # chip id
+        offset = memaddr - 0xAA
+        return BMP180_CALIBRATION[offset:offset + nbytes]
+
+    def writeto_mem(self, addr: int, memaddr: int, buf) -> None:
+        self._transaction(addr)
+        self._control = buf[0]
+
+    def readfrom_mem_into(self, addr: int, memaddr: int, buf) -> None:
+        self._transaction(addr)
+        if self._control == 0x2E:
+            reply = struct.pack(">H", 27898 + self.cycle * 10)
+        else:
+            reply = struct.pack(">I", (23843 + self.cycle * 5) << (8 - (self._control >> 6)))[1:]
+        buf[:len(buf)] = reply[:len(buf)]
+
+
+def pms_frame(value: int) -> bytes:
+    """Frame of the PMS7003 in passive mode with every concentration set to value"""
+    body = struct.pack(">BBH12HBB", 0x42, 0x4D, 28, *([value] * 12), 0x91, 0)
+    return body + struct.pack(">H", sum(body))
+
+
+def check_audit() -> str:
+    """Audit (micropython/audit.py): exact bytes per site, invalid samples after a forced GC, budget"""
+    host_modules(Clock())
+    sys.modules.pop("audit", None)
+    import audit as audit_module
+
+    heap = HostHeap()
+    audit_module.gc = heap
+    audit = audit_module.Audit(budget=2_048)
+
+    # a site near the collection threshold: no GC inside it, the bytes are its own
+    audit.begin_cycle()
+    heap.alloc(heap.threshold - 100)
+    with audit.site("publish"):
+        heap.alloc(512)
+    check(audit.end_cycle() is False, "a cycle of %d bytes passed a budget of 2048", audit.cycle_bytes)
+    counters = audit.sites["publish"]
+    check(counters[1] == 512 and counters[2] == 0, "publish recorded %d bytes, %d GC instead of 512, 0",
+          counters[1], counters[2])
+    check(heap.isenabled(), "the automatic collection is still disabled after the site")
+
+    # within the budget
+    audit.begin_cycle()
+    with audit.site("i2c"):
+        heap.alloc(1_000)
+        with audit.site("nested"):
+            heap.alloc(1_000)
+    check(audit.end_cycle() is True, "a cycle of %d bytes failed a budget of 2048", audit.cycle_bytes)
+    check(audit.cycle_bytes == 2_000, "the cycle recorded %d bytes instead of 2000", audit.cycle_bytes)
+    check(audit.sites["nested"][1] == 1_000 and audit.sites["i2c"][1] == 2_000, "wrong bytes of nested sites")
+
+    # a full heap collects anyway: the sample is invalid, not the size of the live heap
+    audit.begin_cycle()
+    heap.alloc(heap.size - heap.mem_alloc() - 100, keep=False)
+    with audit.site("upload"):
+        heap.alloc(1_000)
+    counters = audit.sites["upload"]
+    check(counters[1] == 0 and counters[2] == 1, "a GC inside upload recorded %d bytes", counters[1])
+    check(audit.end_cycle() is False and audit.cycle_bytes == -1, "a cycle with a GC passed the budget")
+
+    return "sites exact, forced GC flagged, budget enforced"
+
+
+# readings of a cycle, small enough to be small ints on CPython too: (field, value, decimals)
+PUBLISH_READINGS = (
+    ("seq", 7, 0), ("temperature", 215, 1), ("humidity", 45, 0), ("pressure", 101, 0), ("eco2", 250, 0),
+    ("tvoc", 3, 0), ("caqi", 12, 0), ("pm01", 1, 0), ("pm25", 5, 0), ("pm100", 8, 0), ("vsys", -1, 0),
+)
+PUBLISH_CYCLES = 20  # the counters of the sites stay below 256
+
+
+def check_audit_publish() -> str:
+    """
+    Audit of the real publish path: MQTTClient.publish_num (micropython/mqtt.py) of every reading of a cycle
+    allocates nothing, so it passes the budget of a cycle that doesn't publish, while formatting the values as
+    strings fails it.
+
+    On CPython the audit and the loop allocate by themselves (MicroPython keeps the bound __exit__ of a with block
+    and the iterators on the stack): the budget is what a cycle of empty sites allocates. The bytes that
+    publish_num adds to a cycle are what counts against AUDIT_BUDGET of micropython/conf.py.
+    """
+    host_modules(Clock())
+    sys.modules["usocket"] = types.ModuleType("usocket")
+    for name in ("audit", "mqtt"):
+        sys.modules.pop(name, None)
+    import audit as audit_module
+    import mqtt as mqtt_module
+
+    budget = runpy.run_path(os.path.join(FIRMWARE_DIR, "conf.py"))["AUDIT_BUDGET"]
+    heap = TracedHeap()
+    audit_module.gc = heap
+    audit = audit_module.Audit()
+    # no deadline: its ticks would be objects on CPython only
+    client = mqtt_module.MQTTClient("box01", "broker")
+    client.sock = SinkSocket()
+    readings = tuple(("box01/" + field, value, decimals) for field, value, decimals in PUBLISH_READINGS)
+
+    def nothing(topic: str, value: int, decimals: int) -> None:
+        pass
+
+    def as_string(topic: str, value: int, decimals: int) -> None:
+        client.publish(topic, "%d" % value)
+
+    def cycle(site: str, publish) -> bool:
+        """Audited cycle with every reading published in a site. Returns True if it's within the budget"""
+        audit.begin_cycle()
+        for topic, value, decimals in readings:
+            client.bytes_sent = 0  # below 256, not an object on CPython
+            # the with block of main.py, without the bound __enter__ that CPython frees once it returns
+            audit.site(site).__enter__()
+            publish(topic, value, decimals)
+            audit.__exit__(None, None, None)
+        return audit.end_cycle()
+
+    heap.start()
+    try:
+        # the first cycles create the counters of the sites
+        for site, publish in (("baseline", nothing), ("publish", client.publish_num), ("string", as_string)):
+            cycle(site, publish)
+        cycle("baseline", nothing)
+        audit.budget = baseline = audit.cycle_bytes
+        check(baseline > 0, "a cycle of empty sites allocated nothing, the budget would be unlimited")
+
+        for _ in range(PUBLISH_CYCLES):
+            check(cycle("publish", client.publish_num), "a cycle of publish_num allocated %d bytes, %d without "
+                  "publishing", audit.cycle_bytes, baseline)
+            check(audit.cycle_bytes - baseline <= budget, "publish_num allocated %d bytes, over AUDIT_BUDGET",
+                  audit.cycle_bytes - baseline)
+        # per call, the site of publish_num records what an empty site does on CPython
+        calls, allocated, gcs = audit.sites["publish"][:3]
+        empty_calls, empty = audit.sites["baseline"][:2]
+        check(allocated // calls <= empty // empty_calls and gcs == 0, "publish_num recorded %d bytes and %d GC in "
+              "%d calls, an empty site %d bytes in %d", allocated, gcs, calls, empty, empty_calls)
+
+        check(not cycle("string", as_string), "a cycle publishing strings passed the budget")
+        strings = audit.cycle_bytes - baseline
+    finally:
+        heap.stop()
+
+    return "%d readings per cycle published with 0 bytes, %d bytes as strings" % (len(readings), strings)
+
+
+def check_settings() -> str:
+    """
+    Remote settings (micropython/settings.py): messages out of range are rejected, the interval and the CAQI
+    window above the u16 fields of the cache too, and the largest accepted values are cached exactly
+    """
+    host_modules(Clock())
+    sys.modules.pop("settings", None)
+    from settings import Settings
+
+    rejected = (
+        b"1;2;9;30;0;64000000;3600",  # interval too short
+        b"1;2;300;30;4;64000000;3600",  # BMP180 mode
+        b"1;2;300;30;0;64000000;299",  # CAQI window shorter than the interval
+        b"1;2;300;30;0;64000000;86400",  # CAQI window over u16
+        b"1;2;70000;30;0;64000000;70000",  # interval over u16
+    )
+    with tempfile.TemporaryDirectory(prefix="settings-") as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)  # settings.bin is saved in the working directory
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                for msg in rejected:
+                    settings = Settings()
+                    settings.on_message(b"box/config", msg)
+                    try:
+                        accepted = settings.apply_pending()
+                    except struct.error:
+                        accepted = True  # CPython refuses to pack what MicroPython truncates
+                    check(not accepted, "settings %s accepted", msg.decode())
+
+                settings = Settings()
+                settings.on_message(b"box/config", b"1;2;65535;120;3;133000000;65535")
+                check(settings.apply_pending(), "the largest settings were rejected")
+                cached = Settings()
+                check(cached.load(), "the settings weren't cached")
+                check((cached.interval, cached.caqi_window) == (65_535, 65_535),
+                      "interval %d and CAQI window %d cached instead of 65535", cached.interval, cached.caqi_window)
+        finally:
+            os.chdir(cwd)
+
+    return "%d messages out of range rejected, the largest values cached exactly" % len(rejected)
+
+
+def check_pms_worker() -> str:
+    """
+    PMSWorker (micropython/pms.py) on a real thread: the warm-up overlaps the rest of the cycle,
+    every wait() returns the frame of its own request, a warm-up of 120 s doesn't time out
+    """
+    clock = ScaledClock(scale=200)
+    host_modules(clock)
+    sys.modules.pop("pms", None)
+    import pms as pms_module
+    pms_module.sleep = clock.sleep  # imported from time, which the host modules don't replace
+
+    warmup = 30
+    other_ms = 6_000  # WiFi, MQTT and the I2C conversions
+
+    # sequential: the cycle before the worker
+    driver = CountingPMS(clock)
+    start = time.perf_counter()
+    driver.wake_up()
+    clock.sleep(warmup)
+    driver.prepare_read()
+    driver.read()
+    driver.sleep()
+    clock.sleep_ms(other_ms)
+    sequential = time.perf_counter() - start
+
+    worker = pms_module.PMSWorker(CountingPMS(clock), warmup=warmup)
+    start = time.perf_counter()
+    seq = worker.request()
+    clock.sleep_ms(other_ms)
+    frame = worker.wait(seq)
+    parallel = time.perf_counter() - start
+    check(frame is not None and frame[0] == 1, "the worker returned %r", frame)
+    speedup = sequential / parallel
+    check(speedup > 1.1, "no overlap: %.3f s with the worker, %.3f s without", parallel, sequential)
+
+    # every wait() gets the frame of its request, with the threads switching as often as possible
+    switch = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        worker.warmup = 0
+        for i in range(500):
+            seq = worker.request()
+            frame = worker.wait(seq)
+            check(frame is not None and frame[0] == seq + 1 and len(set(frame)) == 1,
+                  "request %d got frame %r", seq, frame)
+    finally:
+        sys.setswitchinterval(switch)
+
+    # the longest warm-up of the settings
+    worker.warmup = 120
+    clock.scale = 2_000
+    frame = worker.wait(worker.request())
+    check(frame is not None, "a warm-up of 120 s timed out")
+
+    return "speedup %.2fx (%.3f s against %.3f s), 500 requests without races" % (speedup, parallel, sequential)
+
+
+def check_pms_irq() -> str:
+    """IRQ reception of the PMS (micropython/pms.py): frames decoded, one lost frame per ring buffer overflow"""
+    clock = Clock()
+    host_modules(clock)
+    sys.modules.pop("pms", None)
+    import pms as pms_module
+
+    uart = StreamUART()
+    pms = pms_module.PMS(uart)
+    check(pms.enable_irq(), "the RX interrupt wasn't enabled")
+
+    stream = b"".join(pms_frame(i) for i in range(40))
+    uart.received(stream[:5 * 32])
+    clock.run_pending()
+    check(pms.frames_ok == 5 and pms._frame[4] == 4, "decoded %d frames instead of 5", pms.frames_ok)
+
+    # the decoder doesn't run while 20 chunks arrive: a single overflow
+    uart.received(stream[5 * 32:25 * 32])
+    check(pms.frames_lost == 1, "one overflow counted %d times", pms.frames_lost)
+    dropped = pms.bytes_dropped
+    check(dropped == 20 * 32 - (pms_module.RING_SIZE - 1), "%d bytes dropped", dropped)
+    clock.run_pending()
+
+    # room again, then a second overflow
+    decoded = pms.frames_ok
+    uart.received(stream[25 * 32:])
+    clock.run_pending()
+    check(pms.frames_lost == 2, "two overflows counted %d times", pms.frames_lost)
+    check(pms.frames_ok > decoded and pms._frame[4] > 24, "no frame decoded after the overflow")
+
+    return "%d frames, %d lost, %d bytes dropped" % (pms.frames_ok, pms.frames_lost, pms.bytes_dropped)
+
+
+MQTT_DEADLINE = 5_000  # ms, as in micropython/conf.py
+CONNACK = b"\x20\x02\0\0"
+CONFIG_TOPIC = b"box01/config"
+CONFIG = b"1;2;300;30;0;64000000;3600"
+CONFIG_PUBLISH = bytes((0x30, 2 + len(CONFIG_TOPIC) + len(CONFIG))) + struct.pack("!H", len(CONFIG_TOPIC)) \
+    + CONFIG_TOPIC + CONFIG
+CONNECT_SIZE = 2 + 10 + 2 + len("box01")  # CONNECT of MQTT 3.1.1 without credentials
+
+# broker, call after the connection (None: the connection itself), whether it must time out
+MQTT_CASES = (
+    ("no SYN-ACK", dict(accept_ms=None), None, True),
+    ("no CONNACK", dict(reply=b""), None, True),
+    ("CONNACK trickling", dict(trickle_ms=2_000), None, True),
+    ("slow CONNACK", dict(trickle_ms=1_000), None, False),
+    ("send buffer full", dict(window=CONNECT_SIZE + 5), lambda c: c.publish("box01/pm25", "12.5"), True),
+    ("send buffer full", dict(window=CONNECT_SIZE), lambda c: c.publish_num("box01/pm25", 125, 1), True),
+    ("send buffer full", dict(window=CONNECT_SIZE), lambda c: c.disconnect(), True),
+    ("PUBLISH trickling", dict(reply=CONNACK + CONFIG_PUBLISH, trickle_ms=400), lambda c: c.wait_msg(), True),
+    ("idle", dict(), lambda c: c.check_msg(), False),
+)
+
+
+def check_mqtt_deadline() -> str:
+    """
+    MQTTClient (micropython/mqtt.py) against brokers that stall or trickle: every call returns,
+    or raises ETIMEDOUT, within its deadline
+    """
+    clock = Clock()
+    host_modules(clock)
+    sys.modules["usocket"] = types.ModuleType("usocket")
+    sys.modules.pop("mqtt", None)
+    import mqtt as mqtt_module
+    mqtt_module.select = types.SimpleNamespace(
+        POLLIN=select.POLLIN, POLLOUT=select.POLLOUT, poll=lambda: VirtualPoll(clock)
+    )
+    mqtt_module.socket.getaddrinfo = lambda host, port: [(0, 0, 0, "", (host, port))]
+
+    worst = 0
+    for name, broker, call, stalls in MQTT_CASES:
+        sock = BrokerSocket(clock, **broker)
+        mqtt_module.socket.socket = lambda: sock
+        client = mqtt_module.MQTTClient("box01", "broker")
+
+        client.set_deadline(MQTT_DEADLINE)
+        start = clock.ms
+        try:
+            if call is None:
+                client.connect()
+            else:
+                client.connect()
+                client.set_deadline(MQTT_DEADLINE)
+                start = clock.ms
+                call(client)
+        except OSError as e:
+            check(stalls, "%s: unexpected %r", name, e)
+            check(e.args[0] == errno.ETIMEDOUT, "%s: %r instead of ETIMEDOUT", name, e)
+        else:
+            check(not stalls, "%s: the call returned after %d ms", name, clock.ms - start)
+
+        elapsed = clock.ms - start
+        check(elapsed <= MQTT_DEADLINE, "%s: returned after %d ms, past the deadline of %d ms",
+              name, elapsed, MQTT_DEADLINE)
+        worst = max(worst, elapsed)
+
+    return "%d stalled or trickling brokers, worst case %d ms with a deadline of %d ms" % (
+        len(MQTT_CASES), worst, MQTT_DEADLINE
+    )
+
+
+# readings of a default cycle as published by micropython/main.py: field, value, decimals
+MQTT_READINGS = (
+    ("temperature", 215, 1), ("humidity", 453, 1), ("pressure", 1013, 0), ("eco2", 412, 0), ("tvoc", 25, 0),
+    ("caqi", 12, 0), ("pm01", 3, 0), ("pm25", 7, 0), ("pm100", 9, 0),
+)
+MQTT_CYCLES = 12
+# CONNACK of a 5.0 broker with a Topic Alias Maximum of 16
+MQTT5_CONNACK = b"\x20\x06\0\0\x03\x22\0\x10"
+
+
+def check_mqtt_bytes() -> str:
+    """
+    MQTT bytes sent per cycle by MQTTClient (micropython/mqtt.py) with 3.1.1 and 5.0, as in micropython/main.py:
+    connect, subscribe to the settings, publish the sequence number and the readings, disconnect. Topic aliases
+    only pay off when a connection lasts several cycles: with a connection per cycle 5.0 sends more.
+    """
+    clock = Clock()
+    host_modules(clock)
+    sys.modules["usocket"] = types.ModuleType("usocket")
+    sys.modules.pop("mqtt", None)
+    import mqtt as mqtt_module
+    mqtt_module.select = types.SimpleNamespace(
+        POLLIN=select.POLLIN, POLLOUT=select.POLLOUT, poll=lambda: VirtualPoll(clock)
+    )
+    mqtt_module.socket.getaddrinfo = lambda host, port: [(0, 0, 0, "", (host, port))]
+
+    def per_cycle(version: int, expiry: int, cycles_per_connection: int) -> int:
+        client = mqtt_module.MQTTClient("box01", "broker", keepalive=60, version=version, message_expiry=expiry)
+        client.set_callback(lambda topic, msg: None)
+        for seq in range(MQTT_CYCLES):
+            if seq % cycles_per_connection == 0:
+                sock = BrokerSocket(clock, reply=MQTT5_CONNACK if version == 5 else b"\x20\x02\0\0")
+                mqtt_module.socket.socket = lambda: sock
+                client.connect()
+                client.subscribe("box01/config")
+            client.publish_num("box01/seq", seq)
+            for field, value, decimals in MQTT_READINGS:
+                client.publish_num("box01/" + field, value, decimals)
+            if seq % cycles_per_connection == cycles_per_connection - 1:
+                while client.check_msg() is not None:
+                    pass
+                client.disconnect()
+        return client.bytes_sent // MQTT_CYCLES
+
+    results = []
+    for cycles_per_connection in (1, 2, MQTT_CYCLES):
+        v4 = per_cycle(4, 0, cycles_per_connection)
+        v5 = per_cycle(5, 0, cycles_per_connection)
+        expiry = per_cycle(5, 3600, cycles_per_connection)
+        check(v4 < v5 < expiry if cycles_per_connection == 1 else v5 < v4,
+              "%d cycles per connection: 3.1.1 sent %d bytes per cycle, 5.0 %d", cycles_per_connection, v4, v5)
+        results.append("%d per connection 3.1.1 %d, 5.0 %d (%d with expiry)" % (
+            cycles_per_connection, v4, v5, expiry
+        ))
+
+    return "bytes per cycle: " + "; ".join(results)
+
+
+TLS_CONNECTIONS = 20
+
+
+def tls_certificate(workdir: str) -> tuple[str, str]:
+    """Self-signed certificate of the broker for localhost, and its key"""
+    cert = os.path.join(workdir, "cert.pem")
+    key = os.path.join(workdir, "key.pem")
+    try:
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-256", "-nodes",
+             "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=localhost",
+             "-addext", "subjectAltName=DNS:localhost"],
+            check=True, capture_output=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise CheckFailed("can't create the certificate of the broker with openssl: %s" % e)
+    return cert, key
+
+
+def tls_broker(cert: str, key: str, version: ssl.TLSVersion) -> socket.socket:
+    """Local TLS server answering every connection with a CONNACK. Returns the listening socket, closed to stop it"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    context.maximum_version = version
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return  # closed
+            try:
+                with context.wrap_socket(conn, server_side=True) as tls:
+                    tls.sendall(CONNACK)
+                    while tls.recv(64):
+                        pass
+            except OSError:
+                pass
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener
+
+
+class SessionlessSocket:
+    """TLS socket of a port without sessions, like the ssl module of MicroPython"""
+
+    def __init__(self, sock: ssl.SSLSocket):
+        self._sock = sock
+
+    def __getattr__(self, name: str):
+        if name in ("session", "session_reused"):
+            raise AttributeError(name)
+        return getattr(self._sock, name)
+
+
+class SessionlessContext:
+    """TLS context of a port without sessions: wrap_socket() takes no session either"""
+
+    def __init__(self, context: ssl.SSLContext):
+        self._context = context
+
+    def wrap_socket(self, sock, server_hostname: str = None) -> SessionlessSocket:
+        return SessionlessSocket(self._context.wrap_socket(sock, server_hostname=server_hostname))
+
+
+def tls_connect(client, port: int) -> float:
+    """Handshake of the client with the broker and read of the CONNACK. Returns the seconds of the handshake"""
+    sock = socket.create_connection(("127.0.0.1", port))
+    client.sock = sock
+    client._poll.register(sock, select.POLLOUT)
+
+    start = time.perf_counter()
+    client._handshake()
+    elapsed = time.perf_counter() - start
+
+    # with TLS 1.3 the session ticket arrives before the CONNACK
+    reply = b""
+    while len(reply) < len(CONNACK):
+        select.select([client.sock], [], [], 5)
+        try:
+            reply += client.sock.recv(len(CONNACK) - len(reply))
+        except ssl.SSLWantReadError:
+            pass
+    client._close()
+    return elapsed
+
+
+def check_tls() -> str:
+    """
+    TLS of MQTTClient (micropython/mqtt.py) on CPython, whose ssl module exposes the sessions: the contexts
+    of tls_context() connect, every reconnection resumes the session, full and resumed handshakes are timed.
+    Without sessions, as on MicroPython, every reconnection makes a full handshake.
+    """
+    host_modules(Clock())
+    sys.modules["usocket"] = socket
+    sys.modules.pop("mqtt", None)
+    import mqtt as mqtt_module
+    mqtt_module.select = types.SimpleNamespace(POLLIN=select.POLLIN, POLLOUT=select.POLLOUT, poll=HostPoll)
+
+    try:
+        unverified = mqtt_module.tls_context()
+    except ValueError as e:
+        raise CheckFailed("tls_context() without a CA: %s" % e)
+
+    timings = []
+    with tempfile.TemporaryDirectory(prefix="tls-") as workdir:
+        cert, key = tls_certificate(workdir)
+        verified = mqtt_module.tls_context(cert)
+        for version in (ssl.TLSVersion.TLSv1_2, ssl.TLSVersion.TLSv1_3):
+            listener = tls_broker(cert, key, version)
+            port = listener.getsockname()[1]
+            try:
+                tls_connect(mqtt_module.MQTTClient("box01", "localhost", ssl_context=unverified), port)
+
+                # a new client has no session: full handshakes
+                full = []
+                for _ in range(TLS_CONNECTIONS):
+                    client = mqtt_module.MQTTClient("box01", "localhost", ssl_context=verified)
+                    full.append(tls_connect(client, port))
+                    check(not client.resumed, "the first connection resumed a session")
+
+                resumed = []
+                for i in range(TLS_CONNECTIONS):
+                    resumed.append(tls_connect(client, port))
+                    check(client.resumed, "reconnection %d made a full handshake (%s)", i + 1, version.name)
+
+                # the port of the board
+                sessionless = []
+                client = mqtt_module.MQTTClient("box01", "localhost", ssl_context=SessionlessContext(verified))
+                for i in range(TLS_CONNECTIONS):
+                    sessionless.append(tls_connect(client, port))
+                    check(not client.resumed and client._session is None,
+                          "reconnection %d resumed a session without sessions (%s)", i + 1, version.name)
+            finally:
+                listener.close()
+            timings.append("%s full %.2f ms, resumed %.2f ms, without sessions %.2f ms" % (
+                version.name, statistics.median(full) * 1_000, statistics.median(resumed) * 1_000,
+                statistics.median(sessionless) * 1_000
+            ))
+
+    return "median handshakes: " + "; ".join(timings)
+
+
+SGP30_RH = range(0, 1_001)  # 0.1 %
+SGP30_TEMP = range(-400, 501)  # 0.1 degree
+RP2_FLOAT_BYTES = 16  # the rp2 port boxes every float in a heap block
+
+
+class CountedFloat(float):
+    """Float that counts the floats created by arithmetic on it, each a heap allocation on the rp2 port"""
+
+    created = 0
+
+    @classmethod
+    def box(cls, value: float) -> "CountedFloat":
+        cls.created += 1
+        return cls(value)
+
+
+for _name in ("add", "sub", "mul", "truediv"):
+    for _method in ("__%s__" % _name, "__r%s__" % _name):
+        setattr(CountedFloat, _method, lambda self, other, _op=getattr(float, _method): CountedFloat.box(
+            _op(self, other)))
+
+
+def check_sgp30_humidity() -> str:
+    """
+    Humidity compensation of the SGP30 (micropython/sgp30.py): set_iaq_rel_humidity_fixed() sends the value of
+    set_iaq_rel_humidity() for every relative humidity and temperature in 0.1 steps, with small ints only on the
+    rp2 port. Both are timed on the host, and the floats that set_iaq_rel_humidity() creates are counted.
+    """
+    host_modules(Clock())
+    sys.modules.pop("sgp30", None)
+    import sgp30 as sgp30_module
+
+    sgp30 = sgp30_module.SGP30(SensorBus(), init=False)
+    sent = []
+    sgp30._set_humidity = sent.append  # the value of the command, without the I2C transaction
+    fixed_s = float_s = 0.0
+    for temp in SGP30_TEMP:
+        start = time.perf_counter()
+        for rh in SGP30_RH:
+            sgp30.set_iaq_rel_humidity_fixed(rh, temp)
+        fixed_s += time.perf_counter() - start
+        fixed = sent[:]
+        sent.clear()
+
+        arguments = [(rh / 10, temp / 10) for rh in SGP30_RH]
+        start = time.perf_counter()
+        for rh, t in arguments:
+            sgp30.set_iaq_rel_humidity(rh, t)
+        float_s += time.perf_counter() - start
+        for rh, value, expected in zip(SGP30_RH, fixed, sent):
+            check(value == expected, "at %.1f C, %.1f %% RH: %d sent instead of %d", temp / 10, rh / 10, value,
+                  expected)
+        sent.clear()
+
+    # rh * entry in two halves: MicroPython boxes the ints from 2^30
+    table = sgp30_module._AH_TABLE
+    largest = max(
+        SGP30_RH[-1] * (table[i] << 8 | table[i + 1]) + ((SGP30_RH[-1] * (table[i + 2] << 8 | table[i + 3])) >> 16)
+        for i in range(0, len(table), 4)
+    )
+    check(largest < 1 << 30, "the largest product %d isn't a small int on MicroPython", largest)
+
+    # the arguments, the arithmetic and exp() of the float version
+    sgp30_module.math = types.SimpleNamespace(exp=lambda x: CountedFloat.box(math.exp(x)))
+    CountedFloat.created = 0
+    sgp30.set_iaq_rel_humidity(CountedFloat.box(45.3), CountedFloat.box(21.5))
+    floats = CountedFloat.created
+
+    calls = len(SGP30_RH) * len(SGP30_TEMP)
+    return "%d inputs sent the same value, %.2f us per call against %.2f us with floats, which allocate %d " \
+           "floats (%d bytes on rp2) against none" % (
+               calls, fixed_s / calls * 1e6, float_s / calls * 1e6, floats, floats * RP2_FLOAT_BYTES
+           )
+
+
+REPLAY_CYCLES = 16  # per boot: past the CAQI window and the save of the SGP30 baselines
+REPLAY_FAILING = (5, 6)  # cycles in which the SGP30 doesn't answer: a failure, then the breaker skips a cycle
+REPLAY_REPEAT = 20
+
+
+def record_trace(path: str, clock: Clock) -> list[tuple]:
+    """
+    Record a trace like main.py with TRACE: a cold boot and a warm one of the firmware pipeline on the simulated
+    sensors. Returns the rows of the readings
+    """
+    sensors = firmware(clock)
+    sys.modules.pop("trace", None)  # the recorder of the firmware, not the module of the standard library
+    import trace as trace_module
+    from i2cbus import I2CBus
+    from settings import Settings
+    from snapshot import Snapshot
+
+    bus = SensorBus()
+    uart = RequestUART()
+    settings = Settings()
+    readings = [0] * len(FIELDS)
+    rows = []
+    snapshot = None
+    seq = 0
+
+    for warm in (False, True):
+        writer = trace_module.TraceWriter(path, warm_boot=warm)
+        i2c = I2CBus(bus)
+        pipeline = sensors.Pipeline(
+            ("aht20", "bmp180", "sgp30", "pms7003"), FIELDS, i2c, trace_module.TraceI2C(i2c, writer),
+            trace_module.TraceUART(uart, writer), settings, warm, NoAudit()
+        )
+        pipeline.setup(warm)
+        if warm:
+            pipeline.restore(snapshot, clock.ms // 1000 - RESET_SLEEP_S)
+        writer.flush()
+
+        boot = clock.ms + pipeline.settle_ms()
+        for i in range(REPLAY_CYCLES):
+            seq += 1
+            clock.ms = boot + i * settings.interval * 1_000
+            bus.cycle = seq
+            bus.failing = {0x58} if seq in REPLAY_FAILING else set()
+            writer.cycle(seq)
+            pipeline.start(True)
+            valid = pipeline.measure(readings, True)
+            rows.append(row(seq, readings, valid))
+            writer.flush()
+
+        # a reset: the snapshot, then the sleep until the warm boot
+        snapshot = Snapshot()
+        pipeline.save(snapshot)
+        clock.ms = (clock.ms // 1_000 + RESET_SLEEP_S + 1) * 1_000
+    return rows
+
+
+def check_replay() -> str:
+    """
+    Trace replay (scripts/trace_replay.py): a trace recorded by the firmware on simulated sensors, with a failing
+    SGP30 and a warm boot, replays to the same readings with polling and with the RX interrupt; a driver that
+    writes something else fails the replay. The replay is timed.
+    """
+    with tempfile.TemporaryDirectory(prefix="replay-") as workdir:
+        path = os.path.join(workdir, "trace.bin")
+        cwd = os.getcwd()
+        os.chdir(workdir)  # the SGP30 baselines are saved in the working directory
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                expected = record_trace(path, Clock())
+        finally:
+            os.chdir(cwd)
+
+        columns = ("seq",) + SENSOR_FIELDS
+        check(any(r[columns.index("caqi")] is not None for r in expected), "no CAQI in the recording")
+        check(sum(r[columns.index("eco2")] is None for r in expected) == 3, "the SGP30 didn't fail 3 cycles")
+
+        trace = Trace(path)
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                for irq in (False, True):
+                    result = replay(trace, irq=irq)
+                    check(result.boots == 2 and len(result.rows) == len(expected), "%d boots, %d cycles replayed",
+                          result.boots, len(result.rows))
+                    for got, want in zip(result.rows, expected):
+                        check(got == want, "cycle %d replayed %s as %r instead of %r",
+                              want[0], "with the RX interrupt" if irq else "polling", got, want)
+
+                try:
+                    replay(trace, bmp_mode=3)
+                except ReplayMismatch:
+                    pass
+                else:
+                    raise CheckFailed("a BMP180 mode different from the recording replayed without errors")
+
+                start = time.perf_counter()
+                for _ in range(REPLAY_REPEAT):
+                    replay(trace)
+                elapsed = (time.perf_counter() - start) / REPLAY_REPEAT
+        finally:
+            trace.close()
+
+    return "%d cycles in 2 boots replayed as recorded, %.0f cycles/s" % (len(expected), len(expected) / elapsed)
+
+
+CHECKS = {
+    "audit": check_audit,
+    "audit-publish": check_audit_publish,
+    "settings": check_settings,
+    "pms-worker": check_pms_worker,
+    "pms-irq": check_pms_irq,
+    "mqtt-deadline": check_mqtt_deadline,
+    "mqtt-bytes": check_mqtt_bytes,
+    "tls": check_tls,
+    "sgp30-humidity": check_sgp30_humidity,
+    "replay": check_replay,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run parts of the firmware on the host and check their behaviour")
+    parser.add_argument("check", nargs="*", help="checks to run: %s (default: all)" % ", ".join(CHECKS))
+    args = parser.parse_args()
+    for name in args.check:
+        if name not in CHECKS:
+            parser.error("Unknown check %s" % name)
+
+    failed = 0
+    for name in args.check or CHECKS:
+        start = time.perf_counter()
+        try:
+            summary = CHECKS[name]()
+        except CheckFailed as e:
+            failed += 1
+            print("%-14s FAILED: %s" % (name, e))
+        else:
+            print("%-14s ok, %s (%.2f s)" % (name, summary, time.perf_counter() - start))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
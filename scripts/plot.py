@@ -1,11 +1,19 @@
+import argparse
+import contextlib
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import tempfile
+import time
+from typing import TYPE_CHECKING, Optional
 
-from influxdb_client import InfluxDBClient
+# the heavy modules (numpy, pandas, matplotlib, InfluxDB) are imported by the subcommands that use them
+if TYPE_CHECKING:
+    import pandas as pd
 
 
+# Local store (scripts/tsstore.py); without it the data is queried from InfluxDB
+TSSTORE_PATH = os.getenv("TSSTORE_PATH")
+BOX = os.getenv("BOX", "box01")
+
 INFLUXDB_HOST = os.getenv("INFLUXDB_HOST")
 INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN")
 INFLUXDB_ORG = os.getenv("INFLUXDB_ORG", "Home")
@@ -20,11 +28,33 @@ from(bucket: "")
     |> drop(columns:["_start", "_stop", "_measurement", "category", "item", "label", "type"])
 """
 
-
-client = InfluxDBClient(url=INFLUXDB_HOST, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
-
-
-def get_data(measurement: str) -> pd.Series:
+# InfluxDB measurement of every field (MQTT topic) stored locally
+MEASUREMENTS = {
+    "temperature": "temp",
+}
+
+# Axis label of every field
+LABELS = {
+    "temperature": "Temperature (°C)",
+    "humidity": "Humidity (%)",
+    "pressure": "Pressure (Pa)",
+    "eco2": "eCO2 (ppm)",
+    "tvoc": "TVOC (ppb)",
+    "caqi": "CAQI",
+    "pm01": "PM1.0 (µg/m³)",
+    "pm25": "PM2.5 (µg/m³)",
+    "pm100": "PM10 (µg/m³)",
+    "vsys": "VSYS (mV)",
+}
+
+YEAR = 365 * 86400
+
+
+def get_influx_data(measurement: str) -> "pd.Series":
+    import pandas as pd
+    from influxdb_client import InfluxDBClient
+
+    client = InfluxDBClient(url=INFLUXDB_HOST, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
     query = QUERY.format(measurement=measurement)
     df = client.query_api().query_data_frame(org=INFLUXDB_ORG, query=query, data_frame_index="_time")
 
@@ -36,18 +66,145 @@ def get_data(measurement: str) -> pd.Series:
     return df.squeeze()
 
 
-def main():
-    ts = get_data("temp")
+def get_data(field: str, box: str = BOX, root: Optional[str] = TSSTORE_PATH) -> "pd.Series":
+    """A year of a field, from the local store if there is one"""
+    if root is None:
+        return get_influx_data(MEASUREMENTS.get(field, field))
+
+    from tsstore import Store
+
+    store = Store(root)
+    last = store.last(box, field)
+    if last is None:
+        raise ValueError("No %s data for %s in %s" % (field, box, root))
+    return store.series(box, field, start=last - YEAR)
+
+
+def draw(ts: "pd.Series", field: str, box: str):
+    """Box plot of every week of the year"""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
     fig, ax = plt.subplots(figsize=(14, 8))
-    sns.boxplot(x=ts.index.weekofyear, y=ts, ax=ax, showfliers=False)
+    sns.boxplot(x=ts.index.isocalendar().week.to_numpy(), y=ts.to_numpy(), ax=ax, showfliers=False)
+
+    ax.set_xlabel("Week of the year")
+    ax.set_ylabel(LABELS.get(field, field))
+    ax.set_title("%s in %s" % (LABELS.get(field, field).split(" (")[0], box))
+    return fig
+
 
-    plt.xlabel("Week of the year")
-    plt.ylabel("Temperature (°C)")
-    ax.set_title("Temperature in the hallway")
+# Report workers: the data is read from the memory maps of the store, shared through the page cache
+
+def _init_worker() -> None:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401, imported once per worker
+    import seaborn as sns
+    sns.set_style("whitegrid")
+
+
+def _render(task: tuple[str, str, str, str, str]) -> float:
+    root, box, field, path, fmt = task
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    fig = draw(get_data(field, box, root), field, box)
+    fig.savefig(path, format=fmt, dpi=100)
+    plt.close(fig)
+    return time.perf_counter() - start
+
+
+def fetch(root: str, fields: list[str], box: str = BOX) -> None:
+    """Download every field from InfluxDB once into the store read by the workers"""
+    from tsstore import Store, _import_influx
+
+    store = Store(root)
+    for field in fields:
+        _import_influx(store, box, field)
+
+
+def report(root: Optional[str], boxes: Optional[list[str]], fields: Optional[list[str]], out: str,
+           jobs: Optional[int], fmt: str) -> None:
+    from concurrent.futures import ProcessPoolExecutor
+    from tsstore import Store
+
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if root is None:
+            # the InfluxDB query has no box: its data is stored as a single box
+            if boxes and len(boxes) > 1:
+                raise ValueError("Without a local store only one box can be reported, not %s" % ", ".join(boxes))
+            root = stack.enter_context(tempfile.TemporaryDirectory(prefix="plot-"))
+            fetch(root, fields or list(MEASUREMENTS), boxes[0] if boxes else BOX)
+        fetched = time.perf_counter() - start
+
+        store = Store(root)
+        tasks = []
+        for box in boxes or store.boxes():
+            os.makedirs(os.path.join(out, box), exist_ok=True)
+            for field in store.fields(box):
+                if fields and field not in fields:
+                    continue
+                tasks.append((root, box, field, os.path.join(out, box, "%s.%s" % (field, fmt)), fmt))
+
+        jobs = jobs or os.cpu_count() or 1
+        durations = []
+        with ProcessPoolExecutor(jobs, initializer=_init_worker) as pool:
+            for duration in pool.map(_render, tasks):
+                if not durations:
+                    first = time.perf_counter() - start
+                durations.append(duration)
+        elapsed = time.perf_counter() - start
+
+    if durations:
+        print("%d plots in %s, %.2f s: data %.2f s, first plot after %.2f s, %.2f s per plot in %d workers" % (
+            len(tasks), out, elapsed, fetched, first, sum(durations) / len(durations), jobs
+        ))
+
+
+def show(root: Optional[str], box: str, field: str) -> None:
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    sns.set_style("whitegrid")
+    draw(get_data(field, box, root), field, box)
     plt.show()
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Plot the readings of the boxes")
+    parser.add_argument("--root", default=TSSTORE_PATH, help="directory of the local store (default: InfluxDB)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    show_parser = commands.add_parser("show", help="interactive plot of a field")
+    show_parser.add_argument("field", nargs="?", default="temperature")
+    show_parser.add_argument("--box", default=BOX)
+
+    report_parser = commands.add_parser("report", help="render the plots of every box and field headless")
+    report_parser.add_argument("--box", action="append", help="only these boxes (default: all)")
+    report_parser.add_argument("--field", action="append", help="only these fields (default: all)")
+    report_parser.add_argument("--out", default="report", help="output directory, one subdirectory per box")
+    report_parser.add_argument("--jobs", type=int, help="worker processes (default: one per CPU)")
+    report_parser.add_argument("--format", default="png", choices=("png", "svg", "pdf"))
+
+    fetch_parser = commands.add_parser("fetch", help="copy a year of the fields from InfluxDB into the local store")
+    fetch_parser.add_argument("field", nargs="*", default=list(MEASUREMENTS))
+    fetch_parser.add_argument("--box", default=BOX)
+
+    args = parser.parse_args()
+
+    if args.command == "show":
+        show(args.root, args.box, args.field)
+    elif args.command == "report":
+        if args.root is None and args.box and len(args.box) > 1:
+            parser.error("without --root or TSSTORE_PATH only one --box can be reported")
+        report(args.root, args.box, args.field, args.out, args.jobs, args.format)
+    elif args.command == "fetch":
+        if args.root is None:
+            parser.error("fetch needs --root or TSSTORE_PATH")
+        fetch(args.root, args.field, args.box)
+
+
 if __name__ == "__main__":
-    sns.set_style("whitegrid")
     main()
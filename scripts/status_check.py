@@ -1,43 +1,371 @@
+import argparse
 import asyncio
 import time
+from array import array
+from typing import Optional
+
 import asyncio_mqtt as aiomqtt
-from concurrent.futures import ProcessPoolExecutor
 
 
-last_cycle: int = 0
+STATUS_TIMEOUT = 600  # s without messages before a box is OFF, or two intervals published by the box if longer
+STATUS_INTERVAL = 60  # s between two status updates
 
+# Topics published by the boxes, <box>/<field>: the readings of micropython/main.py, the cycle sequence number and
+# the blocks of the radio-off mode. Other topics on the broker, <box>/status included, aren't boxes.
+FIELDS = (
+    "seq", "temperature", "humidity", "pressure", "eco2", "tvoc", "caqi", "pm01", "pm25", "pm100",
+    "vsys", "interval", "autonomy", "block",
+)
 
-async def check_last_cycle(client: aiomqtt.Client):
-    global last_cycle
-    while True:
-        # if no data received in 10 minutes, send off topic
-        if time.time() - last_cycle > 600:
-            print('client is dead')
-            await client.publish('box01/status', payload='OFF')
+# Inter-arrival histograms, HDR style: values in ms, SUB_BITS bits of precision in every power of two.
+# Values below 2 ** (SUB_BITS + 1) ms are exact, the others have a relative error below 2 ** -SUB_BITS (1.6%).
+SUB_BITS = 6
+SUB_COUNT = 1 << SUB_BITS
+MAX_BITS = 22  # values from 2 ** 22 ms (70 min) go in the overflow bucket
+OVERFLOW = (MAX_BITS - SUB_BITS + 1) * SUB_COUNT
+BUCKETS = OVERFLOW + 1
+QUANTILES = (0.5, 0.9, 0.99)
+
+CONTENT_TYPE = b"application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def bucket_index(ms: int) -> int:
+    if ms < 2 * SUB_COUNT:
+        return ms
+    shift = ms.bit_length() - SUB_BITS - 1
+    if shift > MAX_BITS - SUB_BITS - 1:
+        return OVERFLOW
+    return shift * SUB_COUNT + (ms >> shift)
+
+
+def bucket_upper(index: int) -> int:
+    """Upper bound (ms, excluded) of a bucket"""
+    if index < 2 * SUB_COUNT:
+        return index + 1
+    shift = index // SUB_COUNT - 1
+    return (index % SUB_COUNT + SUB_COUNT + 1) << shift
+
+
+class Histogram:
+    """Fixed memory histogram of the time between two messages of a topic"""
+
+    __slots__ = ("counts", "count", "sum_ms", "max_ms")
+
+    def __init__(self):
+        self.counts = array("I", bytes(4 * BUCKETS))
+        self.count = 0
+        self.sum_ms = 0
+        self.max_ms = 0
+
+    def record(self, ms: int) -> None:
+        self.counts[bucket_index(ms)] += 1
+        self.count += 1
+        self.sum_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def quantiles(self, qs: tuple) -> list[int]:
+        """Upper bound (ms) of the bucket of every quantile, in increasing order"""
+        result = []
+        ranks = [q * self.count for q in qs]
+        seen = 0
+        for index, n in enumerate(self.counts):
+            if not n:
+                continue
+            seen += n
+            while len(result) < len(ranks) and seen >= ranks[len(result)]:
+                result.append(self.max_ms if index == OVERFLOW else min(bucket_upper(index), self.max_ms))
+            if len(result) == len(ranks):
+                break
+        return result
+
+    def octaves(self):
+        """
+        Cumulative counts below every power of two ms, the buckets of the exposition: (le in ms, count).
+        The values are whole ms, so the values below 2 ** bits are the ones <= 2 ** bits - 1, the
+        inclusive bound required by le.
+        """
+        counts = self.counts
+        total = 0
+        lo = 0
+        # exact buckets up to 2 ** (SUB_BITS + 1), then SUB_COUNT buckets per power of two
+        for bits in range(SUB_BITS + 1, MAX_BITS + 1):
+            hi = (bits - SUB_BITS + 1) * SUB_COUNT
+            total += sum(counts[lo:hi])
+            lo = hi
+            yield (1 << bits) - 1, total
+
+
+class Series:
+    """Messages of a topic"""
+
+    __slots__ = ("box", "labels", "messages", "last_ns", "histogram")
+
+    def __init__(self, box: "Box", topic: str):
+        self.box = box
+        self.labels = 'box="%s",topic="%s"' % (box.name, topic)
+        self.messages = 0
+        self.last_ns = 0
+        self.histogram = Histogram()
+
+
+class Box:
+    """State of a box: the sequence numbers of its cycles and its status"""
+
+    __slots__ = ("name", "labels", "messages", "last_ns", "last_time", "seq", "cycles", "lost", "restarts",
+                 "duplicates", "interval", "status", "rate", "_rate_messages")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.labels = 'box="%s"' % name
+        self.messages = 0
+        self.last_ns = 0
+        self.last_time = 0.0  # UNIX time of the last message
+        self.seq = -1  # last cycle sequence number
+        self.cycles = 0  # sequence numbers received
+        self.lost = 0  # cycles missing from the sequence
+        self.restarts = 0  # the sequence went back (reset without snapshot)
+        self.duplicates = 0
+        self.interval = 0  # s before the next cycle, published with the energy-aware scheduling
+        self.status = False
+        self.rate = 0.0  # messages/s between the last two status updates
+        self._rate_messages = 0
+
+    def timeout(self) -> int:
+        """s without messages before the box is OFF: a cycle may be skipped"""
+        return max(STATUS_TIMEOUT, 2 * self.interval)
+
+    def sequence(self, seq: int) -> None:
+        self.cycles += 1
+        if self.seq >= 0:
+            if seq == self.seq:
+                self.duplicates += 1
+            elif seq > self.seq:
+                self.lost += seq - self.seq - 1
+            else:
+                self.restarts += 1
+        self.seq = seq
+
+
+class Exporter:
+    """
+    Metrics of the messages published by the boxes, ``<box>/<field>`` with a field of FIELDS.
+
+    The state of a topic is created with its first message, its histogram is fixed
+    size: a message updates counters in place. At most max_series topics are tracked,
+    the messages of the others and of unknown topics are only counted.
+
+    :param int max_series: maximum number of topics
+    """
+
+    def __init__(self, max_series: int = 10_000):
+        self.max_series = max_series
+        self.boxes: dict[str, Box] = {}
+        self.series: dict[str, Series] = {}
+        self.untracked = 0  # messages of unknown topics and of topics over max_series
+
+    def _series(self, topic: str) -> Optional[Series]:
+        box_name, _, field = topic.partition("/")
+        if not box_name or field not in FIELDS or len(self.series) >= self.max_series:
+            return None
+        box = self.boxes.get(box_name)
+        if box is None:
+            box = self.boxes[box_name] = Box(box_name)
+        series = self.series[topic] = Series(box, field)
+        return series
+
+    def on_message(self, topic: str, payload: bytes, now_ns: int) -> None:
+        series = self.series.get(topic)
+        if series is None:
+            series = self._series(topic)
+            if series is None:
+                self.untracked += 1
+                return
+
+        if series.last_ns:
+            series.histogram.record((now_ns - series.last_ns) // 1_000_000)
+        series.last_ns = now_ns
+        series.messages += 1
+
+        box = series.box
+        box.messages += 1
+        box.last_ns = now_ns
+        if topic.endswith("/seq"):
+            try:
+                box.sequence(int(payload))
+            except ValueError:
+                pass
+        elif topic.endswith("/interval"):
+            try:
+                box.interval = int(payload)
+            except ValueError:
+                pass
+
+    def update_status(self, now: float, now_ns: int) -> None:
+        """Status (ON if a message arrived within the timeout of the box) and message rate of every box"""
+        for box in self.boxes.values():
+            if box.last_ns:
+                box.last_time = now - (now_ns - box.last_ns) / 1e9
+            box.status = box.last_ns != 0 and now - box.last_time <= box.timeout()
+            box.rate = (box.messages - box._rate_messages) / STATUS_INTERVAL
+            box._rate_messages = box.messages
+
+    def render(self) -> bytes:
+        """The metrics in the OpenMetrics text format"""
+        lines = []
+        add = lines.append
+        boxes = self.boxes.values()
+        series = self.series.values()
+
+        add("# TYPE box_up gauge")
+        add("# HELP box_up 1 if the box sent a message in the last %d s, or two of its intervals" % STATUS_TIMEOUT)
+        for box in boxes:
+            add("box_up{%s} %d" % (box.labels, box.status))
+
+        add("# TYPE box_last_message_timestamp_seconds gauge")
+        for box in boxes:
+            add("box_last_message_timestamp_seconds{%s} %.3f" % (box.labels, box.last_time))
+
+        add("# TYPE box_message_rate gauge")
+        add("# HELP box_message_rate messages/s over the last %d s" % STATUS_INTERVAL)
+        for box in boxes:
+            add("box_message_rate{%s} %.4f" % (box.labels, box.rate))
+
+        add("# TYPE box_cycles counter")
+        add("# HELP box_cycles cycle sequence numbers received on <box>/seq")
+        for box in boxes:
+            add("box_cycles_total{%s} %d" % (box.labels, box.cycles))
+
+        add("# TYPE box_cycles_lost counter")
+        add("# HELP box_cycles_lost cycles missing from the sequence")
+        for box in boxes:
+            add("box_cycles_lost_total{%s} %d" % (box.labels, box.lost))
+
+        add("# TYPE box_sequence_restarts counter")
+        for box in boxes:
+            add("box_sequence_restarts_total{%s} %d" % (box.labels, box.restarts))
+
+        add("# TYPE box_sequence_duplicates counter")
+        for box in boxes:
+            add("box_sequence_duplicates_total{%s} %d" % (box.labels, box.duplicates))
+
+        add("# TYPE box_messages counter")
+        for s in series:
+            add("box_messages_total{%s} %d" % (s.labels, s.messages))
+
+        add("# TYPE box_interarrival_seconds histogram")
+        add("# HELP box_interarrival_seconds time between two messages of a topic")
+        for s in series:
+            h = s.histogram
+            for le, count in h.octaves():
+                add('box_interarrival_seconds_bucket{%s,le="%g"} %d' % (s.labels, le / 1000, count))
+            add('box_interarrival_seconds_bucket{%s,le="+Inf"} %d' % (s.labels, h.count))
+            add("box_interarrival_seconds_count{%s} %d" % (s.labels, h.count))
+            add("box_interarrival_seconds_sum{%s} %.3f" % (s.labels, h.sum_ms / 1000))
+
+        add("# TYPE box_interarrival_quantile_seconds gauge")
+        add("# HELP box_interarrival_quantile_seconds quantiles of the full resolution histogram (1.6%)")
+        for s in series:
+            h = s.histogram
+            if h.count:
+                for q, ms in zip(QUANTILES, h.quantiles(QUANTILES)):
+                    add('box_interarrival_quantile_seconds{%s,quantile="%g"} %.3f' % (s.labels, q, ms / 1000))
+                add('box_interarrival_quantile_seconds{%s,quantile="1"} %.3f' % (s.labels, h.max_ms / 1000))
+
+        add("# TYPE box_untracked_messages counter")
+        add("box_untracked_messages_total %d" % self.untracked)
+        add("# EOF")
+        add("")
+        return "\n".join(lines).encode()
+
+
+async def serve_metrics(exporter: Exporter, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await reader.readline()
+        # headers are ignored
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+            body = exporter.render()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (
+                CONTENT_TYPE, len(body)
+            ))
+            writer.write(body)
         else:
-            print('client is alive')
-            await client.publish('box01/status', payload='ON')
-        
-        await asyncio.sleep(60)
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def check_status(client: aiomqtt.Client, exporter: Exporter):
+    while True:
+        await asyncio.sleep(STATUS_INTERVAL)
+        exporter.update_status(time.time(), time.monotonic_ns())
+        for box in exporter.boxes.values():
+            await client.publish(box.name + "/status", payload="ON" if box.status else "OFF")
 
 
-async def run(client: aiomqtt.Client):
-    global last_cycle
+async def run(client: aiomqtt.Client, exporter: Exporter):
+    on_message = exporter.on_message
+    clock = time.monotonic_ns
     while True:
         try:
             async with client.messages() as messages:
-                await client.subscribe("box01/temperature")
+                # the fields of every box: not <box>/status, which is ours, nor the topics of other clients
+                await client.subscribe([("+/" + field, 0) for field in FIELDS])
                 async for message in messages:
-                    print('received message')
-                    last_cycle = time.time()
+                    on_message(message.topic.value, message.payload, clock())
         except aiomqtt.MqttError:
-            asyncio.sleep(5)
+            await asyncio.sleep(5)
+
+
+async def main(args):
+    exporter = Exporter(args.max_series)
+    server = await asyncio.start_server(
+        lambda r, w: serve_metrics(exporter, r, w), args.listen, args.http_port
+    )
+    async with server, aiomqtt.Client(args.broker, port=args.port) as client:
+        await asyncio.gather(run(client, exporter), check_status(client, exporter))
 
-async def main():
-    async with aiomqtt.Client("TOFILL") as client:
-        await asyncio.gather(run(client), check_last_cycle(client))
+
+def benchmark(boxes: int, messages: int) -> None:
+    """Throughput of the message path and time of an exposition, with the fields of every box"""
+    fields = FIELDS[:FIELDS.index("vsys") + 1]
+    topics = ["box%03d/%s" % (b, f) for b in range(boxes) for f in fields]
+    exporter = Exporter()
+    payload = b"21.5"
+    now = 0
+    start = time.perf_counter()
+    for i in range(messages):
+        topic = topics[i % len(topics)]
+        if i % len(topics) == 0:
+            now += 300_000_000_000 + (i * 7919 % 5_000) * 1_000_000  # a cycle, with some jitter
+        exporter.on_message(topic, b"%d" % (i // len(topics)) if topic.endswith("/seq") else payload, now)
+    elapsed = time.perf_counter() - start
+    print("%d messages, %d topics: %.0f messages/s (%.0f/min)" % (
+        messages, len(topics), messages / elapsed, messages / elapsed * 60
+    ))
+
+    exporter.update_status(time.time(), now)
+    start = time.perf_counter()
+    body = exporter.render()
+    print("exposition: %d bytes in %.3f s" % (len(body), time.perf_counter() - start))
 
 
 if __name__ == '__main__':
-    executor = ProcessPoolExecutor(2)
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Status of the boxes and OpenMetrics exporter of their messages")
+    parser.add_argument("--broker", default="TOFILL", help="MQTT broker")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--listen", default="0.0.0.0", help="address of the metrics endpoint")
+    parser.add_argument("--http-port", type=int, default=9108, help="port of the metrics endpoint (/metrics)")
+    parser.add_argument("--max-series", type=int, default=10_000, help="maximum number of topics tracked")
+    parser.add_argument("--benchmark", type=int, metavar="BOXES", help="measure the throughput with simulated boxes")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, 1_000_000)
+    else:
+        asyncio.run(main(args))
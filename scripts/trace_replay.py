@@ -0,0 +1,559 @@
+import argparse
+import contextlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+import types
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+# Trace format, written by micropython/trace.py
+TRACE_MAGIC = b"ST"
+TRACE_VERSION = 1
+HEADER = struct.Struct("<2sBB")  # magic, version, reserved
+RECORD = struct.Struct("<BBBHI")  # kind, address or UART id, register or errno, length, ms since the boot
+
+REC_I2C_WRITE = 1
+REC_I2C_READ = 2
+REC_I2C_MEM_WRITE = 3
+REC_I2C_MEM_READ = 4
+REC_I2C_ERROR = 5
+REC_UART_RX = 6
+REC_UART_TX = 7
+REC_BOOT = 8
+REC_CYCLE = 9
+
+I2C_KINDS = (REC_I2C_WRITE, REC_I2C_READ, REC_I2C_MEM_WRITE, REC_I2C_MEM_READ, REC_I2C_ERROR)
+
+FIRMWARE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "micropython")
+FIRMWARE_MODULES = ("sensors", "i2cbus", "settings", "snapshot", "caqi", "aht20", "bmp180", "sgp30", "pms")
+
+# Readings of micropython/main.py: the sensors produce the ones up to pm100, the energy scheduler the others
+FIELDS = (
+    "temperature", "humidity", "pressure", "eco2", "tvoc", "caqi",
+    "pm01", "pm25", "pm100", "vsys", "interval", "autonomy",
+)
+SENSOR_FIELDS = FIELDS[:FIELDS.index("vsys")]
+F_CAQI = FIELDS.index("caqi")
+F_PM25 = FIELDS.index("pm25")
+
+RESET_SLEEP_S = 60  # RESET_SLEEP_MS of micropython/main.py: a warm boot comes this late after the snapshot
+
+
+class ReplayMismatch(Exception):
+    """The code under replay didn't do the transaction that was recorded (not caught by the drivers)"""
+
+
+class ReplayExhausted(OSError):
+    """The code under replay asked for more data than was recorded"""
+
+
+@dataclass
+class Cycle:
+    seq: int
+    start: int  # ms since the boot
+    first: int  # index of the first record of the cycle
+    last: int  # index after the last record
+
+
+@dataclass
+class Boot:
+    time: int  # device time() at the boot
+    warm: bool
+    first: int  # index of the first record, before the first cycle (setup)
+    cycles: list[Cycle] = field(default_factory=list)
+
+
+class Trace:
+    """
+    Trace file, memory-mapped: the index keeps only offsets, the data of a record is a view of the file.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mm)
+
+        magic, version, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError("Unsupported trace: %s" % path)
+
+        # kind, address, register, length, ms, data offset of every record
+        self.records: list[tuple[int, int, int, int, int, int]] = []
+        self.boots: list[Boot] = []
+        self._index()
+
+    def _index(self) -> None:
+        mm = self._mm
+        size = len(mm)
+        pos = HEADER.size
+        unpack_from = RECORD.unpack_from
+        records = self.records
+        boot: Optional[Boot] = None
+
+        while pos + RECORD.size <= size:
+            kind, addr, reg, length, ms = unpack_from(mm, pos)
+            pos += RECORD.size
+            if pos + length > size:
+                break  # truncated by a reset during flush()
+            index = len(records)
+            records.append((kind, addr, reg, length, ms, pos))
+
+            if kind == REC_BOOT:
+                if boot is not None and boot.cycles:
+                    boot.cycles[-1].last = index
+                boot_time, warm = struct.unpack_from("<IB", mm, pos)
+                boot = Boot(boot_time, bool(warm), index + 1)
+                self.boots.append(boot)
+            elif kind == REC_CYCLE and boot is not None:
+                if boot.cycles:
+                    boot.cycles[-1].last = index
+                (seq,) = struct.unpack_from("<I", mm, pos)
+                boot.cycles.append(Cycle(seq, ms, index + 1, index + 1))
+            pos += length
+
+        if boot is not None and boot.cycles:
+            boot.cycles[-1].last = len(records)
+
+    def data(self, index: int) -> memoryview:
+        _, _, _, length, _, offset = self.records[index]
+        return self._view[offset:offset + length]
+
+    def close(self) -> None:
+        self._view.release()
+        self._mm.close()
+        self._file.close()
+
+
+class ReplayI2C:
+    """
+    I2C bus serving a window of the trace. Transactions are matched per address, so the
+    order in which the drivers are interleaved (which depends on timing) doesn't matter.
+
+    :param Trace trace: the trace
+    :param bool strict: raise ReplayMismatch when a write differs from the recording
+    """
+
+    def __init__(self, trace: Trace, strict: bool = True):
+        self.trace = trace
+        self.strict = strict
+        self._queues: dict[int, deque[int]] = {}
+        self._addresses: Optional[list[int]] = None
+        self.mismatches = 0
+
+    def window(self, first: int, last: int) -> None:
+        """Serve the records between first and last, dropping what's left of the previous window"""
+        self._queues = {}
+        records = self.trace.records
+        for i in range(first, last):
+            kind, addr = records[i][0], records[i][1]
+            if kind in I2C_KINDS:
+                self._queues.setdefault(addr, deque()).append(i)
+
+    def _next(self, addr: int, kind: int, reg: int = 0) -> int:
+        queue = self._queues.get(addr)
+        if not queue:
+            raise ReplayExhausted("No recorded transaction for 0x%02x" % addr)
+        index = queue.popleft()
+        rec_kind, _, rec_reg, _, _, _ = self.trace.records[index]
+        if rec_kind == REC_I2C_ERROR:
+            raise OSError(rec_reg, "Recorded I2C error")
+        if rec_kind != kind or rec_reg != reg:
+            raise ReplayMismatch("0x%02x: expected transaction %d (reg %d), replayed %d (reg %d)" % (
+                addr, rec_kind, rec_reg, kind, reg
+            ))
+        return index
+
+    def _check(self, index: int, buf) -> None:
+        if bytes(self.trace.data(index)) != bytes(buf):
+            self.mismatches += 1
+            if self.strict:
+                raise ReplayMismatch("0x%02x: written %s, recorded %s" % (
+                    self.trace.records[index][1], bytes(buf).hex(), bytes(self.trace.data(index)).hex()
+                ))
+
+    def _copy(self, index: int, buf) -> None:
+        data = self.trace.data(index)
+        n = min(len(data), len(buf))
+        buf[:n] = data[:n]
+
+    def writeto(self, addr: int, buf) -> None:
+        self._check(self._next(addr, REC_I2C_WRITE), buf)
+
+    def readfrom_into(self, addr: int, buf) -> None:
+        self._copy(self._next(addr, REC_I2C_READ), buf)
+
+    def readfrom_mem(self, addr: int, memaddr: int, nbytes: int) -> bytes:
+        return bytes(self.trace.data(self._next(addr, REC_I2C_MEM_READ, memaddr))[:nbytes])
+
+    def readfrom_mem_into(self, addr: int, memaddr: int, buf) -> None:
+        self._copy(self._next(addr, REC_I2C_MEM_READ, memaddr), buf)
+
+    def writeto_mem(self, addr: int, memaddr: int, buf) -> None:
+        self._check(self._next(addr, REC_I2C_MEM_WRITE, memaddr), buf)
+
+    def scan(self) -> list[int]:
+        """Addresses in the trace: every device that was recorded answered the scan at boot"""
+        if self._addresses is None:
+            self._addresses = sorted({r[1] for r in self.trace.records if r[0] in I2C_KINDS})
+        return self._addresses
+
+
+class ReplayUART:
+    """
+    UART serving the bytes received in a window of the trace.
+
+    Writes are checked against the recorded ones and bring the clock to the time of the recording, so that what
+    follows a command (e.g. the frame after a read request) happens at the recorded time. With polling, the driver
+    reads the recorded bytes as fast as it asks for them and reading past the recording raises ReplayExhausted,
+    instead of waiting for the timeout of the driver. With the RX interrupt, the recorded chunks are delivered to
+    the handler as the clock reaches their time.
+
+    :param Trace trace: the trace
+    :param Clock clock: the clock of the replay
+    :param int uart_id: id of the UART in the records
+    :param bool polling: any() raises ReplayExhausted too, so that polling loops end (False for the RX handler)
+    :param bool strict: raise ReplayMismatch when a write differs from the recording
+    """
+
+    IRQ_RXIDLE = 1
+
+    def __init__(self, trace: Trace, clock: "Clock", uart_id: int = 0, polling: bool = True, strict: bool = True):
+        self.trace = trace
+        self.clock = clock
+        self.uart_id = uart_id
+        self.polling = polling
+        self.strict = strict
+        self._chunks: deque[int] = deque()
+        self._writes: deque[int] = deque()
+        self._buf = bytearray()
+        self._pos = 0
+        self._handler = None
+        self.mismatches = 0
+
+    def window(self, first: int, last: int) -> bool:
+        """Serve the records between first and last. Returns True if the driver used the UART in them"""
+        records = self.trace.records
+        self._chunks = deque()
+        self._writes = deque()
+        for i in range(first, last):
+            kind, uart_id = records[i][0], records[i][1]
+            if uart_id != self.uart_id:
+                continue
+            if kind == REC_UART_RX:
+                self._chunks.append(i)
+            elif kind == REC_UART_TX:
+                self._writes.append(i)
+        self._buf = bytearray()
+        self._pos = 0
+        return bool(self._chunks or self._writes)
+
+    def _feed(self) -> None:
+        """Make the next recorded chunk available"""
+        del self._buf[:self._pos]
+        self._pos = 0
+        self._buf += self.trace.data(self._chunks.popleft())
+
+    def tick(self, ms: int) -> None:
+        """The clock reached ms: deliver the chunks received until then to the RX handler"""
+        if self._handler is None:
+            return
+        records = self.trace.records
+        while self._chunks and records[self._chunks[0]][4] <= ms:
+            self._feed()
+            self._handler(self)
+
+    def init(self, *args, **kwargs) -> None:
+        pass
+
+    def irq(self, handler=None, trigger: int = 0) -> None:
+        self._handler = handler
+        if handler is not None and self not in self.clock.devices:
+            self.clock.devices.append(self)
+
+    def any(self) -> int:
+        n = len(self._buf) - self._pos
+        if n == 0 and self.polling:
+            if not self._chunks:
+                raise ReplayExhausted("No recorded UART data left")
+            self._feed()
+            n = len(self._buf)
+        return n
+
+    def read(self, n: int = -1) -> bytes:
+        if self.polling:
+            while self._chunks and (n < 0 or len(self._buf) - self._pos < n):
+                self._buf += self.trace.data(self._chunks.popleft())
+        end = len(self._buf) if n < 0 else min(len(self._buf), self._pos + n)
+        if end == self._pos and self.polling:
+            raise ReplayExhausted("No recorded UART data left")
+        data = bytes(self._buf[self._pos:end])
+        self._pos = end
+        return data
+
+    def readinto(self, buf, n: int = -1) -> int:
+        data = self.read(len(buf) if n < 0 else n)
+        buf[:len(data)] = data
+        return len(data)
+
+    def write(self, buf) -> int:
+        if not self._writes:
+            raise ReplayExhausted("No recorded UART write left")
+        index = self._writes.popleft()
+        if bytes(self.trace.data(index)) != bytes(buf):
+            self.mismatches += 1
+            if self.strict:
+                raise ReplayMismatch("UART %d: written %s, recorded %s" % (
+                    self.uart_id, bytes(buf).hex(), bytes(self.trace.data(index)).hex()
+                ))
+        self.clock.ms = max(self.clock.ms, self.trace.records[index][4])
+        return len(buf)
+
+    def flush(self) -> None:
+        pass
+
+
+class Clock:
+    """Virtual clock and scheduler of the host simulator: sleeping advances the clock instantly"""
+
+    def __init__(self):
+        self.ms = 0
+        self.pending: list = []  # callbacks of micropython.schedule()
+        self.devices: list = []  # told by tick(ms) that the clock advanced, e.g. a UART receiving
+
+    def schedule(self, f, arg) -> None:
+        self.pending.append((f, arg))
+
+    def run_pending(self) -> None:
+        while self.pending:
+            f, arg = self.pending.pop(0)
+            f(arg)
+
+    def ticks_ms(self) -> int:
+        return self.ms
+
+    def ticks_us(self) -> int:
+        return self.ms * 1000
+
+    def _advance(self) -> None:
+        for device in self.devices:
+            device.tick(self.ms)
+        # like on the board, the scheduled callbacks run while sleeping
+        self.run_pending()
+
+    def sleep_ms(self, ms: int) -> None:
+        self.ms += max(0, ms)
+        self._advance()
+
+    def sleep(self, s: float) -> None:
+        self.ms += int(s * 1000)
+        self._advance()
+
+
+def host_modules(clock: Clock) -> None:
+    """
+    Install the MicroPython modules used by the drivers, so that the unmodified firmware code
+    runs on CPython with the virtual clock.
+    """
+    def identity(f):
+        return f
+
+    micropython = types.ModuleType("micropython")
+    micropython.const = lambda x: x
+    micropython.native = identity
+    micropython.viper = identity
+    micropython.schedule = clock.schedule
+
+    machine = types.ModuleType("machine")
+    machine.I2C = ReplayI2C
+    machine.UART = ReplayUART
+    machine.lightsleep = clock.sleep_ms
+
+    utime = types.ModuleType("utime")
+    utime.ticks_ms = clock.ticks_ms
+    utime.ticks_us = clock.ticks_us
+    utime.ticks_add = lambda a, b: a + b
+    utime.ticks_diff = lambda a, b: a - b
+    utime.sleep_ms = clock.sleep_ms
+    utime.sleep = clock.sleep
+    utime.time = lambda: int(time.time())
+
+    sys.modules["micropython"] = micropython
+    sys.modules["machine"] = machine
+    sys.modules["utime"] = utime
+    sys.modules["ustruct"] = struct
+
+    # the drivers import these from time, which on CPython doesn't have them
+    for name in ("ticks_ms", "ticks_us", "ticks_add", "ticks_diff", "sleep_ms"):
+        setattr(time, name, getattr(utime, name))
+
+    if FIRMWARE_DIR not in sys.path:
+        sys.path.insert(0, FIRMWARE_DIR)
+
+
+def firmware(clock: Clock, pms_irq: bool = False) -> types.ModuleType:
+    """Import the sensor pipeline of the firmware (micropython/sensors.py) on the host, bound to the clock"""
+    host_modules(clock)
+    sys.modules["utime"].time = lambda: clock.ms // 1000
+
+    conf = types.ModuleType("conf")
+    conf.PMS_IRQ = pms_irq
+    conf.PMS_SECOND_CORE = False
+    sys.modules["conf"] = conf
+
+    # a fresh import, bound to this clock
+    for name in FIRMWARE_MODULES:
+        sys.modules.pop(name, None)
+    import sensors
+    sensors.lightsleep = clock.sleep_ms  # the firmware loops on 1 ms sleeps, too slow here
+    return sensors
+
+
+class NoAudit:
+    def site(self, name: str) -> "NoAudit":
+        return self
+
+    def __enter__(self) -> "NoAudit":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+@dataclass
+class Result:
+    boots: int = 0
+    cycles: int = 0
+    i2c_failures: int = 0
+    frames: int = 0
+    caqi: list[tuple[int, int]] = field(default_factory=list)  # (ms since the boot, CAQI)
+    rows: list[tuple] = field(default_factory=list)  # seq and SENSOR_FIELDS, None if not valid
+
+
+def row(seq: int, readings: list, valid: int) -> tuple:
+    """Readings of the sensors in a cycle, None if not valid"""
+    return (seq,) + tuple(readings[i] if valid & (1 << i) else None for i in range(len(SENSOR_FIELDS)))
+
+
+def replay(trace: Trace, irq: bool = False, strict: bool = True, bmp_mode: int = 0, caqi_window: int = 3600) -> Result:
+    """
+    Replay every cycle of the trace through the sensor pipeline of the firmware: the drivers, the I2C scheduler,
+    the circuit breakers and the CAQI aggregation that recorded it.
+
+    Every boot builds the pipeline again and sets it up on the records before its first cycle. A warm boot
+    restores the state that the previous boot saved, like the snapshot of the firmware. The PMS is measured in
+    the cycles in which it was used, since whether it was due isn't recorded.
+    """
+    clock = Clock()
+    sensors = firmware(clock, pms_irq=irq)
+    from i2cbus import I2CBus
+    from settings import Settings
+    from snapshot import Snapshot
+
+    result = Result()
+    i2c = ReplayI2C(trace, strict=strict)
+    uart = ReplayUART(trace, clock, polling=not irq, strict=strict)
+    bus = I2CBus(i2c)
+    settings = Settings()
+    settings.bmp_mode = bmp_mode
+    settings.caqi_window = caqi_window
+
+    names = tuple(name for name, entry in sensors.REGISTRY.items() if entry.BUS == sensors.BUS_I2C)
+    if any(r[0] in (REC_UART_RX, REC_UART_TX) for r in trace.records):
+        names += ("pms7003",)
+    readings = [0] * len(FIELDS)
+    snapshot = None
+
+    cwd = os.getcwd()
+    # the SGP30 baselines are saved in the working directory, the messages of the firmware go to stderr
+    with tempfile.TemporaryDirectory(prefix="replay-") as workdir, contextlib.redirect_stdout(sys.stderr):
+        os.chdir(workdir)
+        try:
+            for boot in trace.boots:
+                result.boots += 1
+                if boot.warm and snapshot is None:
+                    print("Warm boot at %d not replayed: the state of the previous boot isn't in the trace" % boot.time)
+                    continue
+
+                end = boot.cycles[0].first - 1 if boot.cycles else len(trace.records)
+                clock.ms = trace.records[boot.first - 1][4]
+                i2c.window(boot.first, end)
+                uart.window(boot.first, end)
+                try:
+                    pipeline = sensors.Pipeline(names, FIELDS, bus, i2c, uart, settings, boot.warm, NoAudit())
+                    pipeline.setup(boot.warm)
+                    if boot.warm:
+                        pipeline.restore(snapshot, clock.ms // 1000 - RESET_SLEEP_S)
+                except ReplayMismatch as e:
+                    print("Boot at %d not replayed: %s" % (boot.time, e))
+                    snapshot = None
+                    continue
+
+                for cycle in boot.cycles:
+                    result.cycles += 1
+                    clock.ms = cycle.start
+                    i2c.window(cycle.first, cycle.last)
+                    due = uart.window(cycle.first, cycle.last)
+
+                    pipeline.start(due)
+                    valid = pipeline.measure(readings, due)
+
+                    for sensor in pipeline.sensors:
+                        if sensor.BUS == sensors.BUS_I2C and sensor.active and not sensor.valid:
+                            result.i2c_failures += 1
+                    if valid & (1 << F_PM25):
+                        result.frames += 1
+                    if valid & (1 << F_CAQI):
+                        result.caqi.append((cycle.start, readings[F_CAQI]))
+                    result.rows.append(row(cycle.seq, readings, valid))
+
+                # the snapshot taken before the reset
+                snapshot = Snapshot()
+                pipeline.save(snapshot)
+        finally:
+            os.chdir(cwd)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a sensor trace through the firmware drivers")
+    parser.add_argument("trace", help="trace recorded with TRACE = True (trace.bin)")
+    parser.add_argument("--irq", action="store_true", help="decode the PMS frames with the interrupt path")
+    parser.add_argument("--bmp-mode", type=int, default=0, help="BMP180 mode of the recording (settings)")
+    parser.add_argument("--lenient", action="store_true", help="don't stop when a write differs from the trace")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the trace this many times (benchmark)")
+    parser.add_argument("--csv", action="store_true", help="print the readings of every cycle")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    trace = Trace(args.trace)
+    index_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = None
+    for _ in range(args.repeat):
+        result = replay(trace, irq=args.irq, strict=not args.lenient, bmp_mode=args.bmp_mode)
+    replay_time = (time.perf_counter() - start) / args.repeat
+
+    if args.csv:
+        print(",".join(("seq",) + SENSOR_FIELDS))
+        for row in result.rows:
+            print(",".join("" if v is None else str(v) for v in row))
+
+    print("%d records, %d boots, %d cycles, %d PMS frames, %d I2C failures, %d CAQI values" % (
+        len(trace.records), result.boots, result.cycles, result.frames, result.i2c_failures, len(result.caqi)
+    ), file=sys.stderr)
+    print("Index: %.3f s, replay: %.3f s (%.0f cycles/s)" % (
+        index_time, replay_time, result.cycles / replay_time if replay_time else 0
+    ), file=sys.stderr)
+    trace.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+
+# Raw columns: UNIX time (s) and value, one pair of files per box, field and year
+TIME_DTYPE = np.dtype("<i8")
+VALUE_DTYPE = np.dtype("<f8")
+
+# Rollups: one row per bucket
+ROLLUP_DTYPE = np.dtype([
+    ("time", "<i8"),  # start of the bucket
+    ("count", "<u4"),
+    ("sum", "<f8"),
+    ("min", "<f8"),
+    ("max", "<f8"),
+])
+ROLLUPS = {
+    "1min": 60,
+    "1h": 3600,
+    "1d": 86400,
+}
+
+
+def _year(ts: int) -> int:
+    return datetime.fromtimestamp(ts, timezone.utc).year
+
+
+def _year_start(year: int) -> int:
+    return int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp())
+
+
+def _map(path: str, dtype: np.dtype, rows: Optional[int] = None) -> np.ndarray:
+    """Read-only memory map of a column file. Rows beyond a partial write (crash) are ignored"""
+    if rows is None:
+        rows = os.path.getsize(path) // dtype.itemsize
+    if rows == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(rows,))
+
+
+class Store:
+    """
+    Embedded append-only columnar store of the readings of the boxes.
+
+    Layout: ``<root>/<box>/<field>/<year>.time``, ``<year>.value`` and ``<year>.<rollup>``.
+    Every file is a plain little-endian array, read through memory maps: opening a year of
+    data costs a couple of system calls, and the arrays returned by read() are views of the
+    files as long as the range stays in a single year. Points are appended in time order
+    (older or duplicated points are dropped) and the rollups are updated at the same time.
+
+    :param str root: directory of the store, created if it doesn't exist
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def boxes(self) -> list[str]:
+        return sorted(d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d)))
+
+    def fields(self, box: str) -> list[str]:
+        path = os.path.join(self.root, box)
+        return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+    def _dir(self, box: str, field: str) -> str:
+        return os.path.join(self.root, box, field)
+
+    def years(self, box: str, field: str) -> list[int]:
+        path = self._dir(box, field)
+        if not os.path.isdir(path):
+            return []
+        return sorted(int(name[:-5]) for name in os.listdir(path) if name.endswith(".time"))
+
+    def _rows(self, base: str) -> int:
+        """Rows of a partition: the shortest of its columns, after a crash they may differ"""
+        try:
+            return min(
+                os.path.getsize(base + ".time") // TIME_DTYPE.itemsize,
+                os.path.getsize(base + ".value") // VALUE_DTYPE.itemsize,
+            )
+        except OSError:
+            return 0
+
+    # Ingestion
+
+    def append(self, box: str, field: str, times, values) -> int:
+        """Append points of a field. Returns how many were stored"""
+        times = np.asarray(times, dtype=TIME_DTYPE)
+        values = np.asarray(values, dtype=VALUE_DTYPE)
+        order = np.argsort(times, kind="stable")
+        times = times[order]
+        values = values[order]
+        # duplicated times of the batch: the first point is kept, as for the points already stored
+        if len(times) > 1:
+            first = np.r_[True, times[1:] != times[:-1]]
+            times = times[first]
+            values = values[first]
+
+        path = self._dir(box, field)
+        os.makedirs(path, exist_ok=True)
+
+        # drop what is not newer than the last stored point
+        years = self.years(box, field)
+        if years:
+            last = self.last(box, field)
+            if last is not None:
+                keep = times > last
+                times = times[keep]
+                values = values[keep]
+        if len(times) == 0:
+            return 0
+
+        # split by year
+        first_year = _year(int(times[0]))
+        last_year = _year(int(times[-1]))
+        stored = 0
+        for year in range(first_year, last_year + 1):
+            lo = np.searchsorted(times, _year_start(year))
+            hi = np.searchsorted(times, _year_start(year + 1))
+            if lo < hi:
+                self._append_partition(os.path.join(path, str(year)), times[lo:hi], values[lo:hi])
+                stored += hi - lo
+        return stored
+
+    def _append_partition(self, base: str, times: np.ndarray, values: np.ndarray) -> None:
+        # align the columns if a previous write was interrupted
+        rows = self._rows(base)
+        for suffix, dtype in ((".time", TIME_DTYPE), (".value", VALUE_DTYPE)):
+            if os.path.exists(base + suffix):
+                os.truncate(base + suffix, rows * dtype.itemsize)
+
+        with open(base + ".time", "ab") as f:
+            f.write(times.tobytes())
+        with open(base + ".value", "ab") as f:
+            f.write(values.tobytes())
+
+        for name, width in ROLLUPS.items():
+            self._update_rollup(base + "." + name, width, times, values)
+
+    @staticmethod
+    def _update_rollup(path: str, width: int, times: np.ndarray, values: np.ndarray) -> None:
+        buckets = times - times % width
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        rows = np.empty(len(starts), dtype=ROLLUP_DTYPE)
+        rows["time"] = buckets[starts]
+        rows["count"] = np.diff(np.r_[starts, len(times)])
+        rows["sum"] = np.add.reduceat(values, starts)
+        rows["min"] = np.minimum.reduceat(values, starts)
+        rows["max"] = np.maximum.reduceat(values, starts)
+
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        size -= size % ROLLUP_DTYPE.itemsize
+        with open(path, "r+b" if size else "wb") as f:
+            if size:
+                # merge the first bucket with the last stored one if it's the same
+                f.seek(size - ROLLUP_DTYPE.itemsize)
+                last = np.frombuffer(f.read(ROLLUP_DTYPE.itemsize), dtype=ROLLUP_DTYPE)[0]
+                if last["time"] == rows[0]["time"]:
+                    rows[0]["count"] += last["count"]
+                    rows[0]["sum"] += last["sum"]
+                    rows[0]["min"] = min(rows[0]["min"], last["min"])
+                    rows[0]["max"] = max(rows[0]["max"], last["max"])
+                    size -= ROLLUP_DTYPE.itemsize
+            f.seek(size)
+            f.truncate()
+            f.write(rows.tobytes())
+
+    def append_points(self, points: Iterable[tuple[float, str, float]]) -> int:
+        """Append (timestamp, "<box>/<field>", value) points, e.g. from scripts/decode_block.py"""
+        columns: dict[tuple[str, str], tuple[list, list]] = {}
+        for ts, topic, value in points:
+            box, _, field = topic.partition("/")
+            times, values = columns.setdefault((box, field), ([], []))
+            times.append(int(ts))
+            values.append(value)
+        return sum(self.append(box, field, times, values) for (box, field), (times, values) in columns.items())
+
+    # Queries
+
+    def last(self, box: str, field: str) -> Optional[int]:
+        """Time of the last stored point"""
+        for year in reversed(self.years(box, field)):
+            base = os.path.join(self._dir(box, field), str(year))
+            rows = self._rows(base)
+            if rows:
+                return int(_map(base + ".time", TIME_DTYPE, rows)[-1])
+        return None
+
+    def partitions(
+            self, box: str, field: str, start: Optional[int] = None, stop: Optional[int] = None
+    ) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """Yield (times, values) of every year between start and stop (UNIX time, stop excluded) without copying"""
+        for year in self.years(box, field):
+            if start is not None and _year_start(year + 1) <= start:
+                continue
+            if stop is not None and _year_start(year) >= stop:
+                continue
+            base = os.path.join(self._dir(box, field), str(year))
+            rows = self._rows(base)
+            times = _map(base + ".time", TIME_DTYPE, rows)
+            values = _map(base + ".value", VALUE_DTYPE, rows)
+            lo = np.searchsorted(times, start) if start is not None else 0
+            hi = np.searchsorted(times, stop) if stop is not None else rows
+            yield times[lo:hi], values[lo:hi]
+
+    def read(
+            self, box: str, field: str, start: Optional[int] = None, stop: Optional[int] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Points of a field. Views of the files for a range in a single year, a copy otherwise"""
+        parts = list(self.partitions(box, field, start, stop))
+        if not parts:
+            return np.empty(0, dtype=TIME_DTYPE), np.empty(0, dtype=VALUE_DTYPE)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate([t for t, _ in parts]), np.concatenate([v for _, v in parts])
+
+    def rollup(
+            self, box: str, field: str, rollup: str = "1h", start: Optional[int] = None, stop: Optional[int] = None
+    ) -> np.ndarray:
+        """Rows (time, count, sum, min, max) of a rollup. The mean is sum / count"""
+        if rollup not in ROLLUPS:
+            raise ValueError("Unknown rollup: %s" % rollup)
+        parts = []
+        for year in self.years(box, field):
+            if start is not None and _year_start(year + 1) <= start:
+                continue
+            if stop is not None and _year_start(year) >= stop:
+                continue
+            rows = _map(os.path.join(self._dir(box, field), "%d.%s" % (year, rollup)), ROLLUP_DTYPE)
+            lo = np.searchsorted(rows["time"], start) if start is not None else 0
+            hi = np.searchsorted(rows["time"], stop) if stop is not None else len(rows)
+            parts.append(rows[lo:hi])
+        if not parts:
+            return np.empty(0, dtype=ROLLUP_DTYPE)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def series(self, box: str, field: str, start: Optional[int] = None, stop: Optional[int] = None,
+               rollup: Optional[str] = None, tz: str = "Europe/Rome"):
+        """A field as a pandas Series indexed by local time; the mean of every bucket with a rollup"""
+        import pandas as pd
+
+        if rollup is None:
+            times, values = self.read(box, field, start, stop)
+        else:
+            rows = self.rollup(box, field, rollup, start, stop)
+            times, values = rows["time"], rows["sum"] / rows["count"]
+        index = pd.to_datetime(times, unit="s", utc=True).tz_convert(tz)
+        return pd.Series(values, index=index, name=field)
+
+
+def _import_influx(store: Store, box: str, field: str) -> int:
+    """Copy a year of a field from InfluxDB (the query of scripts/plot.py)"""
+    from plot import MEASUREMENTS, get_influx_data
+
+    series = get_influx_data(MEASUREMENTS.get(field, field))
+    times = series.index.tz_convert("UTC").as_unit("s").asi8
+    return store.append(box, field, times, series.to_numpy(dtype=np.float64))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local columnar store of the readings")
+    parser.add_argument("--root", default=os.getenv("TSSTORE_PATH", "tsstore"), help="directory of the store")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest = commands.add_parser("ingest", help="append the timestamp,topic,value lines of decode_block.py (stdin)")
+    ingest.add_argument("file", nargs="?", default="-")
+
+    influx = commands.add_parser("import-influx", help="copy a year of a field from InfluxDB")
+    influx.add_argument("field", help="MQTT name of the field, e.g. temperature")
+    influx.add_argument("--box", default="box01")
+
+    commands.add_parser("info", help="list boxes, fields and points")
+
+    args = parser.parse_args()
+    store = Store(args.root)
+
+    if args.command == "ingest":
+        points = []
+        with (sys.stdin if args.file == "-" else open(args.file, "r")) as f:
+            for line in f:
+                ts, topic, value = line.strip().split(",")
+                points.append((float(ts), topic, float(value)))
+        print("%d points stored" % store.append_points(points))
+    elif args.command == "import-influx":
+        print("%d points stored" % _import_influx(store, args.box, args.field))
+    elif args.command == "info":
+        start = time.perf_counter()
+        for box in store.boxes():
+            for field in store.fields(box):
+                points = sum(len(t) for t, _ in store.partitions(box, field))
+                print("%s/%s: %d points, last %s" % (box, field, points, store.last(box, field)))
+        print("%.3f s" % (time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()